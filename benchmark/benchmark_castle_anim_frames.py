@@ -0,0 +1,307 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# Benchmark of the castle-anim-frames exporter (export_castle_anim_frames.py).
+#
+# Generates synthetic scenes (N objects animated during M frames,
+# by rigid transformation, shape keys or armature, with or without particles),
+# exports each one and measures the total time and the time of each stage
+# of exporting frames (see FRAME_STAGES in export_castle_anim_frames.py).
+#
+# Run in real Blender (headless):
+#
+#   blender --background --factory-startup --python-exit-code 1 \
+#     --python benchmark/benchmark_castle_anim_frames.py -- --objects 100 --frames 50
+#
+# or without Blender, using a lightweight stand-in for bpy (see fake_bpy.py),
+# which measures only the frame-writing logic of the exporter (glTF frames only):
+#
+#   python3 benchmark/benchmark_castle_anim_frames.py --fake-bpy
+#
+# Use --save-baseline to store the results in the --baseline file,
+# and later run with the same --baseline to compare with it:
+# the script fails (exit status 1) if some scenario is slower than the baseline
+# by more than --threshold. Baselines depend on the machine, so they are not
+# stored in the repository.
+
+import sys
+import os
+import json
+import time
+import argparse
+import tempfile
+import shutil
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIR = os.path.dirname(BENCHMARK_DIR)
+
+ANIMATIONS = ('RIGID', 'SHAPE_KEYS', 'ARMATURE')
+
+# Frame formats supported by fake_bpy.
+FAKE_BPY_FRAME_FORMATS = ('GLTF', 'GLTF_SEPARATE')
+
+def parse_arguments():
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else sys.argv[1:]
+    parser = argparse.ArgumentParser(description='Benchmark castle-anim-frames exporter.')
+    parser.add_argument('--objects', type=int, default=50,
+        help='Number of animated objects.')
+    parser.add_argument('--frames', type=int, default=50,
+        help='Number of animation frames.')
+    parser.add_argument('--vertices', type=int, default=500,
+        help='Number of vertices of each object (approximate in real Blender).')
+    parser.add_argument('--static-objects', type=int, default=0,
+        help='Number of additional objects that are not animated.')
+    parser.add_argument('--animation', nargs='+', choices=ANIMATIONS, default=list(ANIMATIONS),
+        help='Kinds of animation to test.')
+    parser.add_argument('--particles', type=int, default=0,
+        help='If non-zero, also test each animation with this many particles.')
+    parser.add_argument('--frame-format',
+        help='Value of frame_format exporter property. By default X3D, or GLTF when using fake_bpy (which supports only glTF frames).')
+    parser.add_argument('--export-option', action='append', default=[], metavar='NAME=JSON_VALUE',
+        help='Additional exporter property, e.g. frame_skip=0 or tight_bounding_box=true.')
+    parser.add_argument('--repeat', type=int, default=1,
+        help='Export each scenario this many times, and use the fastest time.')
+    parser.add_argument('--baseline',
+        help='JSON file with baseline results.')
+    parser.add_argument('--save-baseline', action='store_true',
+        help='Save the results to the --baseline file, instead of comparing with it.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+        help='Allowed slowdown relative to the baseline, 0.2 means 20%%.')
+    parser.add_argument('--output',
+        help='Also save the results to this JSON file.')
+    parser.add_argument('--fake-bpy', action='store_true',
+        help='Use fake_bpy instead of real Blender, even if available.')
+    return parser.parse_args(argv)
+
+def create_real_scene(objects, frames, animation, particles, vertices, static_objects):
+    """Replace the scene (in real Blender) with a synthetic one,
+    like fake_bpy.create_scene."""
+
+    import bpy
+    import math
+
+    bpy.ops.wm.read_factory_settings(use_empty=True)
+    scene = bpy.context.scene
+    scene.frame_start = 1
+    scene.frame_end = frames
+
+    # icosphere with 10 * 4^n + 2 vertices
+    subdivisions = max(1, min(7, round(math.log(max(vertices - 2, 10) / 10, 4))))
+    bpy.ops.mesh.primitive_ico_sphere_add(subdivisions=subdivisions)
+    template = bpy.context.object
+    template_mesh = template.data
+    bpy.data.objects.remove(template)
+
+    if animation == 'ARMATURE':
+        armature_data = bpy.data.armatures.new('Armature')
+        armature = bpy.data.objects.new('Armature', armature_data)
+        scene.collection.objects.link(armature)
+        bpy.context.view_layer.objects.active = armature
+        bpy.ops.object.mode_set(mode='EDIT')
+        bone = armature_data.edit_bones.new('Bone')
+        bone.head = (0, 0, -1)
+        bone.tail = (0, 0, 1)
+        bpy.ops.object.mode_set(mode='POSE')
+        pose_bone = armature.pose.bones['Bone']
+        pose_bone.rotation_mode = 'XYZ'
+        for (frame, angle) in ((1, 0.0), (frames, math.pi / 2)):
+            pose_bone.rotation_euler = (angle, 0, 0)
+            pose_bone.keyframe_insert('rotation_euler', frame=frame)
+        bpy.ops.object.mode_set(mode='OBJECT')
+
+    for index in range(objects):
+        obj = bpy.data.objects.new('Sphere%d' % index, template_mesh.copy())
+        obj.location = (index * 3.0, 0.0, 0.0)
+        scene.collection.objects.link(obj)
+        if animation == 'RIGID':
+            for (frame, angle) in ((1, 0.0), (frames, math.pi * 2)):
+                obj.rotation_euler = (0, 0, angle + index)
+                obj.location.y = angle
+                obj.keyframe_insert('rotation_euler', frame=frame)
+                obj.keyframe_insert('location', frame=frame)
+        elif animation == 'SHAPE_KEYS':
+            obj.shape_key_add(name='Basis')
+            shape_key = obj.shape_key_add(name='Deform')
+            for point in shape_key.data:
+                point.co *= 1.0 + 0.2 * math.sin(point.co.z * 4.0 + index)
+            for (frame, value) in ((1, 0.0), (frames, 1.0)):
+                shape_key.value = value
+                shape_key.keyframe_insert('value', frame=frame)
+        else:
+            vertex_group = obj.vertex_groups.new(name='Bone')
+            vertex_group.add(range(len(obj.data.vertices)), 1.0, 'REPLACE')
+            modifier = obj.modifiers.new('Armature', 'ARMATURE')
+            modifier.object = armature
+
+    for index in range(static_objects):
+        obj = bpy.data.objects.new('Static%d' % index, template_mesh.copy())
+        obj.location = (index * 3.0, 6.0, 0.0)
+        scene.collection.objects.link(obj)
+
+    if particles:
+        bpy.ops.mesh.primitive_plane_add(size=10, location=(-6, 0, 0))
+        emitter = bpy.context.object
+        emitter.name = 'Emitter'
+        emitter.modifiers.new('Particles', 'PARTICLE_SYSTEM')
+        settings = emitter.particle_systems[0].settings
+        settings.count = particles
+        settings.frame_start = 1
+        settings.frame_end = max(1, frames // 2)
+        settings.lifetime = frames
+        settings.render_type = 'OBJECT'
+        settings.instance_object = scene.objects['Sphere0']
+        settings.particle_size = 0.1
+
+def run_scenario(options, bpy, exporter, animation, particles, temp_dir):
+    """Create the scene and export it, options.repeat times.
+    Returns the results of the fastest export."""
+
+    if options.fake_bpy:
+        import fake_bpy
+        fake_bpy.create_scene(options.objects, options.frames, animation, particles, options.vertices,
+            options.static_objects)
+    else:
+        create_real_scene(options.objects, options.frames, animation, particles, options.vertices,
+            options.static_objects)
+
+    export_options = {'frame_format': options.frame_format}
+    for option in options.export_option:
+        (name, value) = option.split('=', 1)
+        export_options[name] = json.loads(value)
+
+    best = None
+    for repeat in range(options.repeat):
+        filepath = os.path.join(temp_dir, 'benchmark.castle-anim-frames')
+        frames_statistics = []
+        exporter.frame_statistics_listeners.append(frames_statistics.append)
+        try:
+            start_time = time.perf_counter()
+            bpy.ops.export.castle_anim_frames(filepath=filepath, **export_options)
+            total = time.perf_counter() - start_time
+        finally:
+            exporter.frame_statistics_listeners.remove(frames_statistics.append)
+
+        if best is None or total < best['total']:
+            stages = {}
+            for frame_statistics in frames_statistics:
+                for (stage, stage_time) in frame_statistics['times'].items():
+                    stages[stage] = stages.get(stage, 0.0) + stage_time
+            best = {
+                'total': total,
+                'stages': stages,
+                'frames': len(frames_statistics),
+                'size': os.path.getsize(filepath),
+            }
+    return best
+
+def compare_with_baseline(results, baseline, threshold):
+    """Print comparison of results with the baseline.
+    Returns False if some scenario is slower than allowed by threshold."""
+
+    ok = True
+    for (name, result) in sorted(results.items()):
+        if name not in baseline:
+            print("%-50s %8.3f s (no baseline)" % (name, result['total']))
+            continue
+        ratio = result['total'] / max(baseline[name]['total'], 1e-9)
+        regression = ratio > 1.0 + threshold
+        if regression:
+            ok = False
+        print("%-50s %8.3f s, baseline %8.3f s (%+.0f%%)%s" % (name, result['total'],
+            baseline[name]['total'], (ratio - 1.0) * 100.0, ' REGRESSION' if regression else ''))
+    return ok
+
+def load_bpy(options):
+    """Return the bpy module, or fake_bpy when not running inside Blender
+    (or when requested by options.fake_bpy)."""
+    if not options.fake_bpy:
+        try:
+            import bpy
+            return bpy
+        except ImportError:
+            print("Not running inside Blender, using fake_bpy")
+            options.fake_bpy = True
+    sys.path.insert(0, BENCHMARK_DIR)
+    import fake_bpy
+    return fake_bpy.install()
+
+def main():
+    options = parse_arguments()
+
+    bpy = load_bpy(options)
+    if options.fake_bpy:
+        if options.frame_format is None:
+            options.frame_format = 'GLTF'
+        elif options.frame_format not in FAKE_BPY_FRAME_FORMATS:
+            sys.exit('fake_bpy supports only frame formats %s, not %s. Run the benchmark in Blender to test other formats.' %
+                (', '.join(FAKE_BPY_FRAME_FORMATS), options.frame_format))
+    elif options.frame_format is None:
+        options.frame_format = 'X3D'
+
+    sys.path.insert(0, REPOSITORY_DIR)
+    sys.path.insert(0, os.path.join(REPOSITORY_DIR, 'x3d_exporter'))
+    import export_castle_anim_frames as exporter
+    exporter.register()
+
+    scenarios = [(animation, particles)
+        for animation in options.animation
+        for particles in ([0, options.particles] if options.particles else [0])]
+
+    results = {}
+    temp_dir = tempfile.mkdtemp(prefix='castle_anim_frames_benchmark_')
+    try:
+        for (animation, particles) in scenarios:
+            name = '%s_%dobjects_%dframes_%dparticles_%s' % (animation.lower(),
+                options.objects, options.frames, particles, options.frame_format.lower())
+            if options.static_objects:
+                name += '_%dstatic' % options.static_objects
+            if options.fake_bpy:
+                name += '_fake'
+            result = run_scenario(options, bpy, exporter, animation, particles, temp_dir)
+            results[name] = result
+            print("%s: %.3f s, %d frames, %d bytes (%s)" % (name, result['total'],
+                result['frames'], result['size'],
+                ', '.join('%s %.3f s' % stage for stage in sorted(result['stages'].items()))))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1)
+
+    ok = True
+    if options.baseline:
+        if options.save_baseline:
+            baseline = {}
+            if os.path.exists(options.baseline):
+                with open(options.baseline, 'r', encoding='utf-8') as f:
+                    baseline = json.load(f)
+            baseline.update(results)
+            with open(options.baseline, 'w', encoding='utf-8') as f:
+                json.dump(baseline, f, indent=1)
+            print("Saved baseline to", options.baseline)
+        else:
+            with open(options.baseline, 'r', encoding='utf-8') as f:
+                baseline = json.load(f)
+            ok = compare_with_baseline(results, baseline, options.threshold)
+
+    if not ok:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
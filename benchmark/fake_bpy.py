@@ -0,0 +1,430 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# Lightweight stand-in for Blender Python API (bpy, bpy.props, bpy_extras,
+# mathutils, addon_utils), sufficient to run the castle-anim-frames exporter
+# (export_castle_anim_frames.py) with glTF frames outside of Blender.
+#
+# The scene is synthetic (see create_scene), and the glTF exporter
+# writes a simple glTF file with the vertex positions of all objects.
+# This allows to measure the frame-writing logic of castle-anim-frames
+# exporter (bounding boxes, copying and escaping frames, statistics)
+# where real Blender is not available. It is not useful to measure
+# the performance of Blender itself (evaluating the scene, glTF exporter).
+
+import sys
+import os
+import json
+import math
+import types
+import base64
+import numpy
+
+# ----------------------------------------------------------------------------
+# mathutils
+
+class Matrix(list):
+    """4x4 matrix, as a list of rows (so numpy.array(matrix) works like in Blender)."""
+
+    def __init__(self, rows=None):
+        if rows is None:
+            rows = numpy.identity(4)
+        super().__init__([list(map(float, row)) for row in rows])
+
+    def to_4x4(self):
+        return Matrix(self)
+
+    def __matmul__(self, other):
+        return Matrix(numpy.array(self) @ numpy.array(other))
+
+class Vector(tuple):
+    pass
+
+def axis_conversion(from_forward='Y', from_up='Z', to_forward='Y', to_up='Z'):
+    """Only converting Blender axes to Y-up (forward Z, up Y,
+    the default of castle-anim-frames exporter) is supported."""
+    if (to_forward, to_up) == ('Z', 'Y'):
+        return Matrix(((1, 0, 0, 0), (0, 0, 1, 0), (0, -1, 0, 0), (0, 0, 0, 1)))
+    return Matrix()
+
+# ----------------------------------------------------------------------------
+# bpy.props
+
+class Property:
+    """Property definition, used as a class annotation of an operator."""
+
+    def __init__(self, default, **kwargs):
+        self.default = default
+        self.kwargs = kwargs
+
+def BoolProperty(default=False, **kwargs):
+    return Property(default, **kwargs)
+
+def IntProperty(default=0, **kwargs):
+    return Property(default, **kwargs)
+
+def FloatProperty(default=0.0, **kwargs):
+    return Property(default, **kwargs)
+
+def StringProperty(default='', **kwargs):
+    return Property(default, **kwargs)
+
+def EnumProperty(default=None, items=(), **kwargs):
+    if default is None and items:
+        default = items[0][0]
+    return Property(default, items=items, **kwargs)
+
+path_reference_mode = EnumProperty(default='AUTO')
+
+def orientation_helper(axis_forward='Y', axis_up='Z'):
+    def decorator(cls):
+        cls.__annotations__ = dict(cls.__dict__.get('__annotations__', {}),
+            axis_forward=EnumProperty(default=axis_forward),
+            axis_up=EnumProperty(default=axis_up))
+        return cls
+    return decorator
+
+# ----------------------------------------------------------------------------
+# bpy.types
+
+class RnaProperty:
+    def __init__(self, identifier):
+        self.identifier = identifier
+
+class Operator:
+    """Operator base class. Properties (class annotations) become
+    instance attributes with default values."""
+
+    def __init__(self):
+        for (name, prop) in self.get_property_definitions().items():
+            setattr(self, name, prop.default)
+
+    @classmethod
+    def get_property_definitions(cls):
+        definitions = {}
+        for klass in reversed(cls.__mro__):
+            for (name, prop) in klass.__dict__.get('__annotations__', {}).items():
+                if isinstance(prop, Property):
+                    definitions[name] = prop
+        return definitions
+
+    @property
+    def properties(self):
+        return types.SimpleNamespace(bl_rna=types.SimpleNamespace(
+            properties=[RnaProperty(name) for name in self.get_property_definitions()]))
+
+    def report(self, report_type, message):
+        print('%s: %s' % ('/'.join(sorted(report_type)), message))
+
+class Menu:
+    def __init__(self):
+        self.functions = []
+
+    def append(self, function):
+        self.functions.append(function)
+
+    def remove(self, function):
+        self.functions.remove(function)
+
+# ----------------------------------------------------------------------------
+# synthetic scene
+
+class Collection(list):
+    """Collection with foreach_get, values of attributes are NumPy arrays."""
+
+    def __init__(self, length, attributes):
+        super().__init__(range(length))
+        self.attributes = attributes
+
+    def foreach_get(self, attribute, values):
+        values[:] = self.attributes[attribute].ravel()
+
+class Mesh:
+    def __init__(self, coords):
+        self.vertices = Collection(len(coords), {'co': coords, 'normal': coords})
+        self.loops = Collection(len(coords), {'vertex_index': numpy.arange(len(coords))})
+        polygons_count = len(coords) // 4
+        self.polygons = Collection(polygons_count, {
+            'material_index': numpy.zeros(polygons_count),
+            'loop_total': numpy.full(polygons_count, 4)})
+        self.uv_layers = types.SimpleNamespace(active=None)
+        self.vertex_colors = types.SimpleNamespace(active=None)
+        self.materials = []
+
+class Object:
+    """Object of the synthetic scene.
+
+    Its transformation and vertices (in object space) at a given frame
+    are calculated by functions matrix_at(frame) and coords_at(frame).
+    """
+
+    def __init__(self, name, object_type, matrix_at, coords_at=None):
+        self.name = name
+        self.type = object_type
+        self.matrix_at = matrix_at
+        self.coords_at = coords_at
+        self.original = self
+        self.modifiers = []
+        self.constraints = []
+        self.material_slots = []
+        self.animation_data = None
+        self.data = None
+
+    def visible_get(self, view_layer=None):
+        return True
+
+    def select_get(self, view_layer=None):
+        return True
+
+    def evaluated_get(self, depsgraph):
+        return self
+
+    @property
+    def matrix_world(self):
+        return Matrix(self.matrix_at(context.scene.frame_current))
+
+    @property
+    def bound_box(self):
+        if self.coords_at is None:
+            return [(-1.0, -1.0, -1.0)] * 8
+        coords = self.coords_at(context.scene.frame_current)
+        box_min = coords.min(axis=0)
+        box_max = coords.max(axis=0)
+        return [(box_max[0] if i & 1 else box_min[0],
+                 box_max[1] if i & 2 else box_min[1],
+                 box_max[2] if i & 4 else box_min[2]) for i in range(8)]
+
+    def to_mesh(self):
+        if self.coords_at is None:
+            return None
+        return Mesh(self.coords_at(context.scene.frame_current))
+
+    def to_mesh_clear(self):
+        pass
+
+class Instance:
+    """Instance (particle) of an object, in depsgraph.object_instances."""
+
+    def __init__(self, parent, instance_object, matrix):
+        self.is_instance = True
+        self.parent = parent
+        self.object = instance_object
+        self.matrix_world = matrix
+
+class Depsgraph:
+    def __init__(self, scene):
+        self.scene = scene
+
+    @property
+    def object_instances(self):
+        return [Instance(parent, instance_object, Matrix(matrix_at(self.scene.frame_current)))
+            for (parent, instance_object, matrix_at) in self.scene.instances]
+
+class Scene:
+    def __init__(self):
+        self.objects = []
+        self.instances = []
+        self.frame_start = 1
+        self.frame_end = 1
+        self.frame_current = 1
+
+    def frame_set(self, frame):
+        self.frame_current = frame
+        for handler in app.handlers.frame_change_post:
+            handler(self, Depsgraph(self))
+
+class Context:
+    def __init__(self):
+        self.scene = Scene()
+        self.view_layer = None
+        self.blend_data = data
+
+    def evaluated_depsgraph_get(self):
+        return Depsgraph(self.scene)
+
+def sphere_coords(vertices):
+    """Vertices (NumPy array Nx3) evenly distributed on a unit sphere."""
+    i = numpy.arange(vertices) + 0.5
+    phi = numpy.arccos(1.0 - 2.0 * i / vertices)
+    theta = math.pi * (1.0 + 5.0 ** 0.5) * i
+    return numpy.stack((numpy.cos(theta) * numpy.sin(phi),
+                        numpy.sin(theta) * numpy.sin(phi),
+                        numpy.cos(phi)), axis=1).astype(numpy.float32)
+
+def rotation_z_matrix(angle, translation):
+    (s, c) = (math.sin(angle), math.cos(angle))
+    return ((c, -s, 0, translation[0]),
+            (s, c, 0, translation[1]),
+            (0, 0, 1, translation[2]),
+            (0, 0, 0, 1))
+
+def create_scene(objects, frames, animation, particles, vertices=500, static_objects=0):
+    """Replace the scene with a synthetic one: objects spheres
+    animated during frames (from 1), with animation 'RIGID' (transformation),
+    'SHAPE_KEYS' or 'ARMATURE' (both deform vertices, the armature
+    is an additional object), particles instances of the first sphere,
+    and static_objects spheres that are not animated."""
+
+    scene = context.scene = Scene()
+    scene.frame_end = frames
+    base_coords = sphere_coords(vertices)
+
+    def static_matrix(index):
+        return lambda frame: rotation_z_matrix(0.0, (index * 3.0, 0.0, 0.0))
+
+    def rigid_matrix(index):
+        return lambda frame: rotation_z_matrix(frame * 0.05 + index, (index * 3.0, math.sin(frame * 0.1), 0.0))
+
+    def deformed_coords(index):
+        wave = numpy.sin(base_coords[:, 2] * 4.0 + index)[:, numpy.newaxis]
+        return lambda frame: base_coords * (1.0 + 0.2 * math.sin(frame * 0.1) * wave)
+
+    for index in range(objects):
+        if animation == 'RIGID':
+            obj = Object('Sphere%d' % index, 'MESH', rigid_matrix(index), lambda frame: base_coords)
+        else:
+            obj = Object('Sphere%d' % index, 'MESH', static_matrix(index), deformed_coords(index))
+        scene.objects.append(obj)
+    if animation == 'ARMATURE':
+        scene.objects.append(Object('Armature', 'ARMATURE', static_matrix(0)))
+
+    for index in range(static_objects):
+        scene.objects.append(Object('Static%d' % index, 'MESH',
+            lambda frame, index=index: rotation_z_matrix(0.0, (index * 3.0, 6.0, 0.0)),
+            lambda frame: base_coords))
+
+    if particles:
+        emitter = Object('Emitter', 'MESH', static_matrix(-2), lambda frame: base_coords[:4])
+        scene.objects.append(emitter)
+        for index in range(particles):
+            scene.instances.append((emitter, scene.objects[0],
+                lambda frame, index=index: rotation_z_matrix(index, (index % 100, index // 100, frame * 0.01))))
+
+# ----------------------------------------------------------------------------
+# bpy.ops
+
+class OperatorCall:
+    """Callable bpy.ops.xxx.yyy."""
+
+    def __init__(self, function, poll=lambda: True):
+        self.function = function
+        self.poll = poll
+
+    def __call__(self, *args, **kwargs):
+        # ignore execution context, like 'INVOKE_DEFAULT'
+        return self.function(**kwargs)
+
+def export_gltf(filepath, export_format='GLTF_EMBEDDED', **options):
+    """Write glTF with vertex positions of all objects (and instances)."""
+
+    depsgraph = context.evaluated_depsgraph_get()
+    buffer_data = bytearray()
+    gltf = {'asset': {'version': '2.0', 'generator': 'fake_bpy'}, 'nodes': [], 'meshes': [],
+        'accessors': [], 'bufferViews': []}
+    objects = [(obj.name, obj) for obj in context.scene.objects] + \
+        [('%s_instance' % instance.object.name, instance.object) for instance in depsgraph.object_instances]
+    for (name, obj) in objects:
+        node = {'name': name, 'matrix': list(numpy.array(obj.matrix_world).T.ravel())}
+        if obj.coords_at is not None:
+            node['mesh'] = len(gltf['meshes'])
+            gltf['meshes'].append({'name': name, 'primitives': [{'attributes': {'POSITION': len(gltf['accessors'])}}]})
+            coords = obj.coords_at(context.scene.frame_current).astype(numpy.float32)
+            gltf['accessors'].append({'bufferView': len(gltf['bufferViews']),
+                'componentType': 5126, 'count': len(coords), 'type': 'VEC3'})
+            gltf['bufferViews'].append({'buffer': 0, 'byteOffset': len(buffer_data), 'byteLength': coords.nbytes})
+            buffer_data += coords.tobytes()
+        gltf['nodes'].append(node)
+
+    if export_format == 'GLTF_SEPARATE':
+        bin_name = os.path.splitext(os.path.basename(filepath))[0] + '.bin'
+        with open(os.path.join(os.path.dirname(filepath), bin_name), 'wb') as f:
+            f.write(buffer_data)
+        uri = bin_name
+    else:
+        uri = 'data:application/octet-stream;base64,' + base64.b64encode(bytes(buffer_data)).decode('ascii')
+    gltf['buffers'] = [{'byteLength': len(buffer_data), 'uri': uri}]
+
+    with open(filepath, 'w', encoding='utf-8') as f:
+        json.dump(gltf, f, indent=2)
+    return {'FINISHED'}
+
+def register_class(cls):
+    (category, name) = cls.bl_idname.split('.')
+    def execute(**properties):
+        operator = cls()
+        for (property_name, value) in properties.items():
+            setattr(operator, property_name, value)
+        return operator.execute(context)
+    setattr(getattr(ops, category), name, OperatorCall(execute))
+
+def unregister_class(cls):
+    (category, name) = cls.bl_idname.split('.')
+    delattr(getattr(ops, category), name)
+
+ops = types.SimpleNamespace(
+    object=types.SimpleNamespace(mode_set=OperatorCall(lambda mode: {'FINISHED'}, poll=lambda: False)),
+    export_scene=types.SimpleNamespace(gltf=OperatorCall(export_gltf)),
+    export=types.SimpleNamespace(),
+)
+
+data = types.SimpleNamespace(filepath='', actions=[], objects=[], is_dirty=False)
+app = types.SimpleNamespace(binary_path=None, version=(2, 81, 0),
+    handlers=types.SimpleNamespace(frame_change_post=[]))
+context = Context()
+
+# ----------------------------------------------------------------------------
+
+def install():
+    """Make "import bpy" (and other Blender modules used by
+    castle-anim-frames exporter) use this stand-in.
+    Returns the stand-in bpy module."""
+
+    props = types.ModuleType('bpy.props')
+    for name in ('BoolProperty', 'IntProperty', 'FloatProperty', 'StringProperty', 'EnumProperty'):
+        setattr(props, name, globals()[name])
+    props.__all__ = ['BoolProperty', 'IntProperty', 'FloatProperty', 'StringProperty', 'EnumProperty']
+
+    bpy = types.ModuleType('bpy')
+    bpy.props = props
+    bpy.types = types.SimpleNamespace(Operator=Operator, TOPBAR_MT_file_export=Menu())
+    bpy.utils = types.SimpleNamespace(register_class=register_class, unregister_class=unregister_class)
+    bpy.ops = ops
+    bpy.data = data
+    bpy.app = app
+    bpy.context = context
+
+    io_utils = types.ModuleType('bpy_extras.io_utils')
+    io_utils.orientation_helper = orientation_helper
+    io_utils.path_reference_mode = path_reference_mode
+    io_utils.axis_conversion = axis_conversion
+    bpy_extras = types.ModuleType('bpy_extras')
+    bpy_extras.io_utils = io_utils
+
+    mathutils = types.ModuleType('mathutils')
+    mathutils.Matrix = Matrix
+    mathutils.Vector = Vector
+
+    sys.modules.update({
+        'bpy': bpy,
+        'bpy.props': props,
+        'bpy_extras': bpy_extras,
+        'bpy_extras.io_utils': io_utils,
+        'mathutils': mathutils,
+        'addon_utils': types.ModuleType('addon_utils'),
+    })
+    return bpy
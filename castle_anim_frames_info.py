@@ -0,0 +1,349 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# Validate a castle-anim-frames file and print its statistics.
+# Does not need Blender, run it like this:
+#
+#   python3 castle_anim_frames_info.py my_animation.castle-anim-frames
+#
+# The file is parsed as a stream (frame by frame), so even huge files
+# are processed with constant memory. Files compressed with gzip
+# (see "Compress" option of the exporter) are handled too.
+#
+# Exit status is 1 if the file is invalid, which makes it useful in automatic tests.
+# Use --json to get the statistics in a machine-readable form.
+
+import sys
+import json
+import gzip
+import hashlib
+import argparse
+from xml.parsers import expat
+
+MIME_TYPES = ('model/x3d+xml', 'model/gltf+json')
+
+def parse_floats(value, count):
+    """Parse a string with exactly count floats, return None if invalid."""
+    try:
+        result = [float(f) for f in value.split()]
+    except ValueError:
+        return None
+    if len(result) != count:
+        return None
+    return result
+
+def gltf_vertices(content):
+    """Number of vertices in glTF JSON content (counting the POSITION
+    attributes of all mesh primitives). Raises exception if content is not valid glTF."""
+    gltf = json.loads(content)
+    if not isinstance(gltf, dict) or 'asset' not in gltf:
+        raise Exception('glTF without "asset" property')
+    accessors = gltf.get('accessors', [])
+    vertices = 0
+    for mesh in gltf.get('meshes', []):
+        for primitive in mesh.get('primitives', []):
+            position = primitive.get('attributes', {}).get('POSITION')
+            if position is not None:
+                vertices += accessors[position]['count']
+    return vertices
+
+class RunningStatistics:
+    """Count, minimum, sum and maximum of the added values,
+    without remembering the values (so memory use is constant)."""
+
+    def __init__(self):
+        self.count = 0
+        self.min = 0
+        self.sum = 0
+        self.max = 0
+
+    def add(self, value):
+        if self.count == 0:
+            self.min = value
+            self.max = value
+        else:
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self):
+        """Minimum, average and maximum, as a dictionary."""
+        return {'min': self.min, 'avg': self.sum / self.count if self.count else 0, 'max': self.max}
+
+class AnimationStatistics:
+    """Statistics of one <animation> element."""
+
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.bytes = RunningStatistics()
+        self.vertices = RunningStatistics()
+        self.duplicate_frames = 0
+        self.duration = 0.0
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'frames': self.frames,
+            'duration': self.duration,
+            'bytes': self.bytes.sum,
+            'bytes_per_frame': self.bytes.as_dict(),
+            'vertices_per_frame': self.vertices.as_dict(),
+            'duplicate_frames': self.duplicate_frames,
+        }
+
+class CastleAnimFramesChecker:
+    """Parse castle-anim-frames file as a stream (using expat),
+    validating it and gathering AnimationStatistics for each animation.
+
+    Problems are collected in the errors list (as strings with line numbers),
+    parsing continues after them, unless the XML is not well-formed.
+    """
+
+    def __init__(self):
+        self.errors = []
+        self.animations = []
+
+        self.parser = expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.character_data
+
+        # stack of element names
+        self.elements = []
+        self.animation = None
+        self.frame_time = None
+        self.previous_frame_time = None
+
+        # state of the current <frame>
+        self.frame_start_byte = None
+        self.frame_mime_type = None
+        self.frame_hash = None
+        self.frame_vertices = 0
+        self.frame_root_elements = []
+        self.frame_text = []
+
+        # hashes of previous 2 frames, to detect frames that could be removed
+        # (in a run of identical frames, only the first and last are necessary)
+        self.previous_frame_hashes = []
+
+    def error(self, message):
+        self.errors.append('Line %d: %s' % (self.parser.CurrentLineNumber, message))
+
+    def parse(self, file):
+        """Parse file (binary file object)."""
+        try:
+            self.parser.ParseFile(file)
+        except expat.ExpatError as e:
+            self.errors.append('XML not well-formed: %s' % e)
+        if not self.animations and not self.errors:
+            self.errors.append('No animations')
+
+    def start_element(self, name, attributes):
+        depth = len(self.elements)
+        self.elements.append(name)
+
+        if depth == 0:
+            if name != 'animations':
+                self.error('Root element must be <animations>, not <%s>' % name)
+        elif depth == 1:
+            if name != 'animation':
+                self.error('Unexpected <%s> inside <animations>' % name)
+                return
+            animation_name = attributes.get('name', 'animation')
+            if any(animation.name == animation_name for animation in self.animations):
+                self.error('Duplicate animation name "%s"' % animation_name)
+            self.animation = AnimationStatistics(animation_name)
+            self.animations.append(self.animation)
+            self.previous_frame_time = None
+            self.previous_frame_hashes = []
+        elif depth == 2:
+            if self.animation is None:
+                self.error('Unexpected <%s> outside of <animation>' % name)
+                return
+            if name != 'frame':
+                self.error('Unexpected <%s> inside <animation>' % name)
+                return
+            self.start_frame(attributes)
+        elif self.frame_hash is not None:
+            if depth == 3:
+                self.frame_root_elements.append(name)
+            if name == 'Coordinate' and 'point' in attributes:
+                self.frame_vertices += len(attributes['point'].split()) // 3
+            self.frame_hash.update(('<%s' % name).encode('utf-8'))
+            for attribute in sorted(attributes.items()):
+                self.frame_hash.update((' %s="%s"' % attribute).encode('utf-8'))
+
+    def start_frame(self, attributes):
+        self.frame_start_byte = self.parser.CurrentByteIndex
+        self.frame_hash = hashlib.sha1()
+        self.frame_vertices = 0
+        self.frame_root_elements = []
+        self.frame_text = []
+
+        # time
+        try:
+            self.frame_time = float(attributes['time'])
+        except KeyError:
+            self.error('Frame without time')
+            self.frame_time = None
+        except ValueError:
+            self.error('Invalid frame time "%s"' % attributes['time'])
+            self.frame_time = None
+        if self.frame_time is not None and self.previous_frame_time is not None and \
+           self.frame_time <= self.previous_frame_time:
+            self.error('Frame time %f is not larger than previous frame time %f' %
+                (self.frame_time, self.previous_frame_time))
+        if self.frame_time is not None:
+            self.previous_frame_time = self.frame_time
+
+        # mime_type
+        self.frame_mime_type = attributes.get('mime_type', 'model/x3d+xml')
+        if self.frame_mime_type not in MIME_TYPES:
+            self.error('Unknown frame mime_type "%s"' % self.frame_mime_type)
+
+        # bounding box
+        if ('bounding_box_center' in attributes) != ('bounding_box_size' in attributes):
+            self.error('Frame must have both bounding_box_center and bounding_box_size, or none')
+        if 'bounding_box_center' in attributes and \
+           parse_floats(attributes['bounding_box_center'], 3) is None:
+            self.error('Invalid bounding_box_center "%s"' % attributes['bounding_box_center'])
+        if 'bounding_box_size' in attributes:
+            size = parse_floats(attributes['bounding_box_size'], 3)
+            if size is None:
+                self.error('Invalid bounding_box_size "%s"' % attributes['bounding_box_size'])
+            # size -1 -1 -1 means "empty", otherwise must be >= 0
+            elif any(s < 0 for s in size) and size != [-1.0, -1.0, -1.0]:
+                self.error('Negative bounding_box_size "%s"' % attributes['bounding_box_size'])
+
+    def character_data(self, data):
+        if self.frame_hash is None:
+            if data.strip():
+                self.error('Unexpected text "%s"' % data.strip()[:20])
+            return
+        self.frame_hash.update(data.encode('utf-8'))
+        # text directly inside <frame> is glTF content, keep it to parse later
+        if len(self.elements) == 3 and self.frame_mime_type == 'model/gltf+json':
+            self.frame_text.append(data)
+
+    def end_element(self, name):
+        self.elements.pop()
+        depth = len(self.elements)
+        if self.frame_hash is not None and depth > 2:
+            self.frame_hash.update(('</%s>' % name).encode('utf-8'))
+        elif depth == 2 and name == 'frame' and self.frame_hash is not None:
+            self.end_frame()
+        elif depth == 1 and name == 'animation':
+            self.animation = None
+
+    def end_frame(self):
+        if self.frame_mime_type == 'model/x3d+xml':
+            if self.frame_root_elements != ['X3D']:
+                self.error('Frame with mime_type "model/x3d+xml" must contain exactly one <X3D> element, not %s' %
+                    self.frame_root_elements)
+        elif self.frame_mime_type == 'model/gltf+json':
+            if self.frame_root_elements:
+                self.error('Frame with mime_type "model/gltf+json" cannot contain XML elements')
+            try:
+                self.frame_vertices = gltf_vertices(''.join(self.frame_text))
+            except Exception as e:
+                self.error('Invalid glTF in frame: %s' % e)
+
+        # bytes from the beginning of <frame> to the beginning of </frame>
+        frame_bytes = self.parser.CurrentByteIndex - self.frame_start_byte
+        frame_hash = self.frame_hash.digest()
+
+        animation = self.animation
+        animation.frames += 1
+        animation.bytes.add(frame_bytes)
+        animation.vertices.add(self.frame_vertices)
+        if self.frame_time is not None:
+            animation.duration = self.frame_time
+
+        # frame identical to 2 previous frames means that the previous frame was not necessary
+        if self.previous_frame_hashes == [frame_hash, frame_hash]:
+            animation.duplicate_frames += 1
+        self.previous_frame_hashes = self.previous_frame_hashes[-1:] + [frame_hash]
+
+        self.frame_hash = None
+        self.frame_text = []
+
+def open_file(filename):
+    """Open castle-anim-frames file for reading (as binary),
+    automatically decompressing if it is compressed with gzip."""
+    file = open(filename, 'rb')
+    if file.peek(2)[:2] == b'\x1f\x8b':
+        return gzip.GzipFile(fileobj=file, mode='rb')
+    return file
+
+def check_file(filename):
+    """Validate castle-anim-frames file.
+    Returns CastleAnimFramesChecker instance, with errors and animations statistics."""
+    checker = CastleAnimFramesChecker()
+    with open_file(filename) as file:
+        checker.parse(file)
+    return checker
+
+def print_statistics(filename, checker):
+    print('%s:' % filename)
+    for animation in checker.animations:
+        statistics = animation.as_dict()
+        print('  Animation "%s": %d frames, %.2f seconds, %d bytes' %
+            (animation.name, animation.frames, animation.duration, statistics['bytes']))
+        for key in ('bytes_per_frame', 'vertices_per_frame'):
+            print('    %s: min %d, avg %.1f, max %d' % ((key.replace('_', ' '), ) +
+                tuple(statistics[key][k] for k in ('min', 'avg', 'max'))))
+        if animation.duplicate_frames:
+            print('    %d frames could be removed (identical to previous and next frames)' %
+                animation.duplicate_frames)
+    for error in checker.errors:
+        print('  ERROR: %s' % error)
+    print('  %s' % ('Invalid' if checker.errors else 'Valid'))
+
+def main():
+    parser = argparse.ArgumentParser(description='Validate castle-anim-frames files and print their statistics.')
+    parser.add_argument('filenames', nargs='+', metavar='FILE',
+        help='castle-anim-frames file (possibly compressed with gzip).')
+    parser.add_argument('--json', action='store_true',
+        help='Print the statistics and errors as JSON.')
+    options = parser.parse_args()
+
+    results = {}
+    valid = True
+    for filename in options.filenames:
+        checker = check_file(filename)
+        if checker.errors:
+            valid = False
+        if options.json:
+            results[filename] = {
+                'animations': [animation.as_dict() for animation in checker.animations],
+                'errors': checker.errors,
+            }
+        else:
+            print_statistics(filename, checker)
+
+    if options.json:
+        print(json.dumps(results, indent=1))
+
+    if not valid:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
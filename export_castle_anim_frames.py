@@ -21,7 +21,9 @@
 # The format specification is on
 # https://castle-engine.io/castle_animation_frames.php
 # Each still frame is exported to a static frame (as X3D or glTF).
-# We call actual Blender X3D/glTF exporter to do this.
+# We call actual X3D exporter (from x3d_exporter/castle_engine_x3d in this
+# repository, writing straight into the castle-anim-frames file)
+# or Blender glTF exporter to do this.
 #
 # The latest version of this script can be found on
 # https://castle-engine.io/creating_data_blender.php
@@ -43,15 +45,281 @@ bl_info = {
 
 import bpy
 import os
+import sys
+import json
+import shutil
+import subprocess
+import tempfile
+import argparse
+import urllib.parse
+import gzip
+import csv
+import time
 from bpy_extras.io_utils import (
     orientation_helper,
     path_reference_mode,
     axis_conversion,
     )
 from bpy.props import *
-from mathutils import Vector
 import addon_utils
 import html
+import hashlib
+import re
+import math
+import numpy
+from xml.sax.saxutils import quoteattr
+
+# Size (in characters) of chunks in which the temporary glTF frame is copied.
+GLTF_COPY_CHUNK_SIZE = 1024 * 1024
+
+# Increase when the exported <animation> contents change for the same input,
+# to not reuse animations cached by an older version of this script.
+ANIMATIONS_CACHE_VERSION = 2
+
+# Properties that don't affect the exported <animation> contents.
+ANIMATIONS_CACHE_IGNORED_SETTINGS = {'verbose', 'use_change_tracking', 'worker_processes', 'worker_job', 'use_animations_cache', 'timing_report',
+    'use_compress', 'compress_level'}
+
+# Stages of exporting a frame, measured for the timing report:
+# frame_set (evaluating the scene at given frame),
+# make_duplicates_real (making duplicates real and removing them),
+# bounding_box, export (X3D exporter writing straight to the output,
+# or glTF exporter writing a temporary file) and copy (copying the temporary glTF file).
+FRAME_STAGES = ('frame_set', 'make_duplicates_real', 'bounding_box', 'export', 'copy')
+
+# Functions called with the statistics of each exported frame
+# (a dictionary, see ExportCastleAnimFrames.add_frame_statistics).
+# Add here a function to collect them, e.g. from a benchmark.
+frame_statistics_listeners = []
+
+# Points (in object space) that determine the object transformation:
+# origin and the ends of 3 axes.
+OBJECT_TRANSFORM_POINTS = numpy.array(
+    ((0.0, 0.0, 0.0),
+     (1.0, 0.0, 0.0),
+     (0.0, 1.0, 0.0),
+     (0.0, 0.0, 1.0)))
+
+def transform_points(matrix, points):
+    """Transform points (NumPy array Nx3) by a 4x4 matrix (NumPy array)."""
+    return points @ matrix[:3, :3].T + matrix[:3, 3]
+
+def get_evaluated_vertices(obj_for_mesh):
+    """Vertex coordinates (NumPy array Nx3, in object space) of the object mesh."""
+    mesh = obj_for_mesh.to_mesh()
+    if mesh is None:
+        return numpy.zeros((0, 3))
+    coords = numpy.empty(len(mesh.vertices) * 3, dtype=numpy.float32)
+    mesh.vertices.foreach_get('co', coords)
+    obj_for_mesh.to_mesh_clear()
+    return coords.reshape(-1, 3)
+
+def points_min_max(points):
+    """Minimum and maximum (NumPy array 2x3, or 0x3 if no points) of points."""
+    if len(points) == 0:
+        return points
+    return numpy.array((points.min(axis=0), points.max(axis=0)))
+
+def interpolation_error(points_start, points_end, points_middle, factor):
+    """Maximum distance between points_middle and the linear interpolation
+    of points_start..points_end with given factor.
+
+    Returns infinity if the arrays have different shapes
+    (e.g. the number of vertices changed), then interpolation is not possible.
+    """
+    if points_start.shape != points_end.shape or \
+       points_start.shape != points_middle.shape:
+        return float('inf')
+    if len(points_start) == 0:
+        return 0.0
+    interpolated = points_start + (points_end - points_start) * factor
+    return numpy.sqrt(((points_middle - interpolated) ** 2).sum(axis=1).max())
+
+def hash_rna_values(hash, struct):
+    """Update hash with values of all simple (not pointer or collection)
+    properties of a Blender struct, like Material or Light."""
+    for prop in struct.bl_rna.properties:
+        if prop.type in {'BOOLEAN', 'INT', 'FLOAT', 'STRING', 'ENUM'}:
+            value = getattr(struct, prop.identifier)
+            if prop.type in {'BOOLEAN', 'INT', 'FLOAT'} and prop.is_array:
+                value = tuple(value)
+            hash.update(repr((prop.identifier, value)).encode('utf-8'))
+
+def hash_materials(hash, obj_eval):
+    """Update hash with the materials of an object (their names and values,
+    including the default values of their nodes inputs)."""
+    for slot in obj_eval.material_slots:
+        material = slot.material
+        if material is not None:
+            hash.update(material.name.encode('utf-8'))
+            hash_rna_values(hash, material)
+            if material.node_tree:
+                for node in material.node_tree.nodes:
+                    for node_input in node.inputs:
+                        if hasattr(node_input, 'default_value'):
+                            hash_rna_values(hash, node_input)
+
+def hash_foreach(hash, collection, attribute, dtype, item_size = 1):
+    """Update hash with the values of a given attribute of all collection items."""
+    values = numpy.empty(len(collection) * item_size, dtype=dtype)
+    collection.foreach_get(attribute, values)
+    hash.update(values.tobytes())
+
+def merge_data_hashes(animations_data_hashes):
+    """Merge the results of get_objects_data_hashes for multiple animations:
+    object data hash is kept only if it is the same in all animations, otherwise it is None."""
+    result = {}
+    for data_hashes in animations_data_hashes:
+        for (obj_name, data_hash) in data_hashes.items():
+            if obj_name not in result:
+                result[obj_name] = data_hash
+            elif result[obj_name] != data_hash:
+                result[obj_name] = None
+    return result
+
+def hash_fcurves(hash, fcurves):
+    """Update hash with the animation curves: their keyframes, modifiers and drivers."""
+    for fcurve in fcurves:
+        hash.update(repr((fcurve.data_path, fcurve.array_index, fcurve.extrapolation)).encode('utf-8'))
+        hash_foreach(hash, fcurve.keyframe_points, 'co', numpy.float32, 2)
+        hash_foreach(hash, fcurve.keyframe_points, 'handle_left', numpy.float32, 2)
+        hash_foreach(hash, fcurve.keyframe_points, 'handle_right', numpy.float32, 2)
+        hash_foreach(hash, fcurve.keyframe_points, 'interpolation', numpy.int32)
+        for modifier in fcurve.modifiers:
+            hash_rna_values(hash, modifier)
+        if fcurve.driver:
+            hash.update(repr((fcurve.driver.type, fcurve.driver.expression)).encode('utf-8'))
+            for variable in fcurve.driver.variables:
+                hash.update(repr((variable.name, variable.type,
+                    [(target.id.name if target.id else None, target.data_path) for target in variable.targets])).encode('utf-8'))
+
+def import_x3d_exporter():
+    """Import and return X3D exporter module.
+
+    Imported only when needed, to not require the X3D exporter addon
+    when exporting only glTF frames.
+    """
+    try:
+        from castle_engine_x3d import export_x3d
+    except ImportError:
+        raise Exception('Exporting X3D requires the "castle_engine_x3d" addon (from cge-blender x3d_exporter/) to be installed')
+    return export_x3d
+
+class StageTimer:
+    """Measure the wall-clock time of consecutive stages (see FRAME_STAGES)."""
+
+    def __init__(self):
+        self.times = {}
+        self.start_time = self.last_time = time.perf_counter()
+
+    def stage(self, name):
+        """Finish a stage, that started when the previous stage finished."""
+        now = time.perf_counter()
+        self.times[name] = self.times.get(name, 0.0) + now - self.last_time
+        self.last_time = now
+
+    def total(self):
+        return self.last_time - self.start_time
+
+class ObjectChangeTracker:
+    """Track which objects changed between the exported frames,
+    to reuse the results calculated for unchanged objects (see get).
+
+    An object did not change when its evaluated transformation
+    and the hash of its evaluated geometry (calculated by geometry_hash
+    function, given to the constructor) are equal to the ones remembered
+    with the result. Comparing the actual values (not relying on the
+    dependency graph updates) makes this correct whatever changes the objects:
+    animation, drivers, constraints, physics.
+
+    Geometry hash of each object is calculated once per frame,
+    it is forgotten when the frame changes (frame_change_post handler)
+    and when invalidate is called.
+
+    When the tracker is not enabled, the results are always calculated.
+    """
+
+    def __init__(self, enabled, geometry_hash):
+        self.enabled = enabled
+        self.geometry_hash = geometry_hash
+        self.geometry_hashes = {}
+        self.cache = {}
+
+        # statistics
+        self.reused = 0
+        self.calculated = 0
+
+    def start(self):
+        if self.enabled:
+            bpy.app.handlers.frame_change_post.append(self.frame_change_post)
+
+    def stop(self):
+        if self.frame_change_post in bpy.app.handlers.frame_change_post:
+            bpy.app.handlers.frame_change_post.remove(self.frame_change_post)
+
+    def invalidate(self):
+        """Forget the geometry hashes of the current frame, when the scene
+        changed without a frame change, e.g. when objects were added
+        or when the action changed."""
+        self.geometry_hashes.clear()
+
+    def frame_change_post(self, scene, depsgraph=None):
+        self.invalidate()
+
+    def get_geometry_hash(self, obj, obj_eval):
+        """Hash (bytes) of the object geometry in the current frame."""
+        if not self.enabled:
+            return self.geometry_hash(obj, obj_eval)
+        result = self.geometry_hashes.get(obj.name)
+        if result is None:
+            result = self.geometry_hashes[obj.name] = self.geometry_hash(obj, obj_eval)
+        return result
+
+    def get(self, cache_name, obj, obj_eval, calculate, use_transform=True):
+        """Return calculate() result for a given object.
+
+        Reuses the result remembered under cache_name for this object,
+        if the object did not change since it was calculated.
+        The result always depends on object geometry;
+        use_transform says whether it also depends on object transformation.
+        """
+        if not self.enabled:
+            return calculate()
+        key = self.get_geometry_hash(obj, obj_eval)
+        if use_transform:
+            key += numpy.array(obj_eval.matrix_world).tobytes()
+        cached = self.cache.get((cache_name, obj.name))
+        if cached is not None and cached[0] == key:
+            self.reused += 1
+            return cached[1]
+        result = calculate()
+        self.cache[(cache_name, obj.name)] = (key, result)
+        self.calculated += 1
+        return result
+
+class CountingWriter:
+    """Pass writes to output_file, counting the written characters
+    (equal to bytes for ASCII content)."""
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return self.output_file.write(data)
+
+class FrameSink:
+    """File-like object that X3D exporter writes to.
+
+    Everything is written straight into the castle-anim-frames output file.
+    The name is the castle-anim-frames filename,
+    X3D exporter uses it to calculate texture paths relative to it.
+    """
+
+    def __init__(self, output_file, name):
+        self.write = output_file.write
+        self.name = name
 
 @orientation_helper(axis_forward='Z', axis_up='Y')
 class ExportCastleAnimFrames(bpy.types.Operator):
@@ -83,6 +351,87 @@ class ExportCastleAnimFrames(bpy.types.Operator):
         description="How many frames to skip between the exported frames. The Castle Game Engine using castle-anim-frames format will reconstruct these frames using linear interpolation.",
             default=4, min=0, max=50)
 
+    frame_sampling: EnumProperty(
+        name='Sampling',
+        items=(('FIXED', 'Fixed',
+                'Export every frame, skipping "Frames to skip" frames between the exported frames.'),
+               ('ADAPTIVE', 'Adaptive',
+                'Export only the frames that cannot be reconstructed by linear interpolation (within "Tolerance") from the neighbouring exported frames.')),
+        description='How to choose the exported frames.',
+        default='FIXED'
+    )
+
+    sampling_tolerance: FloatProperty(name="Tolerance",
+        description="For adaptive sampling: maximum allowed distance (in world space) between the real position of a vertex or object and the position reconstructed by linear interpolation.",
+        default=0.01, min=0.0, precision=4, subtype='DISTANCE')
+
+    collapse_identical_frames: BoolProperty(
+            name="Collapse Identical Frames",
+            description="Detect runs of exported frames where the scene (geometry, transformations, materials) does not change, and export only the first and last frame of each run.",
+            default=False,
+            )
+
+    tight_bounding_box: BoolProperty(
+            name="Tight Bounding Box",
+            description="Calculate the bounding box of each frame exactly, from the (evaluated) vertices of the objects. Otherwise the box is calculated from the bounding boxes of objects, which is faster but larger than necessary when objects are rotated.",
+            default=False,
+            )
+
+    share_static_geometry: BoolProperty(
+            name="Share Static Geometry",
+            description="Write the geometry of objects that does not change in any exported frame only once, to a separate X3D file (next to the castle-anim-frames file), referenced by Inline from every frame. Only for X3D frames.",
+            default=False,
+            )
+
+    use_compress: BoolProperty(
+            name="Compress",
+            description="Compress the castle-anim-frames file using gzip (consider adding .gz extension to the file name). It is compressed while writing, so large animations do not need to fit in memory.",
+            default=False,
+            )
+
+    compress_level: IntProperty(
+            name="Compression Level",
+            description="Gzip compression level, 1 is the fastest, 9 gives the smallest file.",
+            default=6, min=1, max=9,
+            )
+
+    timing_report: EnumProperty(
+        name='Timing Report',
+        items=(('NONE', 'None', 'Do not write a timing report.'),
+               ('JSON', 'JSON', 'Write a timing report as JSON.'),
+               ('CSV', 'CSV', 'Write a timing report as CSV.')),
+        description='Write the time of each stage of exporting each frame, and the size of each frame, to a file next to the castle-anim-frames file (with .timing.json or .timing.csv extension added). Summary is also shown as the export report.',
+        default='NONE'
+    )
+
+    use_animations_cache: BoolProperty(
+            name="Reuse Unchanged Animations",
+            description="Keep the exported animations in a cache directory next to the castle-anim-frames file (with .cache extension added). When exporting again, animations that did not change (their actions, objects, modifiers, meshes, materials and export settings are the same) are copied from the cache, not exported again.",
+            default=False,
+            )
+
+    use_change_tracking: BoolProperty(
+            name="Track Object Changes",
+            description="Reuse the per-object calculations (bounding box, evaluated vertices, hashes, X3D geometry) from the previous frames for objects that did not change. An object did not change when its transformation and the hash of its geometry are equal",
+            default=True,
+            )
+
+    verbose: BoolProperty(
+            name="Verbose",
+            description="Print statistics about the export to the console.",
+            default=False,
+            )
+
+    worker_processes: IntProperty(
+            name="Worker Processes",
+            description="Export the frames using this many background Blender processes running in parallel (each exports a part of the frames, using a copy of the current blend file). 0 means to export all frames in this Blender process. Not used when exporting using X3D interpolators.",
+            default=0, min=0, max=64,
+            )
+
+    # Internal: path to the JSON file describing the job of a worker process,
+    # see output_animations_parallel.
+    worker_job: StringProperty(options={'HIDDEN', 'SKIP_SAVE'})
+
     actions_object: StringProperty(
             name="Actions",
             description="If set, we will export all the actions of a given object. Leave empty to instead export the current animation from Start to End.",
@@ -91,7 +440,7 @@ class ExportCastleAnimFrames(bpy.types.Operator):
 
     make_duplicates_real: BoolProperty(
             name="Make Duplicates Real",
-            description="This option allows to export particles (and other things not exportable without a \"Make Duplicates Real\" call).",
+            description="This option allows to export particles (and other things not exportable without a \"Make Duplicates Real\" call) using glTF frames. Not necessary for X3D frames, that export instances directly (all instances share the mesh of the instanced object), which is much faster.",
             default=False,
             )
 
@@ -99,8 +448,12 @@ class ExportCastleAnimFrames(bpy.types.Operator):
         name='Format',
         items=(('GLTF', 'glTF',
                 'Export each static frame using glTF exporter. This is more functional in general, as glTF exporter can handle normal maps, PBR materials, unlit materials etc.'),
+               ('GLTF_SEPARATE', 'glTF (Separate Binary)',
+                'Export each static frame using glTF exporter, but store the frame geometry in a binary file (in a directory next to the castle-anim-frames file, with _frames suffix) referenced from the frame. Textures are stored in a shared "textures" subdirectory. This makes castle-anim-frames much smaller and faster to load than glTF frames with embedded (base64) geometry.'),
                ('X3D', 'X3D',
-                'Export each static frame using X3D exporter. This is less functional in general, as current X3D exporter misses various features.')),
+                'Export each static frame using X3D exporter. This is less functional in general, as current X3D exporter misses various features.'),
+               ('X3D_INTERPOLATORS', 'X3D Interpolators',
+                'Instead of castle-anim-frames, write a single X3D file (with the same name, but .x3d extension). The scene is exported once, with a TimeSensor for each animation. Object transformations are animated using X3D interpolators, and so are vertex positions and normals of deforming meshes. When the mesh topology (faces, materials, texture coordinates) changes during the animation, or deforming meshes are triangulated, castle-anim-frames with X3D frames is exported instead. Hierarchy is always exported.')),
         description=(
             'Each static frame is recorded using another exporter, to X3D or glTF.'
         ),
@@ -145,14 +498,43 @@ class ExportCastleAnimFrames(bpy.types.Operator):
                          "indicate their type"),
             default=True,
             )
-    use_h3d: BoolProperty(
-            name="H3D Extensions",
-            description="Export shaders for H3D",
-            default=False,
-            )
 
     path_mode: path_reference_mode
 
+    # ------------------------------------------------------------------------
+    # precision of X3D geometry, passed through to the X3D exporter
+
+    coord_decimals: IntProperty(
+            name="Coordinate Decimals",
+            description="Number of decimal digits of vertex coordinates",
+            default=6, min=0, max=8,
+            )
+    relative_coord_precision: FloatProperty(
+            name="Relative Coordinate Precision",
+            description="If non-zero, vertex coordinates in each frame are written with as many decimal digits as necessary to express this fraction of the frame bounding box size (for example 0.0001 means 1/10000 of the bounding box size). This overrides \"Coordinate Decimals\" for frames, making small frames precise and large frames small.",
+            default=0.0, min=0.0, max=0.1, precision=6,
+            )
+    normal_decimals: IntProperty(
+            name="Normal Decimals",
+            description="Number of decimal digits of vertex normals",
+            default=6, min=0, max=8,
+            )
+    uv_decimals: IntProperty(
+            name="Texture Coordinate Decimals",
+            description="Number of decimal digits of texture coordinates",
+            default=4, min=0, max=8,
+            )
+    color_decimals: IntProperty(
+            name="Color Decimals",
+            description="Number of decimal digits of vertex colors",
+            default=3, min=0, max=8,
+            )
+    strip_zeros: BoolProperty(
+            name="Strip Trailing Zeros",
+            description="Do not write trailing zeros of vertex coordinates, normals, texture coordinates and colors (makes the file smaller)",
+            default=False,
+            )
+
     # methods ----------------------------------------------------------------
 
     def draw(self, context):
@@ -170,9 +552,24 @@ class ExportCastleAnimFrames(bpy.types.Operator):
         # http://blender.stackexchange.com/questions/6975/is-it-possible-to-use-bpy-props-pointerproperty-to-store-a-pointer-to-an-object
         box.prop_search(self, 'actions_object', context.scene, "objects")
 
-        box.prop(self, "frame_skip")
+        box.prop(self, "frame_sampling")
+        if self.frame_sampling == 'ADAPTIVE':
+            box.prop(self, "sampling_tolerance")
+        else:
+            box.prop(self, "frame_skip")
+        box.prop(self, "collapse_identical_frames")
+        box.prop(self, "tight_bounding_box")
         box.prop(self, "make_duplicates_real")
         box.prop(self, "frame_format")
+        box.prop(self, "use_compress")
+        if self.use_compress:
+            box.prop(self, "compress_level")
+        box.prop(self, "share_static_geometry")
+        box.prop(self, "worker_processes")
+        box.prop(self, "use_animations_cache")
+        box.prop(self, "timing_report")
+        box.prop(self, "use_change_tracking")
+        box.prop(self, "verbose")
 
         box = layout.box()
         box.label(text="X3D settings:")
@@ -182,23 +579,23 @@ class ExportCastleAnimFrames(bpy.types.Operator):
         box.prop(self, "use_normals")
         box.prop(self, "use_hierarchy")
         box.prop(self, "name_decorations")
-        box.prop(self, "use_h3d")
+        box.prop(self, "coord_decimals")
+        box.prop(self, "relative_coord_precision")
+        box.prop(self, "normal_decimals")
+        box.prop(self, "uv_decimals")
+        box.prop(self, "color_decimals")
+        box.prop(self, "strip_zeros")
         box.prop(self, "axis_forward")
         box.prop(self, "axis_up")
         box.prop(self, "path_mode")
 
-    def is_bound_box_empty(self, bound_box):
-        """Is the Blender bound_box empty.
-
-        The box is represented as 24 floats, as defined by Blender API, see
-        https://www.blender.org/api/blender_python_api_current/bpy.types.Object.html#bpy.types.Object.bound_box
-        (somewhat uncomfortable representation, IMHO...).
-        """
-
-        for f in bound_box:
-            if f != -1:
-                return False
-        return True
+    def get_exported_objects(self, context):
+        """Objects that are exported (visible, and selected if use_selection)."""
+        view_layer = context.view_layer
+        if self.use_selection:
+            return [obj for obj in context.scene.objects if obj.visible_get(view_layer=view_layer) and obj.select_get(view_layer=view_layer)]
+        else:
+            return [obj for obj in context.scene.objects if obj.visible_get(view_layer=view_layer)]
 
     def get_current_bounding_box(self, context):
         """Calculate current scene bounding box.
@@ -209,112 +606,107 @@ class ExportCastleAnimFrames(bpy.types.Operator):
         (see http://www.web3d.org/documents/specifications/19775-1/V3.2/Part01/components/group.html#Group)
         and castle-anim-frames bounding_box_center/size fields
         (see http://michalis.ii.uni.wroc.pl/cge-www-preview/castle_animation_frames.php).
+
+        With tight_bounding_box, objects with geometry contribute
+        their world-space vertices, otherwise the corners of their bound_box.
+        Instances (particles, instanced collections) of exported objects
+        always contribute the corners of their bound_box.
         """
 
-        view_layer = context.view_layer
-        scene_box_empty = True
-        scene_box_min = (0.0, 0.0, 0.0)
-        scene_box_max = (0.0, 0.0, 0.0)
+        # filter out cameras, lights etc., otherwise they have a bounding box
+        box_types = {'ARMATURE', 'LATTICE', 'EMPTY', 'CAMERA', 'LAMP', 'LIGHT', 'SPEAKER'}
+        exported_objects = self.get_exported_objects(context)
+        objects = [ob for ob in exported_objects if ob.type not in box_types]
 
-        if self.use_selection:
-            objects = [obj for obj in context.scene.objects if obj.visible_get(view_layer=view_layer) and obj.select_get(view_layer=view_layer)]
-        else:
-            objects = [obj for obj in context.scene.objects if obj.visible_get(view_layer=view_layer)]
-
-        global_matrix = axis_conversion(to_forward=self.axis_forward, to_up=self.axis_up).to_4x4()
+        points = [numpy.zeros((0, 3))]
+        depsgraph = context.evaluated_depsgraph_get()
 
-        for ob in objects:
-            # filter out cameras, lights etc., otherwise they have a bounding box
-            if (ob.type not in ('ARMATURE', 'LATTICE', 'EMPTY', 'CAMERA', 'LAMP', 'SPEAKER')) and \
-               (not self.is_bound_box_empty(ob.bound_box)):
-                # world-space bounding box calculation,
-                # see blender/2.78/scripts/addons/object_fracture_cell/fracture_cell_setup.py
-                # and http://blender.stackexchange.com/questions/8459/get-blender-x-y-z-and-bounding-box-with-script
-                object_box_points = [global_matrix @ ob.matrix_world @ Vector(corner) for corner in ob.bound_box]
-
-                # calculate object_box_min/max
-                object_box_min = (object_box_points[0].x, object_box_points[0].y,  object_box_points[0].z)
-                object_box_max = object_box_min
-                for v in object_box_points:
-                    object_box_min = (min(v.x, object_box_min[0]),
-                                      min(v.y, object_box_min[1]),
-                                      min(v.z, object_box_min[2]))
-                    object_box_max = (max(v.x, object_box_max[0]),
-                                      max(v.y, object_box_max[1]),
-                                      max(v.z, object_box_max[2]))
-
-                # update scene_box_min/max/empty
-                if scene_box_empty:
-                    scene_box_min = object_box_min
-                    scene_box_max = object_box_max
+        if self.tight_bounding_box:
+            global_matrix = numpy.array(self.global_matrix)
+            box_objects = []
+            for ob in objects:
+                if ob.type in {'MESH', 'CURVE', 'SURFACE', 'FONT'}:
+                    obj_eval = ob.evaluated_get(depsgraph)
+                    # minimum and maximum of world-space vertices is enough
+                    points.append(self.change_tracker.get('bounding_box', ob, obj_eval,
+                        lambda: points_min_max(transform_points(global_matrix @ numpy.array(obj_eval.matrix_world),
+                            self.get_object_vertices(ob, obj_eval)))))
                 else:
-                    scene_box_min = (min(scene_box_min[0], object_box_min[0]),
-                                     min(scene_box_min[1], object_box_min[1]),
-                                     min(scene_box_min[2], object_box_min[2]))
-                    scene_box_max = (max(scene_box_max[0], object_box_max[0]),
-                                     max(scene_box_max[1], object_box_max[1]),
-                                     max(scene_box_max[2], object_box_max[2]))
-                scene_box_empty = False
-
-        # calculate scene_box_center/size from scene_box_min/max/empty
-        if scene_box_empty:
-            scene_box_center = (0.0, 0.0, 0.0)
-            scene_box_size = (-1.0, -1.0, -1.0)
-        else:
-            scene_box_center = ((scene_box_min[0] + scene_box_max[0]) / 2.0,
-                                (scene_box_min[1] + scene_box_max[1]) / 2.0,
-                                (scene_box_min[2] + scene_box_max[2]) / 2.0)
-            scene_box_size = (scene_box_max[0] - scene_box_min[0],
-                              scene_box_max[1] - scene_box_min[1],
-                              scene_box_max[2] - scene_box_min[2])
-
-        return (scene_box_center, scene_box_size)
-
-    def fix_scene_before_x3d_export(self, context):
-        """Fix the Blender scene before exporting.
-
-        Blender 2.8 has a weird bug: running bpy.ops.export_scene.x3d
-        one after another (which is normal for this script), the export process
-        will think that some materials have already been written
-        (and will use <Material USE="XXX" /> instead of <Material DEF="XXX" diffuseColor="..." ... />).
-        This occurs only when mesh is obtained by to_mesh().
-        It seems that Blender cashes this mesh (even despite calling to_mesh_clear()
-        in export_x3d.py) and also materials (or at least tags?) are copied
-        (instead of being only references to same things as in bpy.data.materials).
-        In effect the material.tag values are retained across many
-        bpy.ops.export_scene.x3d calls, and even bpy.data.materials.tag(False)
-        doesn't help to reset them.
+                    box_objects.append(ob)
+            objects = box_objects
+
+        # Blender bound_box is 8 corners (in object space),
+        # all equal -1 when the box is empty, see
+        # https://www.blender.org/api/blender_python_api_current/bpy.types.Object.html#bpy.types.Object.bound_box
+        boxes_corners = [ob.bound_box for ob in objects]
+        boxes_matrices = [ob.matrix_world for ob in objects]
+
+        for (instance_object, instance_matrix) in self.get_exported_instances(depsgraph, exported_objects):
+            if instance_object.type not in box_types:
+                boxes_corners.append(numpy.array(instance_object.bound_box))
+                boxes_matrices.append(instance_matrix)
+
+        if boxes_corners:
+            corners = numpy.array(boxes_corners).reshape(-1, 8, 3)
+            not_empty = (corners != -1).any(axis=(1, 2))
+            if not_empty.any():
+                matrices = numpy.array(self.global_matrix) @ \
+                    numpy.array(boxes_matrices)[not_empty]
+                # transform corners of all objects to world space at once
+                corners = numpy.einsum('nij,nkj->nki', matrices[:, :3, :3], corners[not_empty]) + \
+                    matrices[:, numpy.newaxis, :3, 3]
+                points.append(corners.reshape(-1, 3))
+
+        points = numpy.concatenate(points)
+        if len(points) == 0:
+            return ((0.0, 0.0, 0.0), (-1.0, -1.0, -1.0))
+        scene_box_min = points.min(axis=0)
+        scene_box_max = points.max(axis=0)
+        return (tuple((scene_box_min + scene_box_max) / 2.0),
+                tuple(scene_box_max - scene_box_min))
+
+    def get_exported_instances(self, depsgraph, exported_objects):
+        """Instances (particles, instanced collections) of the exported objects.
+        Returns a list of pairs (evaluated instanced object, world matrix as NumPy array).
+
+        Instances are not scene objects (unless made real, then they are
+        among exported objects and this returns an empty list).
+        Their data is only valid during iteration, so the matrix is copied.
         """
-
-        depsgraph = context.evaluated_depsgraph_get()
-        for obj in bpy.data.objects:
-            uses_temporary_mesh = False
-            # The logic when to set uses_temporary_mesh follows X3D exporter
-            if obj.type in {'MESH', 'CURVE', 'SURFACE', 'FONT'}:
-                if (obj.type != 'MESH') or (self.use_mesh_modifiers and obj.is_modified(context.scene, 'PREVIEW')):
-                    uses_temporary_mesh = True
-            if uses_temporary_mesh:
-                obj_for_mesh = obj.evaluated_get(depsgraph) if self.use_mesh_modifiers else obj
-                mesh = obj_for_mesh.to_mesh()
-                for mat in mesh.materials:
-                    if mat.tag:
-                        print("Workarounding Blender 2.8 bug with materials tag not reset for %s" % mat.name)
-                        mat.tag = False
-                obj.to_mesh_clear()
-
-    def output_frame_x3d(self, context, output_file):
+        if self.make_duplicates_real:
+            return []
+        exported_names = {ob.name for ob in exported_objects}
+        return [(instance.object, numpy.array(instance.matrix_world))
+            for instance in depsgraph.object_instances
+            if instance.is_instance and instance.parent.original.name in exported_names]
+
+    def get_coord_decimals(self, bounding_box_size):
+        """Number of decimal digits of vertex coordinates in a frame
+        with given bounding box size (see relative_coord_precision)."""
+        size = max(bounding_box_size)
+        if self.relative_coord_precision > 0 and size > 0:
+            return min(8, max(0, math.ceil(-math.log10(size * self.relative_coord_precision))))
+        return self.coord_decimals
+
+    def output_frame_x3d(self, context, output_file, bounding_box_size):
         """Append a given frame to output_file in X3D format."""
 
-        # calculate filenames stuff
-        (output_dir, output_basename) = os.path.split(self.filepath)
-        temp_file_name = os.path.join(output_dir, os.path.splitext(output_basename)[0] + "_tmp.x3d")
-
-        self.fix_scene_before_x3d_export(context)
-
-        # write X3D with animation frame
-        bpy.ops.export_scene.x3d(filepath=temp_file_name,
-            check_existing = False,
-            use_compress = False, # never compress
+        export_x3d = import_x3d_exporter()
+        depsgraph = context.evaluated_depsgraph_get()
+        coord_decimals = self.get_coord_decimals(bounding_box_size)
+
+        def reuse_geometry(obj, name, calculate):
+            # coordinates precision may differ between frames
+            return self.change_tracker.get('x3d_%d_%s' % (coord_decimals, name),
+                obj, obj.evaluated_get(depsgraph), calculate, use_transform=False)
+
+        # write X3D with animation frame straight into output_file,
+        # without XML prolog and DOCTYPE (they are not allowed inside <frame>)
+        export_x3d.export(FrameSink(output_file, self.filepath),
+            self.global_matrix,
+            depsgraph,
+            context.scene,
+            context.view_layer,
             # pass through our properties to X3D exporter
             use_selection              = self.use_selection,
             use_mesh_modifiers         = self.use_mesh_modifiers,
@@ -322,33 +714,21 @@ class ExportCastleAnimFrames(bpy.types.Operator):
             use_normals                = self.use_normals,
             use_hierarchy              = self.use_hierarchy,
             name_decorations           = self.name_decorations,
-            use_h3d                    = self.use_h3d,
-            axis_forward               = self.axis_forward,
-            axis_up                    = self.axis_up,
-            path_mode                  = self.path_mode)
-
-        # read from temporary X3D file, and remove it
-        with open(temp_file_name, 'r') as temp_contents_file:
-            temp_contents = temp_contents_file.read()
-        os.remove(temp_file_name)
-
-        # add X3D content
-        temp_contents = temp_contents.replace('<?xml version="1.0" encoding="UTF-8"?>', '')
-        temp_contents = temp_contents.replace('<!DOCTYPE X3D PUBLIC "ISO//Web3D//DTD X3D 3.0//EN" "http://www.web3d.org/specifications/x3d-3.0.dtd">', '')
-        output_file.write(temp_contents)
-
-    def output_frame_gltf(self, context, output_file):
-        """Append a given frame to output_file in glTF format."""
-
-        # Note that using glb would be more efficient,
-        # but then textures are embedded too in every frame, which are not useful.
-
-        # calculate filenames stuff
-        (output_dir, output_basename) = os.path.split(self.filepath)
-        temp_file_name = os.path.join(output_dir, os.path.splitext(output_basename)[0] + "_tmp.gltf")
-
-        bpy.ops.export_scene.gltf(filepath=temp_file_name,
-            export_format = 'GLTF_EMBEDDED',
+            path_mode                  = self.path_mode,
+            use_xml_prolog             = False,
+            inline_meshes              = self.inline_meshes,
+            inline_meshes_written      = self.inline_meshes_written,
+            reuse_geometry             = reuse_geometry,
+            coord_decimals             = coord_decimals,
+            normal_decimals            = self.normal_decimals,
+            uv_decimals                = self.uv_decimals,
+            color_decimals             = self.color_decimals,
+            strip_zeros                = self.strip_zeros)
+
+    def export_gltf(self, filepath, **format_options):
+        """Export the current frame using glTF exporter to a given file."""
+
+        bpy.ops.export_scene.gltf(filepath=filepath,
             check_existing = False,
             export_lights = True,
             export_apply = self.use_mesh_modifiers,
@@ -368,19 +748,107 @@ class ExportCastleAnimFrames(bpy.types.Operator):
             export_morph = False,
             export_morph_normal = False,
             export_nla_strips = False,
-            export_force_sampling = False
+            export_force_sampling = False,
+            **format_options
             )
 
-        # read from temporary glTF file, and remove it
-        with open(temp_file_name, 'r') as temp_contents_file:
-            temp_contents = temp_contents_file.read()
-        os.remove(temp_file_name)
+    def output_frame_gltf(self, context, output_file):
+        """Append a given frame to output_file in glTF format."""
 
-        # add glTF content
+        # Note that using glb would be more efficient,
+        # but then textures are embedded too in every frame, which are not useful.
+
+        # calculate filenames stuff
+        (output_dir, output_basename) = os.path.split(self.filepath)
+        # (process id in the name, as worker processes may export glTF simultaneously)
+        temp_file_name = os.path.join(output_dir, "%s_tmp%d.gltf" % (os.path.splitext(output_basename)[0], os.getpid()))
+
+        self.export_gltf(temp_file_name, export_format = 'GLTF_EMBEDDED')
+        self.frame_timer.stage('export')
+
+        # add glTF content, copying it from temporary glTF file in chunks
+        # (escaping is per-character, so it can be done chunk by chunk),
+        # and remove the temporary file.
         # Note: using quote=False, because it is not necessary to escape " and ' here,
         # and it would cause a lot of replacements since they are used a lot in JSON.
-        temp_contents = html.escape(temp_contents, quote=False)
-        output_file.write(temp_contents)
+        with open(temp_file_name, 'r') as temp_contents_file:
+            while True:
+                chunk = temp_contents_file.read(GLTF_COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                output_file.write(html.escape(chunk, quote=False))
+        os.remove(temp_file_name)
+        self.frame_timer.stage('copy')
+
+    def get_frames_dir_name(self):
+        """Directory (relative to the castle-anim-frames file) with the files
+        of glTF (Separate Binary) frames."""
+        return os.path.splitext(os.path.basename(self.filepath))[0] + '_frames'
+
+    def output_frame_gltf_separate(self, context, output_file, frame):
+        """Append a given frame to output_file in glTF format,
+        with geometry in a separate binary file and textures in a shared directory."""
+
+        frames_dir_name = self.get_frames_dir_name()
+        frames_dir = os.path.join(os.path.dirname(self.filepath), frames_dir_name)
+        os.makedirs(frames_dir, exist_ok=True)
+
+        # the binary file gets the same name as glTF, with .bin extension
+        frame_name = re.sub(r'[^\w.-]', '_', '%s_%d' % (self.current_animation_name, frame))
+        gltf_file_name = os.path.join(frames_dir, frame_name + '.gltf')
+
+        self.export_gltf(gltf_file_name,
+            export_format = 'GLTF_SEPARATE',
+            export_texture_dir = 'textures')
+        self.frame_timer.stage('export')
+
+        with open(gltf_file_name, 'r', encoding='utf-8') as gltf_file:
+            gltf = json.load(gltf_file)
+        os.remove(gltf_file_name)
+
+        # make URIs relative to the castle-anim-frames file
+        uri_prefix = urllib.parse.quote(frames_dir_name) + '/'
+        for item in gltf.get('buffers', []) + gltf.get('images', []):
+            if 'uri' in item and not item['uri'].startswith('data:'):
+                item['uri'] = uri_prefix + item['uri']
+
+        # Without embedded data, the JSON is small and rarely needs escaping
+        # (only when names contain these characters).
+        # Note: " and ' don't need escaping here, like in output_frame_gltf.
+        content = json.dumps(gltf, separators=(',', ':'))
+        if '&' in content or '<' in content or '>' in content:
+            content = html.escape(content, quote=False)
+        output_file.write(content)
+        self.frame_timer.stage('copy')
+
+    def remove_unused_frames_files(self):
+        """Remove files in the directory of glTF (Separate Binary) frames
+        that are not referenced by the written castle-anim-frames file.
+        They are left by previous exports, e.g. with other frames or animations."""
+
+        frames_dir_name = self.get_frames_dir_name()
+        frames_dir = os.path.join(os.path.dirname(self.filepath), frames_dir_name)
+        if not os.path.isdir(frames_dir):
+            return
+
+        # Read the URIs back from the written file, as it is the only place
+        # that knows the frames of animations reused from cache
+        # and exported by worker processes.
+        if self.use_compress:
+            output_file = gzip.open(self.filepath, 'rt', encoding='utf-8')
+        else:
+            output_file = open(self.filepath, 'r', encoding='utf-8')
+        with output_file:
+            content = html.unescape(output_file.read())
+        uri_prefix = urllib.parse.quote(frames_dir_name) + '/'
+        used_files = {os.path.normpath(urllib.parse.unquote(uri[len(uri_prefix):]))
+            for uri in re.findall(r'"uri":"(%s[^"]*)"' % re.escape(uri_prefix), content)}
+
+        for (dir_path, dir_names, file_names) in os.walk(frames_dir):
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                if os.path.relpath(file_path, frames_dir) not in used_files:
+                    os.remove(file_path)
 
     def output_frame(self, context, output_file, frame, frame_start):
         """Output a given frame to a single file, and add <frame...> line to
@@ -394,17 +862,23 @@ class ExportCastleAnimFrames(bpy.types.Operator):
                          such that castle-anim-frames animation starts from time = 0.0.
         """
 
+        self.frame_timer = StageTimer()
+        output_file = CountingWriter(output_file)
+
         # set the animation frame (before calculating bounding box
         # and making duplicates real)
         context.scene.frame_set(frame)
+        self.frame_timer.stage('frame_set')
 
         if self.make_duplicates_real:
             self.make_duplicates_real_before(context)
+            self.frame_timer.stage('make_duplicates_real')
 
         # calculate bounding box in world space
         (bounding_box_center, bounding_box_size) = self.get_current_bounding_box(context)
+        self.frame_timer.stage('bounding_box')
 
-        if self.frame_format == 'GLTF':
+        if self.frame_format in {'GLTF', 'GLTF_SEPARATE'}:
             mime_type = 'model/gltf+json'
         else:
             mime_type = 'model/x3d+xml'
@@ -418,41 +892,235 @@ class ExportCastleAnimFrames(bpy.types.Operator):
 
         if self.frame_format == 'GLTF':
             self.output_frame_gltf(context, output_file)
+        elif self.frame_format == 'GLTF_SEPARATE':
+            self.output_frame_gltf_separate(context, output_file, frame)
         else:
-            self.output_frame_x3d(context, output_file)
+            self.output_frame_x3d(context, output_file, bounding_box_size)
+            self.frame_timer.stage('export')
 
         output_file.write('\n\t\t</frame>\n')
 
         if self.make_duplicates_real:
             self.make_duplicates_real_after(context)
+            self.frame_timer.stage('make_duplicates_real')
+
+        self.add_frame_statistics({
+            'animation': self.current_animation_name,
+            'frame': frame,
+            'size': output_file.size,
+            'total': self.frame_timer.total(),
+            'times': self.frame_timer.times,
+        })
+
+    def add_frame_statistics(self, frame_statistics):
+        """Record statistics of an exported frame: a dictionary with
+        animation name, frame number, size (characters written),
+        total time and times of stages (dictionary from FRAME_STAGES names
+        to seconds, only for the stages that happened)."""
+        self.frames_statistics.append(frame_statistics)
+        for listener in frame_statistics_listeners:
+            listener(frame_statistics)
+
+    def get_frame_points(self, context):
+        """World-space points describing the current state of exported objects.
+
+        Returns NumPy array Nx3, containing for each exported object
+        its transformation (see OBJECT_TRANSFORM_POINTS) and,
+        for objects with geometry, its (evaluated) vertices.
+        For each instance (particle, instanced collection) of exported objects,
+        it contains the instance transformation.
+        Comparing these points between frames tells how much the scene moved.
+        """
+
+        depsgraph = context.evaluated_depsgraph_get()
+        global_matrix = numpy.array(self.global_matrix)
+        points = []
+        exported_objects = self.get_exported_objects(context)
+        for obj in exported_objects:
+            obj_eval = obj.evaluated_get(depsgraph)
+            matrix = global_matrix @ numpy.array(obj_eval.matrix_world)
+            points.append(transform_points(matrix, OBJECT_TRANSFORM_POINTS))
+            if obj.type in {'MESH', 'CURVE', 'SURFACE', 'FONT'}:
+                points.append(self.change_tracker.get('frame_points', obj, obj_eval,
+                    lambda: transform_points(matrix, self.get_object_vertices(obj, obj_eval))))
+        for (instance_object, instance_matrix) in self.get_exported_instances(depsgraph, exported_objects):
+            points.append(transform_points(global_matrix @ instance_matrix, OBJECT_TRANSFORM_POINTS))
+        if len(points) == 0:
+            return numpy.zeros((0, 3))
+        return numpy.concatenate(points)
+
+    def get_adaptive_frames(self, context, frame_start, frame_end):
+        """Choose frames from frame_start..frame_end, such that all other
+        frames can be reconstructed by linear interpolation
+        with error at most sampling_tolerance.
+
+        Starts with only the first and last frame, and recursively adds
+        the worst reconstructed frame between two chosen frames,
+        until all frames are reconstructed well enough.
+        """
+
+        if frame_end <= frame_start:
+            return [frame_end]
+
+        frames = list(range(frame_start, frame_end + 1))
+        frames_points = []
+        for frame in frames:
+            context.scene.frame_set(frame)
+            frames_points.append(self.get_frame_points(context))
+
+        chosen = {0, len(frames) - 1}
+        segments = [(0, len(frames) - 1)]
+        while segments:
+            (start, end) = segments.pop()
+            worst_index = None
+            worst_error = self.sampling_tolerance
+            for i in range(start + 1, end):
+                error = interpolation_error(frames_points[start], frames_points[end],
+                    frames_points[i], (i - start) / (end - start))
+                if error > worst_error:
+                    worst_index = i
+                    worst_error = error
+            if worst_index is not None:
+                chosen.add(worst_index)
+                segments.append((start, worst_index))
+                segments.append((worst_index, end))
+
+        if self.verbose:
+            print("Adaptive sampling chose", len(chosen), "from", len(frames), "frames")
+        return [frames[i] for i in sorted(chosen)]
+
+    def get_object_vertices(self, obj, obj_eval):
+        """Evaluated vertex coordinates (NumPy array Nx3, in object space)
+        of an object with geometry. Reused while the object geometry does not change."""
+        obj_for_mesh = obj_eval if self.use_mesh_modifiers else obj
+        return self.change_tracker.get('vertices', obj, obj_eval,
+            lambda: get_evaluated_vertices(obj_for_mesh), use_transform=False)
+
+    def get_object_data_hash(self, obj, obj_eval):
+        """Hash (bytes) of the object data that is exported:
+        geometry (in object space), materials, light and camera settings.
+        Object transformation is not included.
+        """
+
+        hash = hashlib.sha1()
+        hash.update(self.change_tracker.get_geometry_hash(obj, obj_eval))
+        if obj.type in {'LIGHT', 'CAMERA'}:
+            hash_rna_values(hash, obj_eval.data)
+        hash_materials(hash, obj_eval)
+        return hash.digest()
+
+    def calculate_object_geometry_hash(self, obj, obj_eval):
+        """Hash (bytes) of the exported object geometry (in object space):
+        everything that the X3D exporter writes for the mesh,
+        except the materials.
+        Empty for objects without geometry.
+        Use change_tracker.get_geometry_hash to calculate it once per frame.
+        """
+
+        hash = hashlib.sha1()
+        if obj.type in {'MESH', 'CURVE', 'SURFACE', 'FONT'}:
+            obj_for_mesh = obj_eval if self.use_mesh_modifiers else obj
+            mesh = obj_for_mesh.to_mesh()
+            if mesh is not None:
+                hash.update(repr(len(mesh.materials)).encode('utf-8'))
+                hash_foreach(hash, mesh.vertices, 'co', numpy.float32, 3)
+                hash_foreach(hash, mesh.loops, 'vertex_index', numpy.int32)
+                hash_foreach(hash, mesh.polygons, 'loop_total', numpy.int32)
+                hash_foreach(hash, mesh.polygons, 'material_index', numpy.int32)
+                if mesh.uv_layers.active:
+                    hash_foreach(hash, mesh.uv_layers.active.data, 'uv', numpy.float32, 2)
+                if mesh.vertex_colors.active:
+                    hash_foreach(hash, mesh.vertex_colors.active.data, 'color', numpy.float32, 4)
+                obj_for_mesh.to_mesh_clear()
+        return hash.digest()
+
+    def get_frame_hash(self, context):
+        """Hash (bytes) of the current state of exported objects
+        and their instances (particles, instanced collections):
+        their transformations, geometry and materials.
+        Equal hashes mean that exported frames would be equal.
+        """
+
+        depsgraph = context.evaluated_depsgraph_get()
+        hash = hashlib.sha1()
+        exported_objects = self.get_exported_objects(context)
+        for obj in exported_objects:
+            obj_eval = obj.evaluated_get(depsgraph)
+            hash.update(obj.name.encode('utf-8'))
+            hash.update(numpy.array(obj_eval.matrix_world).tobytes())
+            hash.update(self.get_object_data_hash(obj, obj_eval))
+        for (instance_object, instance_matrix) in self.get_exported_instances(depsgraph, exported_objects):
+            hash.update(instance_object.original.name.encode('utf-8'))
+            hash.update(instance_matrix.tobytes())
+            hash.update(self.get_object_data_hash(instance_object.original, instance_object))
+        return hash.digest()
+
+    def remove_identical_frames(self, context, frames):
+        """Remove from the frames list the frames inside runs of identical frames
+        (keeping only the first and last frame of each run)."""
+
+        hashes = []
+        for frame in frames:
+            context.scene.frame_set(frame)
+            hashes.append(self.get_frame_hash(context))
+
+        result = [frame for i, frame in enumerate(frames)
+            if i == 0 or
+               i == len(frames) - 1 or
+               hashes[i - 1] != hashes[i] or
+               hashes[i] != hashes[i + 1]]
+        self.elided_frames += len(frames) - len(result)
+        return result
+
+    def get_animation_frames(self, context, frame_start, frame_end):
+        """Frames to export from frame_start..frame_end (inclusive), as a sorted list."""
+
+        if self.frame_sampling == 'ADAPTIVE':
+            frames = self.get_adaptive_frames(context, frame_start, frame_end)
+        else:
+            frames = list(range(frame_start, frame_end, 1 + self.frame_skip))
+            # the last frame should be always output, regardless if we would "hit"
+            # it with given frame_skip.
+            frames.append(frame_end)
+
+        if self.collapse_identical_frames:
+            frames = self.remove_identical_frames(context, frames)
+
+        self.exported_frames += len(frames)
+        return frames
+
+    def output_animation_begin(self, output_file, animation_name):
+        """Write the opening <animation> element in castle-anim-frames."""
+        if animation_name != '':
+            output_file.write('\t<animation name="' + animation_name + '">\n')
+        else:
+            output_file.write('\t<animation>\n')
 
     # Export a single animation (e.g. coming from a single action in Blender)
     # to an <animation> element in castle-anim-frames.
     #
     # animation_name must be a string.
     #
-    # frame_start, frame_end must be integer.
-    def output_one_animation(self, context, output_file, animation_name, frame_start, frame_end):
-        if animation_name != '':
-            output_file.write('\t<animation name="' + animation_name + '">\n')
-        else:
-            output_file.write('\t<animation>\n')
+    # frame_start must be integer, frames must be a list of integers
+    # (usually from get_animation_frames).
+    def output_one_animation(self, context, output_file, animation_name, frame_start, frames):
+        self.output_animation_begin(output_file, animation_name)
+        self.current_animation_name = animation_name
 
-        frame = frame_start
-        while frame < frame_end:
+        for frame in frames:
             self.output_frame(context, output_file, frame, frame_start)
-            frame += 1 + self.frame_skip
-        # the last frame should be always output, regardless if we would "hit"
-        # it with given frame_skip.
-        self.output_frame(context, output_file, frame_end, frame_start)
 
         output_file.write('\t</animation>\n')
 
 
-    def execute(self, context):
-        output_file = open(self.filepath, 'w')
-        output_file.write('<?xml version="1.0"?>\n')
-        output_file.write('<animations>\n')
+    def get_animations(self, context):
+        """Animations to export, as a list of
+        (animation name, action, frame start, frame end).
+
+        The action is None when exporting the scene animation from Start to End
+        (when actions_object is not set).
+        Frame start and end are integers.
+        """
 
         if self.actions_object != '':
             actions_object_o = context.scene.objects[self.actions_object]
@@ -471,40 +1139,688 @@ class ExportCastleAnimFrames(bpy.types.Operator):
                 if actions_object_o.user_of_id(action) or action.use_fake_user:
                     actions_to_export.append(action)
 
-            if len(actions_to_export) > 0:
-                original_action = actions_object_o.animation_data.action
-                try:
-                    for action in actions_to_export:
-                        act_start, act_end = action.frame_range
-                        act_start = int(act_start)
-                        act_end = int(act_end)
-                        actions_object_o.animation_data.action = action
-                        print("Exporting action", action.name, "with frames" , act_start, "-", act_end)
-                        self.output_one_animation(context, output_file, action.name, act_start, act_end)
-                finally:
-                    # without restoring this, the action selected previously
-                    # would be lost, with 0 users
-                    actions_object_o.animation_data.action = original_action
-            else:
+            if len(actions_to_export) == 0:
                 raise Exception('No action found on object "' + self.actions_object + '"')
+
+            animations = []
+            for action in actions_to_export:
+                act_start, act_end = action.frame_range
+                animations.append((action.name, action, int(act_start), int(act_end)))
+            return animations
         else:
             # if no actions to use, then export whole context.scene.frame_start..end
-            print("Exporting animation with frames" , context.scene.frame_start, "-", context.scene.frame_end)
-            self.output_one_animation(context, output_file, "animation", context.scene.frame_start, context.scene.frame_end)
+            return [("animation", None, context.scene.frame_start, context.scene.frame_end)]
+
+    def set_animation_action(self, context, action):
+        """Make the action current, for action from get_animations."""
+        if action is not None:
+            context.scene.objects[self.actions_object].animation_data.action = action
+            self.change_tracker.invalidate()
+
+    def get_objects_data_hashes(self, context, animations_frames):
+        """Check which objects have geometry that is the same in all exported frames.
+
+        Returns a dictionary mapping names of objects with geometry
+        to their data hash (see get_object_data_hash),
+        or None if their data changes.
+        """
+
+        data_hashes = {}
+        for (animation_name, action, frame_start, frames) in animations_frames:
+            self.set_animation_action(context, action)
+            for frame in frames:
+                context.scene.frame_set(frame)
+                depsgraph = context.evaluated_depsgraph_get()
+                for obj in self.get_exported_objects(context):
+                    if obj.type in {'MESH', 'CURVE', 'SURFACE', 'FONT'} and \
+                       data_hashes.get(obj.name, b'') is not None:
+                        data_hash = self.get_object_data_hash(obj, obj.evaluated_get(depsgraph))
+                        if obj.name not in data_hashes:
+                            data_hashes[obj.name] = data_hash
+                        elif data_hashes[obj.name] != data_hash:
+                            data_hashes[obj.name] = None
+        return data_hashes
+
+    def get_inline_meshes(self, data_hashes):
+        """Find objects with geometry that is the same in all exported frames,
+        according to data_hashes (see get_objects_data_hashes).
+
+        Returns a dictionary mapping their names to the URLs of separate X3D
+        files (next to the castle-anim-frames file) where their geometry
+        will be written, suitable for X3D exporter inline_meshes.
+        """
+
+        (output_dir, output_basename) = os.path.split(self.filepath)
+        output_basename = os.path.splitext(output_basename)[0]
+        inline_meshes = {}
+        used_urls = set()
+        for obj_name in sorted(data_hashes):
+            if data_hashes[obj_name] is not None:
+                url_base = output_basename + '_static_' + re.sub(r'[^\w.-]', '_', obj_name)
+                url = url_base + '.x3d'
+                count = 0
+                while url in used_urls:
+                    count += 1
+                    url = '%s_%d.x3d' % (url_base, count)
+                used_urls.add(url)
+                inline_meshes[obj_name] = url
+        return inline_meshes
+
+    def get_deformation_sample(self, obj_eval, obj_for_mesh):
+        """Sample the mesh of a deforming object.
+
+        Returns (topology hash, vertex coordinates, vertex normals),
+        with coordinates and normals as NumPy arrays Nx3 (in object space).
+        Topology hash covers everything except vertex coordinates and normals:
+        vertex count, faces, materials (with their values)
+        and texture coordinates.
+        """
+
+        topology_hash = hashlib.sha1()
+        hash_materials(topology_hash, obj_eval)
+        mesh = obj_for_mesh.to_mesh()
+        if mesh is None:
+            return (topology_hash.digest(), numpy.zeros((0, 3)), numpy.zeros((0, 3)))
+        topology_hash.update(repr(len(mesh.vertices)).encode('utf-8'))
+        hash_foreach(topology_hash, mesh.loops, 'vertex_index', numpy.int32)
+        hash_foreach(topology_hash, mesh.polygons, 'loop_total', numpy.int32)
+        hash_foreach(topology_hash, mesh.polygons, 'material_index', numpy.int32)
+        if mesh.uv_layers.active:
+            hash_foreach(topology_hash, mesh.uv_layers.active.data, 'uv', numpy.float32, 2)
+        coords = numpy.empty(len(mesh.vertices) * 3, dtype=numpy.float32)
+        mesh.vertices.foreach_get('co', coords)
+        normals = numpy.empty(len(mesh.vertices) * 3, dtype=numpy.float32)
+        mesh.vertices.foreach_get('normal', normals)
+        obj_for_mesh.to_mesh_clear()
+        return (topology_hash.digest(), coords.reshape(-1, 3), normals.reshape(-1, 3))
+
+    def write_interpolator(self, fw, ident, export_x3d, time_sensor_id, interpolator_name,
+                           interpolator_type, keys, key_value, target_id, target_field):
+        """Write X3D interpolator with routes from TimeSensor and to the target."""
+        interpolator_id = quoteattr(export_x3d.clean_def(interpolator_name))
+        fw('%s<%s DEF=%s key="%s" keyValue="%s" />\n' % (ident, interpolator_type, interpolator_id, keys, key_value))
+        fw('%s<ROUTE fromNode=%s fromField="fraction_changed" toNode=%s toField="set_fraction" />\n' % (ident, time_sensor_id, interpolator_id))
+        fw('%s<ROUTE fromNode=%s fromField="value_changed" toNode=%s toField="%s" />\n' % (ident, interpolator_id, target_id, target_field))
+
+    def write_interpolators(self, fw, ident, export_x3d, animation, object_transform_ids, object_coordinate_ids):
+        """Write X3D TimeSensor, interpolators and routes for one animation.
+
+        animation is a tuple (animation name, frame start, frames,
+        transforms, coordinates, normals), where transforms maps object names
+        to lists of Transform fields (see export_x3d.transform_fields) in each frame,
+        and coordinates, normals map names of deforming objects to lists
+        of vertex coordinates / normals (NumPy arrays) in each frame.
+        """
+
+        (animation_name, frame_start, frames, transforms, coordinates, normals) = animation
+
+        duration = max(frames[-1] - frame_start, 1) / 25.0
+        keys = ' '.join('%f' % ((frame - frame_start) / 25.0 / duration) for frame in frames)
+
+        time_sensor_id = quoteattr(export_x3d.clean_def(animation_name))
+        fw('%s<TimeSensor DEF=%s cycleInterval="%f" />\n' % (ident, time_sensor_id, duration))
+
+        format_coord = export_x3d.float_formatter(self.coord_decimals, self.strip_zeros)
+        format_normal = export_x3d.float_formatter(self.normal_decimals, self.strip_zeros)
+        format_rotation = export_x3d.float_formatter(6, self.strip_zeros)
+
+        for obj_name in sorted(transforms):
+            transform_id = object_transform_ids.get(obj_name)
+            if transform_id is None:
+                continue
+            obj_fields = transforms[obj_name]
+            for (field_index, field_name, interpolator_type, format_value) in (
+                    (0, 'translation', 'PositionInterpolator', format_coord),
+                    (1, 'rotation', 'OrientationInterpolator', format_rotation),
+                    (2, 'scale', 'PositionInterpolator', format_rotation)):
+                values = [fields[field_index] for fields in obj_fields]
+                # no need for interpolator if the value is constant
+                if all(value == values[0] for value in values):
+                    continue
+                key_value = ', '.join(format_value(value).rstrip() for value in values)
+                self.write_interpolator(fw, ident, export_x3d, time_sensor_id,
+                    animation_name + '_' + obj_name + '_' + field_name,
+                    interpolator_type, keys, key_value, transform_id, field_name)
+
+        for obj_name in sorted(coordinates):
+            if obj_name not in object_coordinate_ids:
+                continue
+            (coordinate_id, normal_id) = object_coordinate_ids[obj_name]
+            for (field_values, node_id, field_name, interpolator_type, format_value) in (
+                    (coordinates[obj_name], coordinate_id, 'point', 'CoordinateInterpolator', format_coord),
+                    (normals[obj_name], normal_id, 'vector', 'NormalInterpolator', format_normal)):
+                if node_id is None:
+                    continue
+                # no need for interpolator if the value is constant
+                if all(numpy.array_equal(values, field_values[0]) for values in field_values):
+                    continue
+                key_value = ', '.join(format_value(values.ravel().tolist()).rstrip() for values in field_values)
+                self.write_interpolator(fw, ident, export_x3d, time_sensor_id,
+                    animation_name + '_' + obj_name + '_' + field_name,
+                    interpolator_type, keys, key_value, node_id, field_name)
+
+    def output_interpolators(self, context, animations_frames):
+        """Write the animations as a single X3D file, animated by X3D interpolators
+        (for frame_format X3D_INTERPOLATORS).
+
+        Object transformations are animated by Position/OrientationInterpolator,
+        deforming meshes (with constant topology) by Coordinate/NormalInterpolator.
+        Returns False (without writing anything) if this is not possible,
+        because the topology or materials of some mesh change,
+        or the data of some light or camera changes.
+        """
+
+        export_x3d = import_x3d_exporter()
+
+        deforming_objects = {obj_name
+            for (obj_name, data_hash) in self.get_objects_data_hashes(context, animations_frames).items()
+            if data_hash is None}
+        if deforming_objects and self.use_triangulate:
+            print("Deforming meshes cannot be exported using X3D interpolators with \"Triangulate\"")
+            return False
+
+        # determine exported parent of each object, just like X3D exporter
+        objects = self.get_exported_objects(context)
+        objects_parents = {}
+        def add_parents(obj_parent, objects_hierarchy):
+            for (obj, obj_children) in objects_hierarchy:
+                objects_parents[obj.name] = obj_parent
+                add_parents(obj, obj_children)
+        add_parents(None, export_x3d.build_hierarchy(objects))
+
+        # calculate object transformations and deformations in all frames
+        animations = []
+        topology_hashes = {}
+        data_hashes = {}
+        for (animation_name, action, frame_start, frames) in animations_frames:
+            self.set_animation_action(context, action)
+            print("Exporting animation", animation_name, "with frames" , frame_start, "-", frames[-1])
+            transforms = {obj.name: [] for obj in objects}
+            coordinates = {obj.name: [] for obj in objects if obj.name in deforming_objects}
+            normals = {obj.name: [] for obj in objects if obj.name in deforming_objects}
+            for frame in frames:
+                context.scene.frame_set(frame)
+                depsgraph = context.evaluated_depsgraph_get()
+                for obj in objects:
+                    matrix = export_x3d.object_transform_matrix(obj, objects_parents[obj.name], self.global_matrix)
+                    transforms[obj.name].append(export_x3d.transform_fields(matrix))
+                    if obj.name in deforming_objects:
+                        obj_eval = obj.evaluated_get(depsgraph)
+                        obj_for_mesh = obj_eval if self.use_mesh_modifiers else obj
+                        (topology_hash, obj_coordinates, obj_normals) = self.get_deformation_sample(obj_eval, obj_for_mesh)
+                        if topology_hashes.setdefault(obj.name, topology_hash) != topology_hash:
+                            print("Topology or materials of", obj.name, "change during the animation, it cannot be exported using X3D interpolators")
+                            return False
+                        coordinates[obj.name].append(obj_coordinates)
+                        normals[obj.name].append(obj_normals)
+                    elif obj.type in {'LIGHT', 'CAMERA'}:
+                        data_hash = self.get_object_data_hash(obj, obj.evaluated_get(depsgraph))
+                        if data_hashes.setdefault(obj.name, data_hash) != data_hash:
+                            print("Light or camera", obj.name, "changes during the animation, it cannot be exported using X3D interpolators")
+                            return False
+            animations.append((animation_name, frame_start, frames, transforms, coordinates, normals))
+
+        # export the scene once, in the pose at the beginning of the first animation
+        (animation_name, action, frame_start, frames) = animations_frames[0]
+        self.set_animation_action(context, action)
+        context.scene.frame_set(frames[0])
+
+        object_transform_ids = {}
+        object_coordinate_ids = {}
+        def write_scene_extra(fw, ident):
+            for animation in animations:
+                self.write_interpolators(fw, ident, export_x3d, animation,
+                    object_transform_ids, object_coordinate_ids)
+
+        output_file = open(os.path.splitext(self.filepath)[0] + '.x3d', 'w', encoding='utf-8')
+        export_x3d.export(output_file,
+            self.global_matrix,
+            context.evaluated_depsgraph_get(),
+            context.scene,
+            context.view_layer,
+            use_selection              = self.use_selection,
+            use_mesh_modifiers         = self.use_mesh_modifiers,
+            use_triangulate            = self.use_triangulate,
+            use_normals                = self.use_normals,
+            use_hierarchy              = True,
+            name_decorations           = self.name_decorations,
+            path_mode                  = self.path_mode,
+            object_transform_ids       = object_transform_ids,
+            object_coordinate_ids      = object_coordinate_ids,
+            write_scene_extra          = write_scene_extra,
+            coord_decimals             = self.coord_decimals,
+            normal_decimals            = self.normal_decimals,
+            uv_decimals                = self.uv_decimals,
+            color_decimals             = self.color_decimals,
+            strip_zeros                = self.strip_zeros)
+        output_file.close()
+        return True
+
+    def get_settings(self):
+        """Values of all operator properties, as a dictionary
+        (saved in JSON to pass them to the worker processes)."""
+        return {prop.identifier: getattr(self, prop.identifier)
+            for prop in self.properties.bl_rna.properties
+            if prop.identifier != 'rna_type'}
+
+    def split_worker_jobs(self, animations_frames, temp_dir):
+        """Split the frames of all animations into contiguous chunks,
+        one for each worker process.
+
+        Returns a list of worker jobs, each job is a list of segments,
+        each segment is a dictionary describing frames of one animation
+        and the part file (in temp_dir) where the worker writes them.
+        """
+
+        all_frames = [(animation_index, frame)
+            for (animation_index, (animation_name, action, frame_start, frames)) in enumerate(animations_frames)
+            for frame in frames]
+        workers_count = min(self.worker_processes, len(all_frames))
+        chunk_size = -(-len(all_frames) // workers_count)
+
+        jobs = []
+        for worker_index in range(workers_count):
+            segments = []
+            for (animation_index, frame) in all_frames[worker_index * chunk_size:(worker_index + 1) * chunk_size]:
+                if not segments or segments[-1]['animation'] != animation_index:
+                    (animation_name, action, frame_start, frames) = animations_frames[animation_index]
+                    segments.append({
+                        'animation': animation_index,
+                        'animation_name': animation_name,
+                        'action': action.name if action is not None else None,
+                        'frame_start': frame_start,
+                        'frames': [],
+                        'output': os.path.join(temp_dir, 'part_%d_%d.xml' % (worker_index, len(segments))),
+                    })
+                segments[-1]['frames'].append(frame)
+            jobs.append(segments)
+        return jobs
+
+    def output_animations_parallel(self, context, output_files, animations_frames):
+        """Write the animations (each to the corresponding file in output_files),
+        exporting the frames in worker_processes background Blender processes.
+
+        Each worker opens a copy of the current blend file,
+        writes <frame> elements of its chunk of frames to part files,
+        and then we merge the part files in frame order.
+        """
+
+        temp_dir = tempfile.mkdtemp(prefix='castle_anim_frames_')
+        try:
+            # Save a copy, to let workers see also the unsaved changes.
+            # Paths are remapped, so relative texture paths still work.
+            blend_file = os.path.join(temp_dir, 'scene.blend')
+            bpy.ops.wm.save_as_mainfile(filepath=blend_file, copy=True)
+
+            settings = self.get_settings()
+            settings['worker_processes'] = 0
+
+            jobs = self.split_worker_jobs(animations_frames, temp_dir)
+            processes = []
+            for (worker_index, segments) in enumerate(jobs):
+                job_file = os.path.join(temp_dir, 'job_%d.json' % worker_index)
+                with open(job_file, 'w', encoding='utf-8') as f:
+                    json.dump({
+                        'settings': settings,
+                        'inline_meshes': self.inline_meshes,
+                        'segments': segments,
+                        'statistics': os.path.join(temp_dir, 'statistics_%d.json' % worker_index),
+                    }, f)
+                processes.append(subprocess.Popen([bpy.app.binary_path,
+                    '--background', blend_file,
+                    # without --python-exit-code, Blender exits with 0 even when script fails
+                    '--python-exit-code', '1',
+                    '--python', os.path.abspath(__file__),
+                    '--', '--worker-job', job_file]))
+            print("Exporting", sum(len(segment['frames']) for segments in jobs for segment in segments),
+                "frames using", len(processes), "worker processes")
+
+            try:
+                # poll all workers, to fail as soon as any of them fails
+                running = list(enumerate(processes))
+                while running:
+                    for (worker_index, process) in list(running):
+                        if process.poll() is None:
+                            continue
+                        if process.returncode != 0:
+                            raise Exception('Worker process %d (exporting frames %d-%d) failed with exit code %d, see console for details' %
+                                (worker_index, jobs[worker_index][0]['frames'][0], jobs[worker_index][-1]['frames'][-1], process.returncode))
+                        running.remove((worker_index, process))
+                    if running:
+                        time.sleep(0.1)
+            finally:
+                for process in processes:
+                    if process.poll() is None:
+                        process.kill()
+                        process.wait()
+
+            for worker_index in range(len(jobs)):
+                with open(os.path.join(temp_dir, 'statistics_%d.json' % worker_index), 'r', encoding='utf-8') as f:
+                    for frame_statistics in json.load(f):
+                        self.add_frame_statistics(frame_statistics)
+
+            # merge part files, in the order of animations and frames
+            for (animation_index, (animation_name, action, frame_start, frames)) in enumerate(animations_frames):
+                output_file = output_files[animation_index]
+                self.output_animation_begin(output_file, animation_name)
+                for segments in jobs:
+                    for segment in segments:
+                        if segment['animation'] == animation_index:
+                            with open(segment['output'], 'r', encoding='utf-8') as part_file:
+                                shutil.copyfileobj(part_file, output_file)
+                output_file.write('\t</animation>\n')
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def execute_worker(self, context):
+        """Export a chunk of frames in a worker process,
+        see output_animations_parallel."""
+
+        with open(self.worker_job, 'r', encoding='utf-8') as f:
+            job = json.load(f)
+        for (name, value) in job['settings'].items():
+            if name != 'worker_job':
+                setattr(self, name, value)
+
+        if bpy.ops.object.mode_set.poll():
+            bpy.ops.object.mode_set(mode='OBJECT')
+
+        self.global_matrix = axis_conversion(to_forward=self.axis_forward, to_up=self.axis_up).to_4x4()
+        self.inline_meshes = job['inline_meshes']
+        self.inline_meshes_written = set()
+        self.frames_statistics = []
+
+        self.change_tracker = ObjectChangeTracker(self.use_change_tracking, self.calculate_object_geometry_hash)
+        self.change_tracker.start()
+        try:
+            for segment in job['segments']:
+                if segment['action'] is not None:
+                    self.set_animation_action(context, bpy.data.actions[segment['action']])
+                self.current_animation_name = segment['animation_name']
+                print("Worker exporting frames", segment['frames'][0], "-", segment['frames'][-1])
+                with open(segment['output'], 'w', encoding='utf-8') as output_file:
+                    for frame in segment['frames']:
+                        self.output_frame(context, output_file, frame, segment['frame_start'])
+        finally:
+            self.change_tracker.stop()
+
+        with open(job['statistics'], 'w', encoding='utf-8') as f:
+            json.dump(self.frames_statistics, f)
+
+        return {'FINISHED'}
+
+    def output_animations(self, context, output_files, animations_frames):
+        """Write the animations, each to the corresponding file in output_files
+        (these may be all the same file)."""
+
+        if self.worker_processes > 0:
+            self.output_animations_parallel(context, output_files, animations_frames)
+        else:
+            for (output_file, (animation_name, action, frame_start, frames)) in zip(output_files, animations_frames):
+                self.set_animation_action(context, action)
+                print("Exporting animation", animation_name, "with frames" , frame_start, "-", frames[-1])
+                self.output_one_animation(context, output_file, animation_name, frame_start, frames)
+
+    def get_animation_cache_key(self, context, animation_name, action, frame_start, frame_end):
+        """Hash (hex string) of everything that determines the exported <animation>:
+        export settings, animation frame range, animation curves (of the action,
+        and of all exported objects), modifiers and constraints,
+        and the evaluated scene (transformations, geometry, materials) at the first frame.
+
+        The exported frames (see get_animation_frames) are determined by these,
+        so they don't need to be chosen (which may evaluate all frames)
+        to reuse the animation from cache.
+        """
+
+        hash = hashlib.sha1()
+        settings = {name: value for (name, value) in self.get_settings().items()
+            if name not in ANIMATIONS_CACHE_IGNORED_SETTINGS}
+        hash.update(repr((ANIMATIONS_CACHE_VERSION, sorted(settings.items()))).encode('utf-8'))
+        hash.update(repr((animation_name, frame_start, frame_end)).encode('utf-8'))
+
+        self.set_animation_action(context, action)
+        for obj in self.get_exported_objects(context):
+            hash.update(obj.name.encode('utf-8'))
+            for animated_id in (obj, obj.data, getattr(obj.data, 'shape_keys', None)):
+                animation_data = getattr(animated_id, 'animation_data', None)
+                if animation_data:
+                    if animation_data.action:
+                        hash.update(animation_data.action.name.encode('utf-8'))
+                        hash_fcurves(hash, animation_data.action.fcurves)
+                    hash_fcurves(hash, animation_data.drivers)
+            for modifier in obj.modifiers:
+                hash_rna_values(hash, modifier)
+            for constraint in obj.constraints:
+                hash_rna_values(hash, constraint)
+
+        context.scene.frame_set(frame_start)
+        hash.update(self.get_frame_hash(context))
+        return hash.hexdigest()
+
+    def get_animations_cache_dir(self):
+        return self.filepath + '.cache'
+
+    def get_animation_cache_filename(self, cache_key):
+        """File in the cache directory with the <animation> element."""
+        return os.path.join(self.get_animations_cache_dir(), cache_key + '.xml')
+
+    def load_animations_cache(self):
+        """Load the index of the cache of exported animations, as a dictionary
+        mapping get_animation_cache_key results to information about the cached animation
+        (dictionary with "data_hashes" and "inline_meshes" used when it was exported).
+        Only animations with existing cache files are returned.
+        Returns empty dictionary if the cache doesn't exist or is invalid."""
+        try:
+            with open(os.path.join(self.get_animations_cache_dir(), 'index.json'), 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(cache, dict) or cache.get('version') != ANIMATIONS_CACHE_VERSION:
+            return {}
+        return {key: animation for (key, animation) in cache['animations'].items()
+            if os.path.exists(self.get_animation_cache_filename(key))}
+
+    def save_animations_cache(self, animations):
+        """Save the index of the cache (see load_animations_cache),
+        removing cache files of animations not in it."""
+        cache_dir = self.get_animations_cache_dir()
+        with open(os.path.join(cache_dir, 'index.json'), 'w', encoding='utf-8') as f:
+            json.dump({'version': ANIMATIONS_CACHE_VERSION, 'animations': animations}, f)
+        for file_name in os.listdir(cache_dir):
+            if file_name.endswith('.xml') and file_name[:-len('.xml')] not in animations:
+                os.remove(os.path.join(cache_dir, file_name))
+
+    def choose_animations_frames(self, context, animations, animations_frames, indexes):
+        """Choose the frames (see get_animation_frames) of animations with given indexes,
+        unless already chosen. animations_frames are updated,
+        with (animation_name, action, frame_start, frames) for each chosen animation."""
+        for i in indexes:
+            if animations_frames[i] is None:
+                (animation_name, action, frame_start, frame_end) = animations[i]
+                self.set_animation_action(context, action)
+                frames = self.get_animation_frames(context, frame_start, frame_end)
+                animations_frames[i] = (animation_name, action, frame_start, frames)
+
+    def output_castle_anim_frames(self, context, animations, animations_frames=None):
+        """Write the animations to castle-anim-frames file.
+
+        animations are (animation_name, action, frame_start, frame_end),
+        see get_animations. animations_frames may contain their frames
+        if they are already chosen, otherwise the frames are chosen here
+        (only for the animations that are not reused from cache).
+        """
+
+        if animations_frames is None:
+            animations_frames = [None] * len(animations)
+        else:
+            animations_frames = list(animations_frames)
+
+        if self.use_animations_cache:
+            cache = self.load_animations_cache()
+            cache_keys = [self.get_animation_cache_key(context, *animation) for animation in animations]
+            exported_indexes = [i for (i, key) in enumerate(cache_keys) if key not in cache]
+        else:
+            exported_indexes = list(range(len(animations)))
+        self.choose_animations_frames(context, animations, animations_frames, exported_indexes)
+
+        # data hashes of each animation (see get_objects_data_hashes),
+        # to find static objects and to remember them in cache
+        animations_data_hashes = [None] * len(animations)
+        if self.share_static_geometry and self.frame_format == 'X3D':
+            for i in range(len(animations)):
+                if i in exported_indexes:
+                    animations_data_hashes[i] = {obj_name: (data_hash.hex() if data_hash is not None else None)
+                        for (obj_name, data_hash) in self.get_objects_data_hashes(context, [animations_frames[i]]).items()}
+                else:
+                    animations_data_hashes[i] = cache[cache_keys[i]]['data_hashes']
+            self.inline_meshes = self.get_inline_meshes(merge_data_hashes(animations_data_hashes))
+            if self.use_animations_cache:
+                # animations cached with different static objects must be exported again
+                outdated_indexes = [i for (i, key) in enumerate(cache_keys)
+                    if i not in exported_indexes and cache[key]['inline_meshes'] != self.inline_meshes]
+                self.choose_animations_frames(context, animations, animations_frames, outdated_indexes)
+                exported_indexes = sorted(exported_indexes + outdated_indexes)
+
+        if self.use_animations_cache:
+            # export the animations not in cache, each straight to its cache file
+            os.makedirs(self.get_animations_cache_dir(), exist_ok=True)
+            exported_files = [open(self.get_animation_cache_filename(cache_keys[i]), 'w', encoding='utf-8')
+                for i in exported_indexes]
+            try:
+                self.output_animations(context, exported_files,
+                    [animations_frames[i] for i in exported_indexes])
+            finally:
+                for exported_file in exported_files:
+                    exported_file.close()
+            self.reused_animations = len(animations) - len(exported_indexes)
+
+        if self.use_compress:
+            output_file = gzip.open(self.filepath, 'wt', compresslevel=self.compress_level, encoding='utf-8')
+        else:
+            output_file = open(self.filepath, 'w', encoding='utf-8')
+        output_file.write('<?xml version="1.0"?>\n')
+        output_file.write('<animations>\n')
+
+        if self.use_animations_cache:
+            for (i, key) in enumerate(cache_keys):
+                if i not in exported_indexes:
+                    print("Reusing animation", animations[i][0], "from cache")
+                with open(self.get_animation_cache_filename(key), 'r', encoding='utf-8') as cache_file:
+                    shutil.copyfileobj(cache_file, output_file)
+        else:
+            self.output_animations(context, [output_file] * len(animations), animations_frames)
 
         output_file.write('</animations>\n')
         output_file.close()
 
+        if self.frame_format == 'GLTF_SEPARATE':
+            self.remove_unused_frames_files()
+
+        if self.use_animations_cache:
+            self.save_animations_cache({key: {
+                    'data_hashes': animations_data_hashes[i],
+                    'inline_meshes': self.inline_meshes,
+                } for (i, key) in enumerate(cache_keys)})
+
+    def execute(self, context):
+        if self.worker_job:
+            return self.execute_worker(context)
+
+        if bpy.ops.object.mode_set.poll():
+            bpy.ops.object.mode_set(mode='OBJECT')
+
+        self.global_matrix = axis_conversion(to_forward=self.axis_forward, to_up=self.axis_up).to_4x4()
+
+        # statistics
+        self.exported_frames = 0
+        self.elided_frames = 0
+        self.reused_animations = 0
+        self.frames_statistics = []
+        start_time = time.perf_counter()
+
+        animations = self.get_animations(context)
+
+        self.change_tracker = ObjectChangeTracker(self.use_change_tracking, self.calculate_object_geometry_hash)
+        self.change_tracker.start()
+        if self.actions_object != '':
+            actions_object_o = context.scene.objects[self.actions_object]
+            original_action = actions_object_o.animation_data.action
+        try:
+            self.inline_meshes = None
+            self.inline_meshes_written = set()
+
+            if self.frame_format == 'X3D_INTERPOLATORS':
+                # first choose the frames of all animations,
+                # then write them
+                animations_frames = [None] * len(animations)
+                self.choose_animations_frames(context, animations, animations_frames, range(len(animations)))
+                if not self.output_interpolators(context, animations_frames):
+                    self.report({'WARNING'}, "Cannot export using X3D interpolators (see console for details), exporting castle-anim-frames with X3D frames instead.")
+                    self.output_castle_anim_frames(context, animations, animations_frames)
+            else:
+                self.output_castle_anim_frames(context, animations)
+        finally:
+            self.change_tracker.stop()
+            if self.actions_object != '':
+                # without restoring this, the action selected previously
+                # would be lost, with 0 users
+                actions_object_o.animation_data.action = original_action
+
+        if self.verbose:
+            self.print_statistics()
+
+        if self.timing_report != 'NONE' and self.frames_statistics:
+            self.write_timing_report()
+        if (self.verbose or self.timing_report != 'NONE') and self.frames_statistics:
+            self.report({'INFO'}, self.get_timing_summary(time.perf_counter() - start_time))
+
         return {'FINISHED'}
 
+    def write_timing_report(self):
+        """Write frames_statistics to a JSON or CSV file next to the output."""
+        if self.timing_report == 'JSON':
+            with open(self.filepath + '.timing.json', 'w', encoding='utf-8') as f:
+                json.dump(self.frames_statistics, f, indent=1)
+        else:
+            with open(self.filepath + '.timing.csv', 'w', encoding='utf-8', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(('animation', 'frame', 'size', 'total') + FRAME_STAGES)
+                for frame_statistics in self.frames_statistics:
+                    writer.writerow(
+                        [frame_statistics['animation'], frame_statistics['frame'],
+                         frame_statistics['size'], '%f' % frame_statistics['total']] +
+                        ['%f' % frame_statistics['times'].get(stage, 0.0) for stage in FRAME_STAGES])
+
+    def get_timing_summary(self, export_time):
+        """Summary of frames_statistics: total time of each stage and the slowest frames."""
+        stages_times = {}
+        for frame_statistics in self.frames_statistics:
+            for (stage, stage_time) in frame_statistics['times'].items():
+                stages_times[stage] = stages_times.get(stage, 0.0) + stage_time
+        slowest = sorted(self.frames_statistics, key=lambda frame_statistics: frame_statistics['total'], reverse=True)[:3]
+        return 'Exported %d frames (%d bytes) in %.2f s. Stages: %s. Slowest frames: %s.' % (
+            len(self.frames_statistics),
+            sum(frame_statistics['size'] for frame_statistics in self.frames_statistics),
+            export_time,
+            ', '.join('%s %.2f s' % (stage, stages_times[stage]) for stage in FRAME_STAGES if stage in stages_times),
+            ', '.join('%s %d (%.2f s)' % (frame_statistics['animation'], frame_statistics['frame'], frame_statistics['total']) for frame_statistics in slowest))
+
+    def print_statistics(self):
+        print("Exported frames:", self.exported_frames)
+        if self.collapse_identical_frames:
+            print("Frames elided, because identical to neighbours:", self.elided_frames)
+        if self.inline_meshes is not None:
+            print("Objects with static geometry, written once:", len(self.inline_meshes))
+        if self.use_animations_cache:
+            print("Animations reused from cache:", self.reused_animations)
+        if self.use_change_tracking:
+            print("Per-object results reused, because objects did not change:",
+                self.change_tracker.reused, "of", self.change_tracker.reused + self.change_tracker.calculated)
+
     # Calculate the default object from which we should take actions.
     # Returns string (object mame, or '' if not found).
     def get_default_actions_object(self, context):
-        view_layer = context.view_layer
-        if self.use_selection:
-            objects = [obj for obj in context.scene.objects if obj.visible_get(view_layer=view_layer) and obj.select_get(view_layer=view_layer)]
-        else:
-            objects = [obj for obj in context.scene.objects if obj.visible_get(view_layer=view_layer)]
+        objects = self.get_exported_objects(context)
         more_than_one_armature = False
         armature = None
         for ob in objects:
@@ -551,6 +1867,8 @@ class ExportCastleAnimFrames(bpy.types.Operator):
 
         bpy.ops.object.select_all(action='SELECT')
         bpy.ops.object.duplicates_make_real()
+        # new objects may have the names of objects removed after the previous frame
+        self.change_tracker.invalidate()
 
         # Hm, I cannot seem to be able to undo the duplicates_make_real effect easily.
         # Doing
@@ -573,7 +1891,8 @@ class ExportCastleAnimFrames(bpy.types.Operator):
             # TODO: raise something more specific, what other scripts do?
             raise Exception("Error: we have less objecs after running duplicates_make_real, submit a bug")
 
-        duplicated_objects = [item for item in new_objects if item not in self.old_objects]
+        old_objects = set(self.old_objects)
+        duplicated_objects = [item for item in new_objects if item not in old_objects]
 
         if len(duplicated_objects) != 0:
             print("Make Duplicates Real Created new objects:", len(duplicated_objects))
@@ -587,7 +1906,7 @@ class ExportCastleAnimFrames(bpy.types.Operator):
 
             selected_count = 0
             for ob in context.scene.objects:
-                ob.select_set((ob in new_objects) and (ob not in self.old_objects))
+                ob.select_set(ob not in old_objects)
                 if ob.select_get():
                     selected_count = selected_count + 1
             if selected_count != len(duplicated_objects):
@@ -613,6 +1932,204 @@ def unregister():
     bpy.utils.unregister_class(ExportCastleAnimFrames)
     bpy.types.TOPBAR_MT_file_export.remove(menu_func)
 
-if __name__ == "__main__":
+def load_batch_manifest(manifest_path):
+    """Load the jobs to export from a JSON manifest.
+
+    The manifest is a list of jobs (or an object with "jobs" list).
+    Each job is an object with "blend" (blend file to open) and properties
+    of the export operator, at least "filepath" (castle-anim-frames file to write),
+    and optionally any other, like "actions_object", "frame_skip", "frame_format".
+    Paths are relative to the manifest.
+
+    Returns a list of jobs, with "index" (number in the manifest, from 1)
+    and absolute paths.
+    """
+
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if isinstance(manifest, dict):
+        manifest = manifest.get('jobs', [])
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    known_properties = set(bpy.ops.export.castle_anim_frames.get_rna_type().properties.keys())
+    jobs = []
+    for (index, job) in enumerate(manifest, 1):
+        if 'blend' not in job or 'filepath' not in job:
+            raise Exception('Job %d in "%s" must specify "blend" and "filepath"' % (index, manifest_path))
+        for name in job:
+            if name != 'blend' and name not in known_properties:
+                raise Exception('Job %d in "%s" has unknown property "%s"' % (index, manifest_path, name))
+        job = dict(job, index=index)
+        job['blend'] = os.path.join(base_dir, job['blend'])
+        job['filepath'] = os.path.join(base_dir, job['filepath'])
+        jobs.append(job)
+    return jobs
+
+def write_batch_results(results, results_path):
+    """Write the results of batch jobs to a JSON file.
+    The file is replaced at once, so it is never partially written."""
+    temp_path = results_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f)
+    os.replace(temp_path, results_path)
+
+def run_batch_jobs(jobs, results_path=None):
+    """Run the export jobs (from load_batch_manifest) in this Blender process,
+    opening each blend file once.
+
+    Returns a list of results, each is a dictionary with job "index",
+    "status" ('OK' or 'FAILED'), "time" (seconds) and "error" message.
+    A blend file that cannot be opened fails only its own jobs.
+    If results_path is set, the results are also written there
+    after each job, so they are not lost if this process crashes later.
+    """
+
+    results = []
+    blends = []
+    for job in jobs:
+        if job['blend'] not in blends:
+            blends.append(job['blend'])
+
+    def add_result(job, result):
+        print("Job %d (%s -> %s): %s in %.2f s %s" %
+            (job['index'], os.path.basename(job['blend']), os.path.basename(job['filepath']),
+             result['status'], result['time'], result['error']))
+        results.append(result)
+        if results_path:
+            write_batch_results(results, results_path)
+
+    for blend in blends:
+        blend_jobs = [job for job in jobs if job['blend'] == blend]
+        try:
+            bpy.ops.wm.open_mainfile(filepath=blend)
+        except Exception as e:
+            for job in blend_jobs:
+                add_result(job, {'index': job['index'], 'status': 'FAILED', 'time': 0.0,
+                    'error': 'Cannot open blend file: %s' % e})
+            continue
+        for job in blend_jobs:
+            properties = {name: value for (name, value) in job.items() if name not in {'blend', 'index'}}
+            start_time = time.perf_counter()
+            try:
+                bpy.ops.export.castle_anim_frames(**properties)
+                result = {'status': 'OK', 'error': ''}
+            except Exception as e:
+                result = {'status': 'FAILED', 'error': str(e)}
+            result.update(index=job['index'], time=time.perf_counter() - start_time)
+            add_result(job, result)
+    return results
+
+def run_batch(manifest_path, workers):
+    """Export all jobs from a manifest (see load_batch_manifest).
+
+    With workers > 0, jobs are split between this many background Blender
+    processes (all jobs using the same blend file are done by the same process).
+    Returns True if all jobs succeeded.
+    """
+
+    start_time = time.perf_counter()
+    jobs = load_batch_manifest(manifest_path)
+
+    if workers <= 0:
+        results = run_batch_jobs(jobs)
+    else:
+        # distribute blend files between workers, the largest groups first,
+        # each to the worker with the least jobs
+        groups = {}
+        for job in jobs:
+            groups.setdefault(job['blend'], []).append(job)
+        workers_jobs = [[] for i in range(min(workers, len(groups)))]
+        for group in sorted(groups.values(), key=len, reverse=True):
+            min(workers_jobs, key=len).extend(group)
+
+        results = []
+        temp_dir = tempfile.mkdtemp(prefix='castle_anim_frames_batch_')
+        try:
+            processes = []
+            for (worker_index, worker_jobs) in enumerate(workers_jobs):
+                job_file = os.path.join(temp_dir, 'batch_%d.json' % worker_index)
+                with open(job_file, 'w', encoding='utf-8') as f:
+                    json.dump({
+                        'jobs': worker_jobs,
+                        'results': os.path.join(temp_dir, 'results_%d.json' % worker_index),
+                    }, f)
+                processes.append(subprocess.Popen([bpy.app.binary_path,
+                    '--background',
+                    '--python-exit-code', '1',
+                    '--python', os.path.abspath(__file__),
+                    '--', '--batch-worker', job_file]))
+
+            for (worker_index, process) in enumerate(processes):
+                process.wait()
+                worker_results = []
+                try:
+                    with open(os.path.join(temp_dir, 'results_%d.json' % worker_index), 'r', encoding='utf-8') as f:
+                        worker_results = json.load(f)
+                except OSError:
+                    pass
+                results.extend(worker_results)
+                # worker crashed, its remaining jobs have no results
+                done = {result['index'] for result in worker_results}
+                results.extend({'index': job['index'], 'status': 'FAILED', 'time': 0.0,
+                    'error': 'Worker process failed with exit code %d' % process.returncode}
+                    for job in workers_jobs[worker_index] if job['index'] not in done)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    results.sort(key=lambda result: result['index'])
+    jobs_by_index = {job['index']: job for job in jobs}
+    print("Batch export summary:")
+    for result in results:
+        job = jobs_by_index[result['index']]
+        print("  %3d %-6s %8.2f s  %s -> %s %s" % (result['index'], result['status'], result['time'],
+            job['blend'], job['filepath'], result['error']))
+    failed = sum(1 for result in results if result['status'] != 'OK')
+    print("Exported %d jobs, %d failed, in %.2f s" % (len(results), failed, time.perf_counter() - start_time))
+    return failed == 0
+
+def main():
+    """Run from Blender command-line, like
+
+      blender --python export_castle_anim_frames.py
+      blender --background --python export_castle_anim_frames.py -- --manifest jobs.json --workers 4
+
+    Arguments after "--" are for this script.
+    Without arguments, shows the export dialog.
+    With --manifest, exports all jobs from the manifest
+    (see load_batch_manifest) and exits with non-zero status if some failed
+    (or if the manifest is invalid).
+    """
+
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    parser = argparse.ArgumentParser(prog='blender --python export_castle_anim_frames.py --')
+    parser.add_argument('--manifest',
+        help='Export jobs from this JSON file, each job is an object with "blend" file and export properties.')
+    parser.add_argument('--workers', type=int, default=0,
+        help='Number of background Blender processes to run the manifest jobs. 0 (default) means to run them in this process.')
+    parser.add_argument('--worker-job',
+        help='Internal: export frames described by this JSON file, used by "Worker Processes" option.')
+    parser.add_argument('--batch-worker',
+        help='Internal: run manifest jobs described by this JSON file, used by --workers.')
+    args = parser.parse_args(argv)
+
     register()
-    bpy.ops.export.castle_anim_frames('INVOKE_DEFAULT')
+    if args.worker_job:
+        bpy.ops.export.castle_anim_frames(worker_job=args.worker_job)
+    elif args.batch_worker:
+        with open(args.batch_worker, 'r', encoding='utf-8') as f:
+            batch = json.load(f)
+        run_batch_jobs(batch['jobs'], batch['results'])
+    elif args.manifest:
+        try:
+            success = run_batch(args.manifest, args.workers)
+        except Exception as e:
+            # exit with non-zero status even when Blender is run without --python-exit-code
+            print("Batch export failed:", e)
+            success = False
+        if not success:
+            sys.exit(1)
+    else:
+        bpy.ops.export.castle_anim_frames('INVOKE_DEFAULT')
+
+if __name__ == "__main__":
+    main()
@@ -32,6 +32,16 @@
 #
 # To have sensible results, make sure that render resolution width
 # is equal height, and that camera has field of view = 90 degrees.
+#
+# Alternatively (method "Panorama", requires Cycles) the scene is rendered
+# only once, by a panoramic equirectangular camera, and the 6 images
+# are resampled from it (by skybox_images.py, that must be installed
+# next to this script). This avoids repeating the scene preparation
+# (like BVH building and shader compilation) for each image.
+#
+# Optionally, the 6 images are also written as a single cube map file
+# (DDS or KTX, uncompressed RGBA with mipmaps),
+# or as a single atlas image (with X3D file showing it as a skybox).
 
 bl_info = {
     "name": "Render Skybox",
@@ -51,35 +61,514 @@ bl_info = {
 
 import bpy
 import os
+import sys
+import json
+import time
+import hashlib
+import shutil
+import tempfile
+import subprocess
 import mathutils
 import math
+import numpy
+from xml.sax.saxutils import quoteattr
 from math import radians
+from bpy.props import *
 
 # For useful info for implementation, see
 # https://www.blender.org/api/blender_python_api_current/
 # http://blender.stackexchange.com/questions/31702/how-to-set-objects-rotation-from-python
 # http://blender.stackexchange.com/questions/8850/how-to-take-images-with-multiple-cameras-with-script
 
+# Skybox sides, with camera rotation (Euler XYZ, in degrees) to render them.
+SKYBOX_SIDES = (
+    ("bottom", (  0.0, 0.0, -180.0)),
+    ("top",    (180.0, 0.0, -180.0)),
+    ("back",   ( 90.0, 0.0,    0.0)),
+    ("front",  ( 90.0, 0.0,  180.0)),
+    ("left",   ( 90.0, 0.0,  -90.0)),
+    ("right",  ( 90.0, 0.0,   90.0)),
+)
+
+# Skybox sides in the order of cube map faces in DDS and KTX files
+# (+X, -X, +Y, -Y, +Z, -Z).
+CUBE_MAP_SIDES = ("right", "left", "top", "bottom", "front", "back")
+
+# X3D file showing the skybox atlas on a cube, see RenderSkybox.write_atlas.
+ATLAS_X3D = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE X3D PUBLIC "ISO//Web3D//DTD X3D 3.0//EN" "http://www.web3d.org/specifications/x3d-3.0.dtd">
+<X3D version="3.0" profile="Interchange">
+<Scene>
+  <!-- Skybox from the atlas %(atlas)s, on a cube with size 2 (scale it as needed).
+       It looks like X3D Background node with the 6 images, but loads only one image.
+       Without Material, the cube is unlit. -->
+  <Shape>
+    <Appearance>
+      <ImageTexture url=%(url)s repeatS="false" repeatT="false" />
+    </Appearance>
+    <IndexedFaceSet solid="false" coordIndex="%(index)s" texCoordIndex="%(index)s">
+      <Coordinate point="%(points)s" />
+      <TextureCoordinate point="%(tex_coords)s" />
+    </IndexedFaceSet>
+  </Shape>
+</Scene>
+</X3D>
+"""
+
+# Python code executed by a background Blender process to render one skybox side,
+# see RenderSkybox.parallel_render.
+WORKER_SCRIPT = """
+import bpy
+from math import radians
+bpy.context.scene.frame_set(%d)
+camera = bpy.context.scene.camera
+camera.rotation_euler = [radians(angle) for angle in %r]
+bpy.context.scene.render.filepath = %r
+bpy.ops.render.render(write_still=True)
+"""
+
+# File (in the output directory) remembering the inputs of rendered images
+# in the "Render Sequence" mode, see RenderSkybox.get_inputs_hash.
+CACHE_FILE_NAME = "skybox_cache.json"
+
+# Node properties that only affect the node editor, not the rendering.
+NODE_UI_PROPERTIES = {'name', 'label', 'location', 'width', 'width_hidden', 'height',
+    'dimensions', 'select', 'hide', 'show_options', 'show_preview', 'show_texture',
+    'use_custom_color', 'color'}
+
+def import_skybox_images():
+    """Import and return skybox_images module (used only by some methods)."""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    if os.path.isfile(os.path.join(script_dir, "skybox_images.py")) and script_dir not in sys.path:
+        sys.path.append(script_dir)
+    try:
+        import skybox_images
+    except ImportError:
+        raise Exception('This method requires skybox_images.py (from cge-blender render_skybox/) installed next to render_skybox.py')
+    return skybox_images
+
+def hash_rna_values(hash, struct, ignored=()):
+    """Update hash with values of all simple (not pointer or collection)
+    properties of a Blender struct, like Material or Lamp,
+    except properties named in ignored."""
+    for prop in struct.bl_rna.properties:
+        if prop.type in {'BOOLEAN', 'INT', 'FLOAT', 'STRING', 'ENUM'} and \
+           prop.identifier not in ignored:
+            value = getattr(struct, prop.identifier)
+            if prop.type in {'BOOLEAN', 'INT', 'FLOAT'} and prop.is_array:
+                value = tuple(value)
+            hash.update(repr((prop.identifier, value)).encode('utf-8'))
+
+def hash_foreach(hash, collection, attribute, dtype, size=1):
+    """Update hash with the attribute of all items of a Blender collection."""
+    values = numpy.empty(len(collection) * size, dtype=dtype)
+    collection.foreach_get(attribute, values)
+    hash.update(values.tobytes())
+
+def hash_evaluated_mesh(hash, obj, scene):
+    """Update hash with the geometry of an object as rendered,
+    with modifiers, shape keys and armature deformation applied."""
+    mesh = obj.to_mesh(scene, True, 'RENDER')
+    if mesh is None:
+        return
+    try:
+        hash_foreach(hash, mesh.vertices, 'co', numpy.float32, 3)
+        hash_foreach(hash, mesh.loops, 'vertex_index', numpy.int32)
+        hash_foreach(hash, mesh.polygons, 'material_index', numpy.int32)
+        hash_foreach(hash, mesh.polygons, 'use_smooth', numpy.bool_)
+        if mesh.uv_layers.active:
+            hash_foreach(hash, mesh.uv_layers.active.data, 'uv', numpy.float32, 2)
+    finally:
+        bpy.data.meshes.remove(mesh)
+
+def hash_node_tree(hash, node_tree, hashed_groups=None):
+    """Update hash with the nodes of a node tree (of material, world or lamp):
+    node settings, values of the inputs, used images and links.
+    Node groups are hashed recursively (each once)."""
+    if hashed_groups is None:
+        hashed_groups = set()
+    for node in node_tree.nodes:
+        hash.update(repr((node.name, node.bl_idname)).encode('utf-8'))
+        hash_rna_values(hash, node, NODE_UI_PROPERTIES)
+        for node_input in node.inputs:
+            if hasattr(node_input, 'default_value'):
+                hash_rna_values(hash, node_input)
+        image = getattr(node, 'image', None)
+        if image is not None:
+            hash.update(repr((image.name, image.filepath)).encode('utf-8'))
+        group = getattr(node, 'node_tree', None)
+        if group is not None and group.name not in hashed_groups:
+            hashed_groups.add(group.name)
+            hash_node_tree(hash, group, hashed_groups)
+    for link in node_tree.links:
+        hash.update(repr((link.from_node.name, link.from_socket.identifier,
+            link.to_node.name, link.to_socket.identifier)).encode('utf-8'))
+
+class SideJob:
+    """Skybox side to render: side name, camera rotation (Euler XYZ, in degrees),
+    frame, output file and hash of the inputs (or None if not known)."""
+
+    def __init__(self, name, rotation, frame, filepath, inputs_hash):
+        self.name = name
+        self.rotation = rotation
+        self.frame = frame
+        self.filepath = filepath
+        self.inputs_hash = inputs_hash
+
 class RenderSkybox(bpy.types.Operator):
     """Render the scene 6 times, to outputs named front/back/top/bottom/left/right. Suitable to create skyboxes or cubemap textures for games. The orientation and naming matches X3D and Castle Game Engine."""
     bl_idname = "render.skybox"
     bl_label = "Render Skybox"
 
-    def one_render(self, context, output_path, rotation, name):
-        # set camera
+    method = EnumProperty(
+        name="Method",
+        items=(('CAMERAS', "Six Renders", "Render the scene 6 times, rotating the camera"),
+               ('EQUIRECTANGULAR', "Panorama", "Render the scene once with an equirectangular panoramic camera (requires Cycles), and resample it into 6 images"),
+               ),
+        default='CAMERAS',
+        )
+
+    worker_processes = IntProperty(
+        name="Worker Processes",
+        description="If non-zero, the 6 images are rendered in parallel by this many background Blender processes (each renders a copy of the current blend file). Used only by the \"Six Renders\" method",
+        default=0, min=0, max=6,
+        )
+
+    use_sequence = BoolProperty(
+        name="Render Sequence",
+        description="Render a skybox for each frame from the scene Start to End frame (every Frame Step frames), to outputs named like front_0001.png. Images whose inputs (scene state at this frame, camera position, render settings) did not change since the previous run are not rendered again (this is remembered in " + CACHE_FILE_NAME + " in the output directory)",
+        default=False,
+        )
+
+    cube_map_format = EnumProperty(
+        name="Cube Map File",
+        items=(('NONE', "None", "Only write 6 images"),
+               ('DDS', "DDS", "Also write the 6 images as a cube map in DDS file, with mipmaps"),
+               ('KTX', "KTX", "Also write the 6 images as a cube map in KTX file, with mipmaps"),
+               ),
+        description="Write a single cube map file (named skybox.dds or skybox.ktx, with frame number in the \"Render Sequence\" mode) with all images and their mipmaps, that can be loaded by the game engine without generating mipmaps at runtime",
+        default='NONE',
+        )
+
+    atlas_layout = EnumProperty(
+        name="Atlas",
+        items=(('NONE', "None", "Only write 6 images"),
+               ('STRIP', "Strip", "Also write the 6 images in one image, side by side (right, left, top, bottom, front, back)"),
+               ('CROSS', "Cross", "Also write the 6 images in one image, in a horizontal cross (top, left-front-right-back, bottom)"),
+               ),
+        description="Write a single image (named skybox.png, with frame number in the \"Render Sequence\" mode) with all 6 images, and X3D file (skybox.x3d) showing it as a skybox. This way the game engine loads one image per skybox",
+        default='NONE',
+        )
+
+    def get_side_filepath(self, output_path, name, frame):
+        """Output file of a skybox side."""
+        if self.use_sequence:
+            return output_path + "/%s_%04d.png" % (name, frame)
+        return output_path + "/" + name + ".png"
+
+    def get_skybox_filepath(self, output_path, frame, extension):
+        """Output file combining all sides (see cube_map_format, atlas_layout)."""
+        return self.get_side_filepath(output_path, "skybox", frame)[:-len(".png")] + extension
+
+    def get_combined_filepaths(self, output_path, frame):
+        """Output files combining all sides, that should be written."""
+        result = []
+        if self.cube_map_format != 'NONE':
+            result.append(self.get_skybox_filepath(output_path, frame, "." + self.cube_map_format.lower()))
+        if self.atlas_layout != 'NONE':
+            result.append(self.get_skybox_filepath(output_path, frame, ".png"))
+            result.append(self.get_skybox_filepath(output_path, frame, ".x3d"))
+        return result
+
+    def get_inputs_hash(self, context):
+        """Hash (string) of the inputs that determine the skybox rendered
+        at the current frame: camera position, render settings, world,
+        and the visible objects (transformation, evaluated geometry, pose,
+        modifiers, materials), including the node trees of world, lamps and materials.
+        Camera rotation is not included, it is overridden by each side."""
+
+        scene = context.scene
+        hash = hashlib.sha1()
+        hash.update(repr((scene.frame_current, self.method,
+            tuple(scene.camera.matrix_world.translation))).encode('utf-8'))
+        hash_rna_values(hash, scene.render)
+        if scene.world:
+            hash_rna_values(hash, scene.world)
+            if scene.world.node_tree:
+                hash_node_tree(hash, scene.world.node_tree)
+        for obj in scene.objects:
+            if obj.hide_render or obj == scene.camera:
+                continue
+            hash.update(repr((obj.name, obj.type)).encode('utf-8'))
+            hash.update(numpy.array(obj.matrix_world).tobytes())
+            if obj.type in {'MESH', 'CURVE', 'SURFACE', 'FONT', 'META'}:
+                hash_evaluated_mesh(hash, obj, scene)
+            elif obj.data is not None:
+                hash_rna_values(hash, obj.data)
+                if getattr(obj.data, 'node_tree', None):
+                    hash_node_tree(hash, obj.data.node_tree)
+            if obj.pose:
+                for bone in obj.pose.bones:
+                    hash.update(numpy.array(bone.matrix).tobytes())
+            for modifier in obj.modifiers:
+                hash_rna_values(hash, modifier)
+            for slot in obj.material_slots:
+                if slot.material:
+                    hash_rna_values(hash, slot.material)
+                    if slot.material.node_tree:
+                        hash_node_tree(hash, slot.material.node_tree)
+        return hash.hexdigest()
+
+    def get_frames(self, context):
+        """Frames to render."""
+        scene = context.scene
+        if self.use_sequence:
+            return range(scene.frame_start, scene.frame_end + 1, scene.frame_step)
+        return [scene.frame_current]
+
+    def get_jobs(self, context, output_path, cache):
+        """List of SideJob to render, skipping the images already rendered
+        with the same inputs (according to cache)."""
+
+        scene = context.scene
+        if not self.use_sequence:
+            return [SideJob(name, rotation, scene.frame_current,
+                self.get_side_filepath(output_path, name, scene.frame_current), None)
+                for (name, rotation) in SKYBOX_SIDES]
+
+        jobs = []
+        self.unchanged_images = 0
+        for frame in self.get_frames(context):
+            scene.frame_set(frame)
+            frame_hash = self.get_inputs_hash(context)
+            for (name, rotation) in SKYBOX_SIDES:
+                filepath = self.get_side_filepath(output_path, name, frame)
+                inputs_hash = frame_hash + " " + name
+                if cache.get(os.path.basename(filepath)) == inputs_hash and \
+                   os.path.isfile(bpy.path.abspath(filepath)):
+                    self.unchanged_images += 1
+                    continue
+                jobs.append(SideJob(name, rotation, frame, filepath, inputs_hash))
+        return jobs
+
+    def job_done(self, context, job, cache, cache_file, output_path, pixels):
+        """Finished rendering job: update progress and cache,
+        write files combining all sides when all sides of the frame are ready.
+        pixels are the rendered image, if available in memory (or None)."""
+
+        self.current_progress = self.current_progress + 1
+        context.window_manager.progress_update(self.current_progress)
+
+        if self.get_combined_filepaths(output_path, job.frame):
+            if pixels is not None:
+                self.sides_pixels[job.filepath] = pixels
+            self.frames_pending_sides[job.frame] -= 1
+            if self.frames_pending_sides[job.frame] == 0:
+                self.write_combined_files(output_path, job.frame)
+
+        if job.inputs_hash is not None:
+            cache[os.path.basename(job.filepath)] = job.inputs_hash
+            # save after every image, to not render it again when the rendering is interrupted
+            with open(cache_file + ".tmp", 'w', encoding='utf-8') as f:
+                json.dump(cache, f, indent=1, sort_keys=True)
+            os.replace(cache_file + ".tmp", cache_file)
+
+    def load_image_pixels(self, filepath):
+        """Load image file as NumPy array (height x width x channels, rows from the bottom)."""
+        image = bpy.data.images.load(filepath)
+        try:
+            (width, height) = image.size
+            return numpy.array(image.pixels[:], dtype=numpy.float32). \
+                reshape(height, width, image.channels)
+        finally:
+            bpy.data.images.remove(image)
+
+    def write_combined_files(self, output_path, frame):
+        """Write files combining all sides (see cube_map_format, atlas_layout)
+        from the images of the given frame.
+        Uses the images in sides_pixels (removing them from there) or loads them."""
+
+        faces = {}
+        for (name, rotation) in SKYBOX_SIDES:
+            filepath = self.get_side_filepath(output_path, name, frame)
+            pixels = self.sides_pixels.pop(filepath, None)
+            if pixels is None:
+                pixels = self.load_image_pixels(filepath)
+            faces[name] = pixels
+
+        if self.cube_map_format != 'NONE':
+            self.write_cube_map(output_path, frame, faces)
+        if self.atlas_layout != 'NONE':
+            self.write_atlas(output_path, frame, faces)
+
+    def write_cube_map(self, output_path, frame, faces):
+        """Write cube map file (see cube_map_format) from the sides (dictionary name -> pixels)."""
+
+        skybox_images = import_skybox_images()
+        rotations = dict(SKYBOX_SIDES)
+        levels = skybox_images.cube_map_mipmaps([faces[name] for name in CUBE_MAP_SIDES],
+            [[radians(angle) for angle in rotations[name]] for name in CUBE_MAP_SIDES])
+
+        cube_map_filepath = bpy.path.abspath(self.get_skybox_filepath(output_path, frame,
+            "." + self.cube_map_format.lower()))
+        if self.cube_map_format == 'DDS':
+            skybox_images.write_dds(cube_map_filepath, levels)
+        else:
+            skybox_images.write_ktx(cube_map_filepath, levels)
+
+    def write_atlas(self, output_path, frame, faces):
+        """Write atlas image (see atlas_layout) from the sides (dictionary name -> pixels),
+        and X3D file showing it."""
+
+        skybox_images = import_skybox_images()
+        atlas_filepath = self.get_skybox_filepath(output_path, frame, ".png")
+        self.save_image(skybox_images.make_atlas(faces, self.atlas_layout), atlas_filepath)
+
+        size = next(iter(faces.values())).shape[0]
+        quads = skybox_images.atlas_cube(self.atlas_layout,
+            dict((name, [radians(angle) for angle in rotation]) for (name, rotation) in SKYBOX_SIDES),
+            size)
+        atlas_name = os.path.basename(atlas_filepath)
+        with open(bpy.path.abspath(self.get_skybox_filepath(output_path, frame, ".x3d")), 'w', encoding='utf-8') as f:
+            f.write(ATLAS_X3D % {
+                'atlas': atlas_name,
+                'url': quoteattr('"%s"' % atlas_name),
+                'index': ' '.join('%d %d %d %d -1' % tuple(range(i * 4, i * 4 + 4)) for i in range(len(quads))),
+                'points': ', '.join('%d %d %d' % point for quad in quads for (point, tex_coord) in quad),
+                'tex_coords': ', '.join('%.6f %.6f' % tex_coord for quad in quads for (point, tex_coord) in quad),
+            })
+
+    def one_render(self, context, job):
+        # set frame and camera
+        if context.scene.frame_current != job.frame:
+            context.scene.frame_set(job.frame)
         camera = context.scene.camera
-        camera.rotation_euler = rotation
+        camera.rotation_euler = mathutils.Euler([radians(angle) for angle in job.rotation])
 
         # render
-        context.scene.render.filepath = output_path + "/" + name + ".png"
+        context.scene.render.filepath = job.filepath
         bpy.ops.render.render(write_still=True)
 
-        # increase progress
-        self.current_progress = self.current_progress + 1
-        wm = context.window_manager
-        wm.progress_update(self.current_progress)
+    def parallel_render(self, context, jobs, job_done):
+        """Render the jobs in worker_processes background Blender processes,
+        each rendering one image from a copy of the current blend file.
+        Returns False (after reporting an error) if some worker failed."""
+
+        temp_dir = tempfile.mkdtemp(prefix='render_skybox_')
+        try:
+            # Save a copy, to let workers see also the unsaved changes
+            # (including the camera settings done by execute).
+            # Paths are remapped, so relative texture paths still work.
+            blend_file = os.path.join(temp_dir, 'scene.blend')
+            bpy.ops.wm.save_as_mainfile(filepath=blend_file, copy=True)
+
+            pending = list(jobs)
+            running = [] # list of (job, process, start time)
+            times = []
+            start_time = time.time()
+            try:
+                while pending or running:
+                    while pending and len(running) < self.worker_processes:
+                        job = pending.pop(0)
+                        # workers open the blend file from another directory, so use absolute paths
+                        script = WORKER_SCRIPT % (job.frame, job.rotation, bpy.path.abspath(job.filepath))
+                        process = subprocess.Popen([bpy.app.binary_path,
+                            '--background', blend_file,
+                            # without --python-exit-code, Blender exits with 0 even when script fails
+                            '--python-exit-code', '1',
+                            '--python-expr', script])
+                        running.append((job, process, time.time()))
+
+                    time.sleep(0.1)
+                    for (job, process, process_start_time) in list(running):
+                        if process.poll() is None:
+                            continue
+                        running.remove((job, process, process_start_time))
+                        if process.returncode != 0:
+                            self.report({'ERROR'}, "Rendering skybox image \"%s\" failed (worker process exit code %d), see console for details." %
+                                (os.path.basename(job.filepath), process.returncode))
+                            return False
+                        times.append((os.path.basename(job.filepath), time.time() - process_start_time))
+                        job_done(job)
+            finally:
+                for (job, process, process_start_time) in running:
+                    if process.poll() is None:
+                        process.kill()
+                        process.wait()
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        self.report({'INFO'}, "Rendered skybox in %.1f s (%s)" % (time.time() - start_time,
+            ", ".join("%s %.1f s" % name_time for name_time in times)))
+        return True
+
+    def panorama_render(self, context, jobs, job_done):
+        """Render the scene once (for each frame) with equirectangular panoramic camera,
+        and resample the result into the images."""
+
+        skybox_images = import_skybox_images()
+
+        scene = context.scene
+        camera = scene.camera
+        render = scene.render
+        # panorama with the same angular resolution as the images
+        size = render.resolution_x * render.resolution_percentage // 100
+        # panorama looks at the front, any rotation would work
+        panorama_rotation = [radians(angle) for angle in dict(SKYBOX_SIDES)["front"]]
+
+        frames = sorted(set(job.frame for job in jobs))
+        for frame in frames:
+            if scene.frame_current != frame:
+                scene.frame_set(frame)
+
+            old_camera_type = camera.data.type
+            old_panorama_type = camera.data.cycles.panorama_type
+            old_resolution = (render.resolution_x, render.resolution_y)
+            panorama_path = os.path.dirname(jobs[0].filepath) + "/skybox_panorama.png"
+            try:
+                camera.data.type = 'PANO'
+                camera.data.cycles.panorama_type = 'EQUIRECTANGULAR'
+                camera.rotation_euler = panorama_rotation
+                render.resolution_x = old_resolution[0] * 4
+                render.resolution_y = old_resolution[0] * 2
+                render.filepath = panorama_path
+                bpy.ops.render.render(write_still=True)
+            finally:
+                camera.data.type = old_camera_type
+                camera.data.cycles.panorama_type = old_panorama_type
+                (render.resolution_x, render.resolution_y) = old_resolution
+
+            panorama = self.load_image_pixels(panorama_path)
+            os.remove(bpy.path.abspath(panorama_path))
+
+            for job in jobs:
+                if job.frame == frame:
+                    face = skybox_images.equirectangular_to_face(panorama, panorama_rotation,
+                        [radians(angle) for angle in job.rotation], size)
+                    self.save_image(face, job.filepath)
+                    job_done(job, face)
+
+    def save_image(self, pixels, filepath):
+        """Save NumPy array (height x width x channels, rows from the bottom) as PNG."""
+        (height, width, channels) = pixels.shape
+        if channels != 4:
+            rgba = numpy.ones((height, width, 4), dtype=pixels.dtype)
+            rgba[:, :, :channels] = pixels
+            pixels = rgba
+        image = bpy.data.images.new(os.path.basename(filepath), width, height, alpha=True)
+        try:
+            image.pixels = pixels.ravel().tolist()
+            image.filepath_raw = filepath
+            image.file_format = 'PNG'
+            image.save()
+        finally:
+            bpy.data.images.remove(image)
 
     def execute(self, context):
+        if self.method == 'EQUIRECTANGULAR' and context.scene.render.engine != 'CYCLES':
+            self.report({'ERROR'}, "The \"Panorama\" method of \"Render Skybox\" requires Cycles render engine.")
+            return {'CANCELLED'}
+
         if context.scene.render.resolution_x != context.scene.render.resolution_y:
             self.report({'ERROR'}, "To make \"Render Skybox\" work, first set render size to be square (resolution_x must be equal to resolution_y).")
             return {'CANCELLED'}
@@ -101,29 +590,65 @@ class RenderSkybox(bpy.types.Operator):
         camera.data.angle = radians(90)
 
         old_filepath = context.scene.render.filepath
+        old_frame = context.scene.frame_current
         try:
             wm = context.window_manager
 
             (output_path, output_basename_ignored) = \
                 os.path.split(context.scene.render.filepath)
 
+            cache_file = os.path.join(bpy.path.abspath(output_path), CACHE_FILE_NAME)
+            cache = {}
+            if self.use_sequence and os.path.isfile(cache_file):
+                with open(cache_file, 'r', encoding='utf-8') as f:
+                    cache = json.load(f)
+
+            jobs = self.get_jobs(context, output_path, cache)
+            if self.use_sequence:
+                print("Rendering", len(jobs), "skybox images,", self.unchanged_images,
+                    "images did not change since the previous run")
+
+            self.sides_pixels = {}
+            self.frames_pending_sides = {}
+            for job in jobs:
+                self.frames_pending_sides[job.frame] = self.frames_pending_sides.get(job.frame, 0) + 1
+
+            def job_done(job, pixels=None):
+                self.job_done(context, job, cache, cache_file, output_path, pixels)
+
             self.current_progress = 0
-            wm.progress_begin(self.current_progress, 6)
+            wm.progress_begin(self.current_progress, len(jobs))
 
-            self.one_render(context, output_path, mathutils.Euler((          0.0 , 0.0, radians(-180.0))), "bottom")
-            self.one_render(context, output_path, mathutils.Euler((radians(180.0), 0.0, radians(-180.0))), "top")
+            rendered = True
+            if not jobs:
+                pass
+            elif self.method == 'EQUIRECTANGULAR':
+                self.panorama_render(context, jobs, job_done)
+            elif self.worker_processes > 0:
+                rendered = self.parallel_render(context, jobs, job_done)
+            else:
+                for job in jobs:
+                    self.one_render(context, job)
+                    job_done(job)
 
-            self.one_render(context, output_path, mathutils.Euler((radians(90.0), 0.0,            0.0 )), "back")
-            self.one_render(context, output_path, mathutils.Euler((radians(90.0), 0.0,  radians(180.0))), "front")
-            self.one_render(context, output_path, mathutils.Euler((radians(90.0), 0.0,  radians(-90.0))), "left")
-            self.one_render(context, output_path, mathutils.Euler((radians(90.0), 0.0,  radians( 90.0))), "right")
+            if rendered:
+                # write missing combined files of frames that did not need rendering
+                for frame in self.get_frames(context):
+                    if self.frames_pending_sides.get(frame, 0) == 0 and \
+                       any(not os.path.isfile(bpy.path.abspath(filepath))
+                           for filepath in self.get_combined_filepaths(output_path, frame)):
+                        self.write_combined_files(output_path, frame)
 
             wm.progress_end()
+            if not rendered:
+                return {'CANCELLED'}
         finally:
             context.scene.render.filepath = old_filepath
             camera.rotation_euler = old_camera_rotation
             camera.data.lens_unit = old_camera_lens_unit
             camera.data.angle = old_camera_angle
+            if context.scene.frame_current != old_frame:
+                context.scene.frame_set(old_frame)
 
         return {'FINISHED'}
 
@@ -0,0 +1,301 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# Image processing for render_skybox.py, using only NumPy (not Blender),
+# so it can be used and tested outside of Blender.
+#
+# Images are NumPy arrays (height, width, channels) of floats,
+# with rows ordered from the bottom, like Blender Image.pixels.
+#
+# Directions are in Blender world space (+Z up).
+# Camera rotations are Euler XYZ angles (in radians), like Object.rotation_euler.
+# Blender camera looks along its local -Z, with local +Y up.
+
+import math
+import struct
+import numpy
+
+def euler_xyz_matrix(euler):
+    """Rotation matrix (NumPy 3x3) of Euler XYZ angles, like Blender Euler.to_matrix()."""
+    (x, y, z) = euler
+    (sx, cx) = (math.sin(x), math.cos(x))
+    (sy, cy) = (math.sin(y), math.cos(y))
+    (sz, cz) = (math.sin(z), math.cos(z))
+    rotate_x = numpy.array(((1, 0, 0), (0, cx, -sx), (0, sx, cx)))
+    rotate_y = numpy.array(((cy, 0, sy), (0, 1, 0), (-sy, 0, cy)))
+    rotate_z = numpy.array(((cz, -sz, 0), (sz, cz, 0), (0, 0, 1)))
+    return rotate_z @ rotate_y @ rotate_x
+
+def face_directions(camera_euler, size):
+    """World-space directions (NumPy array size x size x 3, not normalized)
+    seen by pixel centers of a square image rendered by a camera
+    with given rotation and field of view 90 degrees."""
+    coords = (numpy.arange(size) + 0.5) * (2.0 / size) - 1.0
+    (x, y) = numpy.meshgrid(coords, coords)
+    local_directions = numpy.stack((x, y, numpy.full_like(x, -1.0)), axis=-1)
+    return local_directions @ euler_xyz_matrix(camera_euler).T
+
+def equirectangular_coordinates(directions, panorama_euler):
+    """Texture coordinates (u, v) in the equirectangular panorama,
+    rendered by Cycles panoramic camera with given rotation,
+    where given world-space directions are visible.
+
+    The panorama center (u = v = 0.5) is what the camera looks at (local -Z),
+    v = 1 is up (local +Y), u grows to the right (local +X).
+    """
+    local = directions @ euler_xyz_matrix(panorama_euler)
+    local = local / numpy.linalg.norm(local, axis=-1, keepdims=True)
+    u = (math.pi - numpy.arctan2(-local[..., 0], -local[..., 2])) / (2.0 * math.pi)
+    v = (math.pi - numpy.arccos(numpy.clip(local[..., 1], -1.0, 1.0))) / math.pi
+    return (u, v)
+
+def sample_bilinear(image, u, v):
+    """Sample image (height x width x channels) at texture coordinates u, v
+    (arrays of the same shape) with bilinear filtering.
+    Horizontally the image wraps (like a panorama), vertically it is clamped."""
+    (height, width) = image.shape[:2]
+    x = u * width - 0.5
+    y = numpy.clip(v * height - 0.5, 0.0, height - 1.0)
+    x0 = numpy.floor(x).astype(numpy.int64)
+    y0 = numpy.floor(y).astype(numpy.int64)
+    fx = (x - x0)[..., numpy.newaxis]
+    fy = (y - y0)[..., numpy.newaxis]
+    x1 = (x0 + 1) % width
+    x0 = x0 % width
+    y1 = numpy.minimum(y0 + 1, height - 1)
+    bottom = image[y0, x0] * (1.0 - fx) + image[y0, x1] * fx
+    top = image[y1, x0] * (1.0 - fx) + image[y1, x1] * fx
+    return bottom * (1.0 - fy) + top * fy
+
+def equirectangular_to_face(panorama, panorama_euler, camera_euler, size):
+    """Resample equirectangular panorama (rendered by a camera with panorama_euler
+    rotation) into a square image of given size, like rendered by a camera
+    with camera_euler rotation and field of view 90 degrees."""
+    (u, v) = equirectangular_coordinates(face_directions(camera_euler, size), panorama_euler)
+    return sample_bilinear(panorama, u, v)
+
+def equirectangular_to_faces(panorama, panorama_euler, faces, size):
+    """Resample equirectangular panorama into skybox faces.
+    faces is a sequence of (name, camera_euler), returns a dictionary name -> image."""
+    return dict((name, equirectangular_to_face(panorama, panorama_euler, camera_euler, size))
+        for (name, camera_euler) in faces)
+
+def srgb_to_linear(values):
+    """Convert sRGB-encoded color values (0..1) to linear light."""
+    return numpy.where(values <= 0.04045, values / 12.92, ((values + 0.055) / 1.055) ** 2.4)
+
+def linear_to_srgb(values):
+    """Convert linear light color values (0..1) to sRGB encoding."""
+    values = numpy.clip(values, 0.0, 1.0)
+    return numpy.where(values <= 0.0031308, values * 12.92, 1.055 * values ** (1.0 / 2.4) - 0.055)
+
+def downsample_box(image):
+    """Half-size image (2x2 box filter). For odd sizes, the last row/column is ignored."""
+    (height, width) = (max(1, image.shape[0] // 2), max(1, image.shape[1] // 2))
+    (box_height, box_width) = (min(2, image.shape[0]), min(2, image.shape[1]))
+    image = image[:height * box_height, :width * box_width]
+    return image.reshape(height, box_height, width, box_width, image.shape[2]).mean(axis=(1, 3))
+
+def fix_cube_seams(faces, cameras_eulers):
+    """Make the edge texels of cube map faces (all of equal size,
+    linear light, modified in place) equal to their neighbours on adjacent faces,
+    by averaging the texels that touch the same point on a cube edge.
+    This way filtering doesn't show seams between faces.
+
+    cameras_eulers are rotations of cameras that rendered the faces
+    (see face_directions), they determine how faces are adjacent."""
+
+    size = faces[0].shape[0]
+    if size < 2:
+        # each face is 1 texel, average all to make a uniform cube
+        average = numpy.mean([face[0, 0] for face in faces], axis=0)
+        for face in faces:
+            face[0, 0] = average
+        return
+
+    # positions (rows, columns) of border texels, in the same order for all faces
+    border = numpy.zeros((size, size), dtype=bool)
+    border[0, :] = border[-1, :] = border[:, 0] = border[:, -1] = True
+    (rows, columns) = numpy.nonzero(border)
+
+    # points on the cube edges (local coordinates are texel centers,
+    # clamped to the edge), in units of half-texel, so they are integers
+    coords = (numpy.arange(size) * 2 + 1) - size
+    x = numpy.clip(coords[columns], 1 - size, size - 1)
+    y = numpy.clip(coords[rows], 1 - size, size - 1)
+    x = numpy.where(columns == 0, -size, numpy.where(columns == size - 1, size, x))
+    y = numpy.where(rows == 0, -size, numpy.where(rows == size - 1, size, y))
+    local_points = numpy.stack((x, y, numpy.full_like(x, -size)), axis=-1)
+
+    points = numpy.concatenate([local_points @ euler_xyz_matrix(euler).T for euler in cameras_eulers])
+    points = numpy.round(points).astype(numpy.int64)
+    values = numpy.concatenate([face[rows, columns] for face in faces])
+
+    (unique_points, groups) = numpy.unique(points, axis=0, return_inverse=True)
+    groups = groups.ravel()
+    sums = numpy.zeros((len(unique_points), values.shape[1]))
+    numpy.add.at(sums, groups, values)
+    counts = numpy.bincount(groups, minlength=len(unique_points))
+    averages = sums / counts[:, numpy.newaxis]
+
+    for (face_index, face) in enumerate(faces):
+        face_groups = groups[face_index * len(rows):(face_index + 1) * len(rows)]
+        face[rows, columns] = averages[face_groups]
+
+def cube_map_mipmaps(faces, cameras_eulers):
+    """Mipmaps of a cube map.
+
+    faces are square images (sRGB-encoded, like rendered images) of equal size,
+    cameras_eulers are rotations of cameras that rendered them (see fix_cube_seams).
+    Returns a list of levels (from the largest), each level is a list of faces.
+    Smaller levels are calculated by box filter in linear light,
+    with edges averaged between adjacent faces.
+    """
+    levels = [list(faces)]
+    linear_faces = [face.astype(numpy.float64) for face in faces]
+    for face in linear_faces:
+        face[:, :, :3] = srgb_to_linear(face[:, :, :3])
+    while linear_faces[0].shape[0] > 1:
+        linear_faces = [downsample_box(face) for face in linear_faces]
+        fix_cube_seams(linear_faces, cameras_eulers)
+        level = []
+        for face in linear_faces:
+            face = face.copy()
+            face[:, :, :3] = linear_to_srgb(face[:, :, :3])
+            level.append(face)
+        levels.append(level)
+    return levels
+
+def to_rgba8(image):
+    """Convert image (height x width x channels, floats 0..1) to RGBA bytes (NumPy uint8 array)."""
+    (height, width, channels) = image.shape
+    rgba = numpy.ones((height, width, 4))
+    rgba[:, :, :min(channels, 4)] = image[:, :, :4]
+    if channels < 3:
+        # grayscale
+        rgba[:, :, 1] = rgba[:, :, 2] = rgba[:, :, 0]
+    return numpy.round(numpy.clip(rgba, 0.0, 1.0) * 255.0).astype(numpy.uint8)
+
+def cube_map_face_bytes(face):
+    """RGBA bytes of a cube map face, rows from the top.
+
+    Cube map faces (both in DDS and KTX) follow the RenderMan convention,
+    with the first row at the top of the face (looking from the cube center),
+    unlike 2D OpenGL textures where the first row is at the bottom.
+    """
+    return to_rgba8(face[::-1]).tobytes()
+
+def write_dds(filepath, levels):
+    """Write cube map to DDS file (uncompressed RGBA, 8 bits per channel).
+    levels are like the cube_map_mipmaps result, faces in the DDS order
+    (+X, -X, +Y, -Y, +Z, -Z)."""
+    size = levels[0][0].shape[0]
+    header = struct.pack('<4s7I44x', b'DDS ', 124,
+        0x1 | 0x2 | 0x4 | 0x8 | 0x1000 | 0x20000, # CAPS, HEIGHT, WIDTH, PITCH, PIXELFORMAT, MIPMAPCOUNT
+        size, size, size * 4, 0, len(levels))
+    pixel_format = struct.pack('<2I4s5I', 32,
+        0x1 | 0x40, # ALPHAPIXELS, RGB
+        b'\0\0\0\0', 32, 0x000000ff, 0x0000ff00, 0x00ff0000, 0xff000000)
+    caps = struct.pack('<4I4x',
+        0x8 | 0x1000 | 0x400000, # COMPLEX, TEXTURE, MIPMAP
+        0x200 | 0xfc00, # CUBEMAP, all 6 faces
+        0, 0)
+    with open(filepath, 'wb') as f:
+        f.write(header + pixel_format + caps)
+        # DDS has all levels of each face
+        for face_index in range(6):
+            for level in levels:
+                f.write(cube_map_face_bytes(level[face_index]))
+
+def write_ktx(filepath, levels):
+    """Write cube map to KTX (version 1) file (uncompressed RGBA, 8 bits per channel).
+    levels are like the cube_map_mipmaps result, faces in the KTX order
+    (+X, -X, +Y, -Y, +Z, -Z)."""
+    size = levels[0][0].shape[0]
+    # state the row order (rows from the top) explicitly, padded to 4 bytes
+    orientation = b'KTXorientation\0S=r,T=d\0'
+    key_value_data = struct.pack('<I', len(orientation)) + orientation + \
+        b'\0' * (-len(orientation) % 4)
+    header = b'\xabKTX 11\xbb\r\n\x1a\n' + struct.pack('<13I',
+        0x04030201, # endianness
+        0x1401, 1, # GL_UNSIGNED_BYTE, type size
+        0x1908, 0x8058, 0x1908, # GL_RGBA, GL_RGBA8, GL_RGBA
+        size, size, 0, # width, height, depth
+        0, 6, len(levels), # array elements, faces, mipmap levels
+        len(key_value_data))
+    with open(filepath, 'wb') as f:
+        f.write(header + key_value_data)
+        # KTX has all faces of each level
+        for level in levels:
+            face_size = level[0].shape[0] * level[0].shape[1] * 4
+            f.write(struct.pack('<I', face_size))
+            for face in level:
+                f.write(cube_map_face_bytes(face))
+
+# Atlas layouts: (columns, rows, positions of sides as (column, row from the top)).
+# The cross has top above front, and bottom below front,
+# which matches the orientation of skybox sides (see X3D Background node).
+ATLAS_LAYOUTS = {
+    'STRIP': (6, 1, {'right': (0, 0), 'left': (1, 0), 'top': (2, 0),
+                     'bottom': (3, 0), 'front': (4, 0), 'back': (5, 0)}),
+    'CROSS': (4, 3, {'top': (1, 0),
+                     'left': (0, 1), 'front': (1, 1), 'right': (2, 1), 'back': (3, 1),
+                     'bottom': (1, 2)}),
+}
+
+def make_atlas(faces, layout):
+    """Place the skybox sides (dictionary name -> square image, all of equal size)
+    in a single image, according to layout (key of ATLAS_LAYOUTS).
+    Unused places are transparent black."""
+    (columns, rows, positions) = ATLAS_LAYOUTS[layout]
+    (size, _, channels) = next(iter(faces.values())).shape
+    atlas = numpy.zeros((rows * size, columns * size, max(channels, 4)))
+    for (name, (column, row)) in positions.items():
+        # rows of images are from the bottom
+        bottom = (rows - 1 - row) * size
+        atlas[bottom:bottom + size, column * size:(column + 1) * size, :channels] = faces[name]
+        if channels < 4:
+            atlas[bottom:bottom + size, column * size:(column + 1) * size, 3] = 1.0
+    return atlas
+
+def atlas_cube(layout, cameras_eulers, size):
+    """Geometry of a cube (with size 2, centered at origin) showing the skybox
+    from the atlas with given layout, like X3D Background shows the 6 sides.
+
+    cameras_eulers is a dictionary side name -> rotation of the camera that rendered it,
+    size is the size of each side (in pixels).
+    Returns a list of quads, each quad is 4 pairs of (X3D point, texture coordinate).
+    Texture coordinates are half a pixel inside the side, so that
+    bilinear filtering doesn't take pixels from the neighbour side in the atlas."""
+
+    (columns, rows, positions) = ATLAS_LAYOUTS[layout]
+    inset = 0.5 / size
+    quads = []
+    for (name, (column, row)) in positions.items():
+        matrix = euler_xyz_matrix(cameras_eulers[name])
+        quad = []
+        for (u, v) in ((0, 0), (1, 0), (1, 1), (0, 1)):
+            direction = matrix @ (u * 2.0 - 1.0, v * 2.0 - 1.0, -1.0)
+            # Blender world direction to the X3D direction in which
+            # X3D Background shows it
+            point = tuple(int(round(c)) for c in (-direction[0], direction[2], direction[1]))
+            tex_coord = ((column + inset + u * (1.0 - 2.0 * inset)) / columns,
+                         (rows - 1 - row + inset + v * (1.0 - 2.0 * inset)) / rows)
+            quad.append((point, tex_coord))
+        quads.append(quad)
+    return quads
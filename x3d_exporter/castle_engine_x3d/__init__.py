@@ -22,7 +22,7 @@ bl_info = {
     "name": "Web3D X3D/VRML2 format (Castle Game Engine Importer/Exporter)",
     "author": "Campbell Barton, Bart, Bastien Montagne, Seva Alekseyev, Michalis Kamburelis",
     "version": (1, 2, 0),
-    "blender": (2, 76, 0),
+    "blender": (2, 80, 0),
     "location": "File > Import-Export",
     "description": "Import-Export X3D",
     "warning": "",
@@ -40,30 +40,28 @@ if "bpy" in locals():
 import bpy
 from bpy.props import (
         BoolProperty,
-        EnumProperty,
         FloatProperty,
+        IntProperty,
         StringProperty,
         )
 from bpy_extras.io_utils import (
         ImportHelper,
         ExportHelper,
-        orientation_helper_factory,
+        orientation_helper,
         axis_conversion,
         path_reference_mode,
         )
 
 
-IOX3DOrientationHelper = orientation_helper_factory("IOX3DOrientationHelper", axis_forward='Z', axis_up='Y')
-
-
-class ImportX3D(bpy.types.Operator, ImportHelper, IOX3DOrientationHelper):
+@orientation_helper(axis_forward='Z', axis_up='Y')
+class ImportX3D(bpy.types.Operator, ImportHelper):
     """Import an X3D or VRML2 file"""
     bl_idname = "castle_import_scene.x3d"
     bl_label = "Import X3D/VRML2"
     bl_options = {'PRESET', 'UNDO'}
 
     filename_ext = ".x3d"
-    filter_glob = StringProperty(default="*.x3d;*.wrl", options={'HIDDEN'})
+    filter_glob: StringProperty(default="*.x3d;*.wrl", options={'HIDDEN'})
 
     def execute(self, context):
         from . import import_x3d
@@ -80,69 +78,91 @@ class ImportX3D(bpy.types.Operator, ImportHelper, IOX3DOrientationHelper):
         return import_x3d.load(context, **keywords)
 
 
-class ExportX3D(bpy.types.Operator, ExportHelper, IOX3DOrientationHelper):
+@orientation_helper(axis_forward='Z', axis_up='Y')
+class ExportX3D(bpy.types.Operator, ExportHelper):
     """Export selection to Extensible 3D file (.x3d)"""
     bl_idname = "castle_export_scene.x3d"
     bl_label = 'Export X3D'
     bl_options = {'PRESET'}
 
     filename_ext = ".x3d"
-    filter_glob = StringProperty(default="*.x3d", options={'HIDDEN'})
+    filter_glob: StringProperty(default="*.x3d", options={'HIDDEN'})
 
-    use_selection = BoolProperty(
+    use_selection: BoolProperty(
             name="Selection Only",
             description="Export selected objects only",
             default=False,
             )
-    use_mesh_modifiers = BoolProperty(
+    use_mesh_modifiers: BoolProperty(
             name="Apply Modifiers",
             description="Use transformed mesh data from each object",
             default=True,
             )
-    use_triangulate = BoolProperty(
+    use_triangulate: BoolProperty(
             name="Triangulate",
             description="Write quads into 'IndexedTriangleSet'",
             default=False,
             )
-    use_normals = BoolProperty(
+    use_normals: BoolProperty(
             name="Normals",
             description="Write normals with geometry",
             default=False,
             )
-    use_compress = BoolProperty(
+    use_compress: BoolProperty(
             name="Compress",
             description="Compress the exported file",
             default=False,
             )
-    use_hierarchy = BoolProperty(
+    use_hierarchy: BoolProperty(
             name="Hierarchy",
             description="Export parent child relationships",
             default=True,
             )
-    name_decorations = BoolProperty(
+    name_decorations: BoolProperty(
             name="Name decorations",
             description=("Add prefixes to the names of exported nodes to "
                          "indicate their type"),
             default=True,
             )
-    use_h3d = BoolProperty(
-            name="H3D Extensions",
-            description="Export shaders for H3D",
+    use_common_surface_shader: BoolProperty(
+            name="CommonSurfaceShader Extension",
+            description="Export material and textures to CommonSurfaceShader (in addition to standard Material). This is supported by at least InstantReality, X3DOM, View3dscene and Castle Game Engine. Allows to influence alpha / normal / specular by textures.",
             default=False,
             )
-    use_common_surface_shader = BoolProperty(
-            name="CommonSurfaceShader Extension",
-            description="Export material and textures to CommonSurfaceShader (in addition to standard Material). This is supported by at least InstantReality, X3DOM, View3dscene and Castle Game Engine. Allows to influence normal / specular / shininess / ambient by textures.",
+
+    coord_decimals: IntProperty(
+            name="Coordinate Decimals",
+            description="Number of decimal digits of vertex coordinates",
+            default=6, min=0, max=8,
+            )
+    normal_decimals: IntProperty(
+            name="Normal Decimals",
+            description="Number of decimal digits of vertex normals",
+            default=6, min=0, max=8,
+            )
+    uv_decimals: IntProperty(
+            name="Texture Coordinate Decimals",
+            description="Number of decimal digits of texture coordinates",
+            default=4, min=0, max=8,
+            )
+    color_decimals: IntProperty(
+            name="Color Decimals",
+            description="Number of decimal digits of vertex colors",
+            default=3, min=0, max=8,
+            )
+    strip_zeros: BoolProperty(
+            name="Strip Trailing Zeros",
+            description="Do not write trailing zeros of vertex coordinates, normals, texture coordinates and colors (makes the file smaller)",
             default=False,
             )
 
-    global_scale = FloatProperty(
+    global_scale: FloatProperty(
             name="Scale",
             min=0.01, max=1000.0,
             default=1.0,
             )
 
-    path_mode = path_reference_mode
+    path_mode: path_reference_mode
 
     def execute(self, context):
         from . import export_x3d
@@ -157,7 +177,7 @@ class ExportX3D(bpy.types.Operator, ExportHelper, IOX3DOrientationHelper):
                                             ))
         global_matrix = axis_conversion(to_forward=self.axis_forward,
                                         to_up=self.axis_up,
-                                        ).to_4x4() * Matrix.Scale(self.global_scale, 4)
+                                        ).to_4x4() @ Matrix.Scale(self.global_scale, 4)
         keywords["global_matrix"] = global_matrix
 
         return export_x3d.save(context, **keywords)
@@ -173,18 +193,26 @@ def menu_func_export(self, context):
                          text="X3D Extensible 3D (.x3d) (Castle Game Engine Exporter)")
 
 
+classes = (
+    ImportX3D,
+    ExportX3D,
+)
+
+
 def register():
-    bpy.utils.register_module(__name__)
+    for cls in classes:
+        bpy.utils.register_class(cls)
 
-    bpy.types.INFO_MT_file_import.append(menu_func_import)
-    bpy.types.INFO_MT_file_export.append(menu_func_export)
+    bpy.types.TOPBAR_MT_file_import.append(menu_func_import)
+    bpy.types.TOPBAR_MT_file_export.append(menu_func_export)
 
 
 def unregister():
-    bpy.utils.unregister_module(__name__)
+    bpy.types.TOPBAR_MT_file_import.remove(menu_func_import)
+    bpy.types.TOPBAR_MT_file_export.remove(menu_func_export)
 
-    bpy.types.INFO_MT_file_import.remove(menu_func_import)
-    bpy.types.INFO_MT_file_export.remove(menu_func_export)
+    for cls in classes:
+        bpy.utils.unregister_class(cls)
 
 # NOTES
 # - blender version is hardcoded
@@ -39,13 +39,19 @@ import os
 import bpy
 import mathutils
 
-from bpy_extras.io_utils import create_derived_objects, free_derived_objects
+from bpy_extras.node_shader_utils import PrincipledBSDFWrapper
 
 
-# h3d defines
-H3D_TOP_LEVEL = 'TOP_LEVEL_TI'
-H3D_CAMERA_FOLLOW = 'CAMERA_FOLLOW_TRANSFORM'
-H3D_VIEW_MATRIX = 'view_matrix'
+# CommonSurfaceShader texture fields, with the corresponding
+# PrincipledBSDFWrapper textures.
+# Keep in alphabetic order, like on
+# https://castle-engine.sourceforge.io/x3d_implementation_texturing_extensions.php#section_ext_common_surface_shader
+COMMON_SURFACE_SHADER_TEXTURES = (
+    ('alphaTexture', 'alpha_texture'),
+    ('diffuseTexture', 'base_color_texture'),
+    ('normalTexture', 'normalmap_texture'),
+    ('specularTexture', 'specular_texture'),
+)
 
 
 def clamp_color(col):
@@ -53,7 +59,7 @@ def clamp_color(col):
 
 
 def matrix_direction_neg_z(matrix):
-    return (matrix.to_3x3() * mathutils.Vector((0.0, 0.0, -1.0))).normalized()[:]
+    return (matrix.to_3x3() @ mathutils.Vector((0.0, 0.0, -1.0))).normalized()[:]
 
 
 def prefix_quoted_str(value, prefix):
@@ -126,6 +132,52 @@ def clean_def(txt):
         })
 
 
+def object_transform_matrix(obj, obj_parent, global_matrix):
+    """Matrix of the object Transform node, when exporting hierarchy.
+    obj_parent is the exported parent (see build_hierarchy), or None.
+    """
+    if obj_parent:
+        return obj_parent.matrix_world.inverted(mathutils.Matrix()) @ obj.matrix_world
+    else:
+        return global_matrix @ obj.matrix_world
+
+
+def transform_fields(matrix):
+    """Decompose matrix into X3D Transform fields:
+    translation (3 floats), rotation (axis-angle, 4 floats) and scale (3 floats).
+    """
+    loc, rot, sca = matrix.decompose()
+    rot = rot.to_axis_angle()
+    rot = (*rot[0], rot[1])
+    return loc[:], rot, sca[:]
+
+
+def float_formatter(decimals, strip_zeros=False):
+    """Return a function converting a sequence of floats to a string,
+    each float with given number of decimal digits and followed by a space.
+    With strip_zeros, trailing zeros (and dot) of each float are removed.
+    """
+    number_format = '%%.%df' % decimals
+    if strip_zeros and decimals > 0:
+        def format_floats(values):
+            result = ''
+            for value in values:
+                number = (number_format % value).rstrip('0').rstrip('.')
+                if number == '-0':
+                    number = '0'
+                result += number + ' '
+            return result
+    else:
+        values_formats = {}
+        def format_floats(values):
+            values = tuple(values)
+            values_format = values_formats.get(len(values))
+            if values_format is None:
+                values_format = values_formats[len(values)] = (number_format + ' ') * len(values)
+            return values_format % values
+    return format_floats
+
+
 def build_hierarchy(objects):
     """ returns parent child relationships, skipping
     """
@@ -147,87 +199,82 @@ def build_hierarchy(objects):
     return par_lookup.get(None, [])
 
 
-# -----------------------------------------------------------------------------
-# H3D Functions
-# -----------------------------------------------------------------------------
-def h3d_shader_glsl_frag_patch(filepath, scene, global_vars, frag_uniform_var_map):
-    h3d_file = open(filepath, 'r', encoding='utf-8')
-    lines = []
-
-    last_transform = None
-
-    for l in h3d_file:
-        if l.startswith("void main(void)"):
-            lines.append("\n")
-            lines.append("// h3d custom vars begin\n")
-            for v in global_vars:
-                lines.append("%s\n" % v)
-            lines.append("// h3d custom vars end\n")
-            lines.append("\n")
-        elif l.lstrip().startswith("lamp_visibility_other("):
-            w = l.split(', ')
-            last_transform = w[1] + "_transform"  # XXX - HACK!!!
-            w[1] = '(view_matrix * %s_transform * vec4(%s.x, %s.y, %s.z, 1.0)).xyz' % (w[1], w[1], w[1], w[1])
-            l = ", ".join(w)
-        elif l.lstrip().startswith("lamp_visibility_sun_hemi("):
-            w = l.split(', ')
-            w[0] = w[0][len("lamp_visibility_sun_hemi(") + 1:]
-
-            if not h3d_is_object_view(scene, frag_uniform_var_map[w[0]]):
-                w[0] = '(mat3(normalize(view_matrix[0].xyz), normalize(view_matrix[1].xyz), normalize(view_matrix[2].xyz)) * -%s)' % w[0]
-            else:
-                w[0] = ('(mat3(normalize((view_matrix*%s)[0].xyz), normalize((view_matrix*%s)[1].xyz), normalize((view_matrix*%s)[2].xyz)) * -%s)' %
-                        (last_transform, last_transform, last_transform, w[0]))
-
-            l = "\tlamp_visibility_sun_hemi(" + ", ".join(w)
-        elif l.lstrip().startswith("lamp_visibility_spot_circle("):
-            w = l.split(', ')
-            w[0] = w[0][len("lamp_visibility_spot_circle(") + 1:]
-
-            if not h3d_is_object_view(scene, frag_uniform_var_map[w[0]]):
-                w[0] = '(mat3(normalize(view_matrix[0].xyz), normalize(view_matrix[1].xyz), normalize(view_matrix[2].xyz)) * -%s)' % w[0]
-            else:
-                w[0] = ('(mat3(normalize((view_matrix*%s)[0].xyz), normalize((view_matrix*%s)[1].xyz), normalize((view_matrix*%s)[2].xyz)) * %s)' %
-                    (last_transform, last_transform, last_transform, w[0]))
-
-            l = "\tlamp_visibility_spot_circle(" + ", ".join(w)
-
-        lines.append(l)
-
-    h3d_file.close()
-
-    h3d_file = open(filepath, 'w', encoding='utf-8')
-    h3d_file.writelines(lines)
-    h3d_file.close()
-
-
-def h3d_is_object_view(scene, obj):
-    camera = scene.camera
-    parent = obj.parent
-    while parent:
-        if parent == camera:
-            return True
-        parent = parent.parent
-    return False
-
-
 # -----------------------------------------------------------------------------
 # Functions for writing output file
 # -----------------------------------------------------------------------------
 
 def export(file,
            global_matrix,
+           depsgraph,
            scene,
+           view_layer,
            use_mesh_modifiers=False,
            use_selection=True,
            use_triangulate=False,
            use_normals=False,
            use_hierarchy=True,
-           use_h3d=False,
            use_common_surface_shader=False,
            path_mode='AUTO',
            name_decorations=True,
+           use_xml_prolog=True,
+           inline_meshes=None,
+           inline_meshes_written=None,
+           object_transform_ids=None,
+           object_coordinate_ids=None,
+           write_scene_extra=None,
+           reuse_geometry=None,
+           coord_decimals=6,
+           normal_decimals=6,
+           uv_decimals=4,
+           color_decimals=3,
+           strip_zeros=False,
            ):
+    """Write the scene as X3D to the file.
+
+    The file may be any object with write() method and name attribute
+    (name is used to calculate relative paths to textures).
+    It is not closed by this function.
+
+    depsgraph should be the evaluated dependency graph of the scene
+    (like context.evaluated_depsgraph_get()), it is used to apply modifiers
+    and to get instances (particles, instanced collections).
+    view_layer determines which objects are visible and selected.
+
+    Pass use_xml_prolog=False to omit the XML declaration and DOCTYPE,
+    e.g. when the X3D is written inside a larger XML document
+    (like castle-anim-frames).
+
+    inline_meshes may map object names to URLs (relative to the file)
+    of separate X3D files with the geometry of these objects.
+    The geometry is then referenced by Inline, instead of being written
+    to the file. The separate X3D file is written only when the object name
+    is not yet in inline_meshes_written set (and then it is added there).
+    This allows to share the same geometry among many files.
+
+    If object_transform_ids is a dictionary, it is filled with
+    object names mapped to the (quoted) DEF names of their Transform nodes
+    (only when use_hierarchy).
+
+    If object_coordinate_ids is a dictionary, it is filled with
+    object names mapped to pairs (quoted DEF name of Coordinate node,
+    quoted DEF name of Normal node or None) with their mesh vertices
+    (only when not use_triangulate, as then vertices are not shared).
+
+    If write_scene_extra is set, it is called as write_scene_extra(fw, ident)
+    at the end of the Scene, to write additional nodes and routes.
+
+    If reuse_geometry is set, it is called as reuse_geometry(obj, name, calculate)
+    to get the parts of the mesh geometry (like the coordinates string)
+    of the object. It should return calculate() result, or the result
+    remembered for the same object and name from the previous export,
+    if the object geometry (and the export settings) did not change since then.
+    This allows to export many animation frames quickly.
+
+    coord_decimals, normal_decimals, uv_decimals, color_decimals
+    are the numbers of decimal digits of the mesh vertex coordinates,
+    normals, texture coordinates and colors.
+    With strip_zeros, their trailing zeros are not written.
+    """
 
     # -------------------------------------------------------------------------
     # Global Setup
@@ -285,20 +332,31 @@ def export(file,
     # store files to copy
     copy_set = set()
 
+    format_coord = float_formatter(coord_decimals, strip_zeros)
+    format_normal = float_formatter(normal_decimals, strip_zeros)
+    format_uv = float_formatter(uv_decimals, strip_zeros)
+    format_color = float_formatter(color_decimals, strip_zeros)
+
     # store names of newly cerated meshes, so we dont overlap
     mesh_name_set = set()
 
+    # materials wrapped by PrincipledBSDFWrapper (see material_wrapper)
+    material_wrappers = {}
+
+    # store materials and images already written (with DEF),
+    # next time they are written with USE.
+    # Note: not using material.tag, as it is not reliable for materials
+    # of temporary meshes (to_mesh) in Blender 2.8.
+    written_materials = set()
+    written_images = set()
+
+    # temporary meshes of instanced (dupli) objects, created once
+    # and shared by all instances, removed at the end of export
+    instance_meshes = {}
+
     fw = file.write
     base_src = os.path.dirname(bpy.data.filepath)
     base_dst = os.path.dirname(file.name)
-    filename_strip = os.path.splitext(os.path.basename(file.name))[0]
-    gpu_shader_cache = {}
-
-    if use_h3d:
-        import gpu
-        gpu_shader_dummy_mat = bpy.data.materials.new('X3D_DYMMY_MAT')
-        gpu_shader_cache[None] = gpu.export_shader(scene, gpu_shader_dummy_mat)
-        h3d_material_route = []
 
     # -------------------------------------------------------------------------
     # File Writing Functions
@@ -308,12 +366,10 @@ def export(file,
         filepath_quoted = quoteattr(os.path.basename(file.name))
         blender_ver_quoted = quoteattr('Blender %s' % bpy.app.version_string)
 
-        fw('%s<?xml version="1.0" encoding="UTF-8"?>\n' % ident)
-        if use_h3d:
-            fw('%s<X3D profile="H3DAPI" version="1.4">\n' % ident)
-        else:
+        if use_xml_prolog:
+            fw('%s<?xml version="1.0" encoding="UTF-8"?>\n' % ident)
             fw('%s<!DOCTYPE X3D PUBLIC "ISO//Web3D//DTD X3D 3.0//EN" "http://www.web3d.org/specifications/x3d-3.0.dtd">\n' % ident)
-            fw('%s<X3D version="3.0" profile="Immersive" xmlns:xsd="http://www.w3.org/2001/XMLSchema-instance" xsd:noNamespaceSchemaLocation="http://www.web3d.org/specifications/x3d-3.0.xsd">\n' % ident)
+        fw('%s<X3D version="3.0" profile="Immersive" xmlns:xsd="http://www.w3.org/2001/XMLSchema-instance" xsd:noNamespaceSchemaLocation="http://www.web3d.org/specifications/x3d-3.0.xsd">\n' % ident)
 
         ident += '\t'
         fw('%s<head>\n' % ident)
@@ -327,19 +383,9 @@ def export(file,
         fw('%s<Scene>\n' % ident)
         ident += '\t'
 
-        if use_h3d:
-            # outputs the view matrix in glModelViewMatrix field
-            fw('%s<TransformInfo DEF="%s" outputGLMatrices="true" />\n' % (ident, H3D_TOP_LEVEL))
-
         return ident
 
     def writeFooter(ident):
-
-        if use_h3d:
-            # global
-            for route in h3d_material_route:
-                fw('%s%s\n' % (ident, route))
-
         ident = ident[:-1]
         fw('%s</Scene>\n' % ident)
         ident = ident[:-1]
@@ -362,18 +408,20 @@ def export(file,
         fw(ident_step + 'fieldOfView="%.3f"\n' % obj.data.angle)
         fw(ident_step + '/>\n')
 
-    def writeFog(ident, world):
+    def writeFog(ident, world, view_layer):
         if world:
             mtype = world.mist_settings.falloff
             mparam = world.mist_settings
         else:
             return
 
-        if mparam.use_mist:
+        # Blender 2.80 has no "use mist" toggle in the world,
+        # the mist is used when the view layer has the mist pass.
+        if view_layer.use_pass_mist:
             ident_step = ident + (' ' * (-len(ident) + \
             fw('%s<Fog ' % ident)))
             fw('fogType="%s"\n' % ('LINEAR' if (mtype == 'LINEAR') else 'EXPONENTIAL'))
-            fw(ident_step + 'color="%.3f %.3f %.3f"\n' % clamp_color(world.horizon_color))
+            fw(ident_step + 'color="%.3f %.3f %.3f"\n' % clamp_color(world.color))
             fw(ident_step + 'visibilityRange="%.3f"\n' % mparam.depth)
             fw(ident_step + '/>\n')
         else:
@@ -396,13 +444,11 @@ def export(file,
         else:
             fw('\n')
 
-        loc, rot, sca = matrix.decompose()
-        rot = rot.to_axis_angle()
-        rot = (*rot[0], rot[1])
+        loc, rot, sca = transform_fields(matrix)
 
-        fw(ident_step + 'translation="%.6f %.6f %.6f"\n' % loc[:])
+        fw(ident_step + 'translation="%.6f %.6f %.6f"\n' % loc)
         # fw(ident_step + 'center="%.6f %.6f %.6f"\n' % (0, 0, 0))
-        fw(ident_step + 'scale="%.6f %.6f %.6f"\n' % sca[:])
+        fw(ident_step + 'scale="%.6f %.6f %.6f"\n' % sca)
         fw(ident_step + 'rotation="%.6f %.6f %.6f %.6f"\n' % rot)
         fw(ident_step + '>\n')
         ident += '\t'
@@ -413,16 +459,20 @@ def export(file,
         fw('%s</Transform>\n' % ident)
         return ident
 
+    # Blender 2.80 world has no separate ambient color,
+    # the world color lights the scene instead.
+    def world_ambient_intensity(world):
+        if world:
+            ambi = world.color
+            return ((ambi[0] + ambi[1] + ambi[2]) / 3.0) / 2.5
+        else:
+            return 0.0
+
     def writeSpotLight(ident, obj, matrix, lamp, world):
         # note, lamp_id is not re-used
         lamp_id = quoteattr(unique_name(obj, LA_ + obj.name, uuid_cache_lamp, clean_func=clean_def, sep="_"))
 
-        if world:
-            ambi = world.ambient_color
-            amb_intensity = ((ambi[0] + ambi[1] + ambi[2]) / 3.0) / 2.5
-            del ambi
-        else:
-            amb_intensity = 0.0
+        amb_intensity = world_ambient_intensity(world)
 
         # compute cutoff and beamwidth
         intensity = min(lamp.energy / 1.75, 1.0)
@@ -453,13 +503,7 @@ def export(file,
         # note, lamp_id is not re-used
         lamp_id = quoteattr(unique_name(obj, LA_ + obj.name, uuid_cache_lamp, clean_func=clean_def, sep="_"))
 
-        if world:
-            ambi = world.ambient_color
-            # ambi = world.amb
-            amb_intensity = ((float(ambi[0] + ambi[1] + ambi[2])) / 3.0) / 2.5
-        else:
-            ambi = 0
-            amb_intensity = 0.0
+        amb_intensity = world_ambient_intensity(world)
 
         intensity = min(lamp.energy / 1.75, 1.0)
 
@@ -483,13 +527,7 @@ def export(file,
         # note, lamp_id is not re-used
         lamp_id = quoteattr(unique_name(obj, LA_ + obj.name, uuid_cache_lamp, clean_func=clean_def, sep="_"))
 
-        if world:
-            ambi = world.ambient_color
-            # ambi = world.amb
-            amb_intensity = ((float(ambi[0] + ambi[1] + ambi[2])) / 3.0) / 2.5
-        else:
-            ambi = 0.0
-            amb_intensity = 0.0
+        amb_intensity = world_ambient_intensity(world)
 
         intensity = min(lamp.energy / 1.75, 1.0)
         location = matrix.to_translation()[:]
@@ -505,18 +543,64 @@ def export(file,
         fw(ident_step + 'location="%.4f %.4f %.4f"\n' % location)
         fw(ident_step + '/>\n')
 
-    def writeIndexedFaceSet(ident, obj, mesh, matrix, world):
+    def writeInlineMesh_begin(obj, mesh, url):
+        """Redirect writing to a new X3D file, that will contain only
+        the mesh geometry (to be referenced by Inline).
+        Returns indentation and state to pass to writeInlineMesh_end."""
+        nonlocal fw
+
+        # The new file must define (DEF) everything it uses,
+        # regardless of what was already written to the main file.
+        # So temporarily reset what is "already written".
+        written_main = (mesh, mesh.tag, set(written_materials), set(written_images))
+        mesh.tag = False
+        written_materials.clear()
+        written_images.clear()
+
+        # Write to a temporary file and rename it at the end,
+        # to allow many processes to safely write the same file at once.
+        inline_file_path = os.path.join(base_dst, url)
+        inline_file = open('%s.tmp%d' % (inline_file_path, os.getpid()), 'w', encoding='utf-8')
+        fw_main = fw
+        fw = inline_file.write
+
+        fw('<?xml version="1.0" encoding="UTF-8"?>\n')
+        fw('<!DOCTYPE X3D PUBLIC "ISO//Web3D//DTD X3D 3.0//EN" "http://www.web3d.org/specifications/x3d-3.0.dtd">\n')
+        fw('<X3D version="3.0" profile="Immersive" xmlns:xsd="http://www.w3.org/2001/XMLSchema-instance" xsd:noNamespaceSchemaLocation="http://www.web3d.org/specifications/x3d-3.0.xsd">\n')
+        fw('\t<Scene>\n')
+
+        return '\t\t', (inline_file, inline_file_path, fw_main, written_main)
+
+    def writeInlineMesh_end(obj, state):
+        """Finish writing X3D file started by writeInlineMesh_begin."""
+        nonlocal fw
+        inline_file, inline_file_path, fw_main, written_main = state
+
+        fw('\t</Scene>\n')
+        fw('</X3D>\n')
+        inline_file.close()
+        os.replace(inline_file.name, inline_file_path)
+
+        fw = fw_main
+        mesh, mesh_tag, written_materials_main, written_images_main = written_main
+        mesh.tag = mesh_tag
+        written_materials.clear()
+        written_materials.update(written_materials_main)
+        written_images.clear()
+        written_images.update(written_images_main)
+        inline_meshes_written.add(obj.name)
+
+    def writeIndexedFaceSet(ident, obj, mesh, mesh_key, mesh_name, matrix, world, is_instance=False):
+        # mesh_key identifies the mesh for DEF names, it is not the mesh itself
+        # for temporary meshes (from to_mesh), as the same memory may be reused
+        # for the next temporary mesh.
         obj_id = quoteattr(unique_name(obj, OB_ + obj.name, uuid_cache_object, clean_func=clean_def, sep="_"))
-        mesh_id = quoteattr(unique_name(mesh, ME_ + mesh.name, uuid_cache_mesh, clean_func=clean_def, sep="_"))
+        mesh_id = quoteattr(unique_name(mesh_key, ME_ + mesh_name, uuid_cache_mesh, clean_func=clean_def, sep="_"))
         mesh_id_group = prefix_quoted_str(mesh_id, group_)
         mesh_id_coords = prefix_quoted_str(mesh_id, 'coords_')
         mesh_id_normals = prefix_quoted_str(mesh_id, 'normals_')
 
-        # tessellation faces may not exist
-        if not mesh.tessfaces and mesh.polygons:
-            mesh.update(calc_tessface=True)
-
-        if not mesh.tessfaces:
+        if not mesh.polygons:
             return
 
         use_collnode = bool([mod for mod in obj.modifiers
@@ -529,112 +613,78 @@ def export(file,
 
         # use _ifs_TRANSFORM suffix so we dont collide with transform node when
         # hierarchys are used.
-        ident = writeTransform_begin(ident, matrix, suffix_quoted_str(obj_id, "_ifs" + _TRANSFORM))
+        # Instances of the same object would have the same DEF name,
+        # so they are written without DEF.
+        ident = writeTransform_begin(ident, matrix,
+            None if is_instance else suffix_quoted_str(obj_id, "_ifs" + _TRANSFORM))
+
+        inline_url = inline_meshes.get(obj.name) if inline_meshes else None
+
+        if inline_url is not None:
+            fw('%s<Inline url=\'"%s"\' />\n' % (ident, escape(inline_url)))
 
-        if mesh.tag:
+        if inline_url is not None and obj.name in inline_meshes_written:
+            pass
+        elif mesh.tag and inline_url is None:
             fw('%s<Group USE=%s />\n' % (ident, mesh_id_group))
         else:
+            if inline_url is not None:
+                ident_before_inline = ident
+                ident, inline_state = writeInlineMesh_begin(obj, mesh, inline_url)
+
             mesh.tag = True
 
             fw('%s<Group DEF=%s>\n' % (ident, mesh_id_group))
             ident += '\t'
 
-            is_uv = bool(mesh.tessface_uv_textures.active)
-            # is_col, defined for each material
+            is_uv = bool(mesh.uv_layers.active)
+            is_col = bool(mesh.vertex_colors.active)
 
             is_coords_written = False
 
+            def calculate_geometry(name, calculate):
+                # calculate() result depends only on the mesh geometry,
+                # so it may be reused from the previous export
+                if reuse_geometry is None:
+                    return calculate()
+                return reuse_geometry(obj, name, calculate)
+
             mesh_materials = mesh.materials[:]
             if not mesh_materials:
                 mesh_materials = [None]
 
-            mesh_material_texture_diffuse = [None] * len(mesh_materials)
-            mesh_material_texture_diffuse_slot = [None] * len(mesh_materials)
-            mesh_material_texture_diffuse_images = [None] * len(mesh_materials)
-            # Additional texture types, only for CommonSurfaceShader.
-            # Keep in alphabetic order, like on
-            # https://castle-engine.sourceforge.io/x3d_implementation_texturing_extensions.php#section_ext_common_surface_shader
-            # For now, other texture types don't need to know the _slot
-            # (or _image, which is only a shortcut).
-            mesh_material_texture_alpha = [None] * len(mesh_materials)
-            mesh_material_texture_ambient = [None] * len(mesh_materials)
-            mesh_material_texture_displacement = [None] * len(mesh_materials)
-            mesh_material_texture_displacement_factor = [None] * len(mesh_materials)
-            mesh_material_texture_normal = [None] * len(mesh_materials)
-            mesh_material_texture_shininess = [None] * len(mesh_materials)
-            mesh_material_texture_specular = [None] * len(mesh_materials)
-
-            for i, material in enumerate(mesh_materials):
+            # Textures of each material, mapping CommonSurfaceShader
+            # texture fields to ShaderImageTextureWrapper.
+            # If not use_common_surface_shader then only the diffuse
+            # (base color) texture is used.
+            mesh_material_textures = []
+            for material in mesh_materials:
+                material_textures = {}
                 if material:
-                    for texture_slot in material.texture_slots:
-                        if texture_slot:
-                            tex = texture_slot.texture
-                            if tex and tex.type == 'IMAGE' and tex.image:
-                                if use_common_surface_shader:
-                                    if texture_slot.use_map_alpha and not mesh_material_texture_alpha[i]:
-                                        mesh_material_texture_alpha[i] = tex
-                                    if texture_slot.use_map_ambient and not mesh_material_texture_ambient[i]:
-                                        mesh_material_texture_ambient[i] = tex
-                                    if texture_slot.use_map_color_diffuse and not mesh_material_texture_diffuse[i]:
-                                        mesh_material_texture_diffuse[i] = tex
-                                        mesh_material_texture_diffuse_slot[i] = texture_slot
-                                        mesh_material_texture_diffuse_images[i] = tex.image
-                                    if texture_slot.use_map_displacement and not mesh_material_texture_displacement[i]:
-                                        mesh_material_texture_displacement[i] = tex
-                                        mesh_material_texture_displacement_factor[i] = texture_slot.displacement_factor
-                                    if texture_slot.use_map_normal and not mesh_material_texture_normal[i]:
-                                        mesh_material_texture_normal[i] = tex
-                                    if texture_slot.use_map_hardness and not mesh_material_texture_shininess[i]:
-                                        mesh_material_texture_shininess[i] = tex
-                                    if texture_slot.use_map_color_spec and not mesh_material_texture_specular[i]:
-                                        mesh_material_texture_specular[i] = tex
-                                else:
-                                    # if not use_common_surface_shader then
-                                    # (for backward compatibility) accept the first IMAGE texture
-                                    # (without looking at the "Influence" field) as diffuse.
-                                    mesh_material_texture_diffuse[i] = tex
-                                    mesh_material_texture_diffuse_slot[i] = texture_slot
-                                    mesh_material_texture_diffuse_images[i] = tex.image
-                                    break
-
-            mesh_materials_use_face_texture = [getattr(material, 'use_face_texture', True) for material in mesh_materials]
+                    wrapper = material_wrapper(material)
+                    for field, wrapper_texture in COMMON_SURFACE_SHADER_TEXTURES:
+                        if use_common_surface_shader or field == 'diffuseTexture':
+                            texture = getattr(wrapper, wrapper_texture)
+                            if texture and texture.image:
+                                material_textures[field] = texture
+                mesh_material_textures.append(material_textures)
 
             # fast access!
             mesh_vertices = mesh.vertices[:]
-            mesh_faces = mesh.tessfaces[:]
-            mesh_faces_materials = [f.material_index for f in mesh_faces]
-            mesh_faces_vertices = [f.vertices[:] for f in mesh_faces]
-
-            if is_uv and True in mesh_materials_use_face_texture:
-                mesh_faces_image = [(fuv.image
-                                     if mesh_materials_use_face_texture[mesh_faces_materials[i]]
-                                     else mesh_material_texture_diffuse_images[mesh_faces_materials[i]])
-                                     for i, fuv in enumerate(mesh.tessface_uv_textures.active.data)]
-
-                mesh_faces_image_unique = set(mesh_faces_image)
-            elif len(set(mesh_material_texture_diffuse_images) | {None}) > 1:  # make sure there is at least one image
-                mesh_faces_image = [mesh_material_texture_diffuse_images[material_index] for material_index in mesh_faces_materials]
-                mesh_faces_image_unique = set(mesh_faces_image)
-            else:
-                mesh_faces_image = [None] * len(mesh_faces)
-                mesh_faces_image_unique = {None}
-
-            # group faces
-            face_groups = {}
-            for material_index in range(len(mesh_materials)):
-                for image in mesh_faces_image_unique:
-                    face_groups[material_index, image] = []
-            del mesh_faces_image_unique
-
-            for i, (material_index, image) in enumerate(zip(mesh_faces_materials, mesh_faces_image)):
-                face_groups[material_index, image].append(i)
+            mesh_polygons = mesh.polygons[:]
+            mesh_polygons_materials = [p.material_index for p in mesh_polygons]
+            mesh_polygons_vertices = [p.vertices[:] for p in mesh_polygons]
+            mesh_polygons_loops = [p.loop_indices for p in mesh_polygons]
 
-            # same as face_groups.items() but sorted so we can get predictable output.
-            face_groups_items = list(face_groups.items())
-            face_groups_items.sort(key=lambda m: (m[0][0], getattr(m[0][1], 'name', '')))
+            # group polygons, Blender 2.80 meshes have no per-face images,
+            # so the image depends only on the material
+            polygon_groups = [[] for material in mesh_materials]
+            for i, material_index in enumerate(mesh_polygons_materials):
+                # material_index may be invalid, if the mesh has less materials
+                polygon_groups[min(material_index, len(mesh_materials) - 1)].append(i)
 
-            is_col = (mesh.tessface_vertex_colors.active and (material is None or material.use_vertex_color_paint))
-            mesh_faces_col = mesh.tessface_vertex_colors.active.data if is_col else None
+            mesh_loops_uv = mesh.uv_layers.active.data if is_uv else None
+            mesh_loops_col = mesh.vertex_colors.active.data if is_col else None
 
             # Check if vertex colors can be exported in per-vertex mode.
             # Do we have just one color per vertex in every face that uses the vertex?
@@ -642,23 +692,102 @@ def export(file,
                 def calc_vertex_color():
                     vert_color = [None] * len(mesh.vertices)
 
-                    for i, face in enumerate(mesh_faces):
-                        fcol = mesh_faces_col[i]
-                        face_colors = (fcol.color1, fcol.color2, fcol.color3, fcol.color4)
-                        for j, vert_index in enumerate(face.vertices):
-                            if vert_color[vert_index] is None:
-                                vert_color[vert_index] = face_colors[j][:]
-                            elif vert_color[vert_index] != face_colors[j][:]:
-                                return False, ()
+                    for loop in mesh.loops:
+                        color = mesh_loops_col[loop.index].color[:3]
+                        if vert_color[loop.vertex_index] is None:
+                            vert_color[loop.vertex_index] = color
+                        elif vert_color[loop.vertex_index] != color:
+                            return False, ()
 
                     return True, vert_color
 
-                is_col_per_vertex, vert_color = calc_vertex_color()
+                is_col_per_vertex, vert_color = calculate_geometry('vertex_color', calc_vertex_color)
                 del calc_vertex_color
 
-            for (material_index, image), face_group in face_groups_items:  # face_groups.items()
-                if face_group:
+            if use_triangulate:
+                def calc_polygons_loop_triangles():
+                    mesh.calc_loop_triangles()
+                    polygons_loop_triangles = [[] for p in mesh_polygons]
+                    for loop_triangle in mesh.loop_triangles:
+                        polygons_loop_triangles[loop_triangle.polygon_index].append(loop_triangle)
+                    return polygons_loop_triangles
+
+                # calculated only when some triangles are not reused
+                polygons_loop_triangles = None
+
+                def calc_triangle_set(polygon_group, is_normals):
+                    # Returns strings with index, Coordinate points,
+                    # Normal vectors, TextureCoordinate points and Color colors
+                    # (the last three are None if not written).
+                    nonlocal polygons_loop_triangles
+                    if polygons_loop_triangles is None:
+                        polygons_loop_triangles = calc_polygons_loop_triangles()
+
+                    slot_uv = None
+                    slot_col = None
+
+                    if is_uv and is_col:
+                        slot_uv = 0
+                        slot_col = 1
+
+                        def vertex_key(lidx):
+                            return (
+                                mesh_loops_uv[lidx].uv[:],
+                                mesh_loops_col[lidx].color[:3],
+                            )
+                    elif is_uv:
+                        slot_uv = 0
+
+                        def vertex_key(lidx):
+                            return (
+                                mesh_loops_uv[lidx].uv[:],
+                            )
+                    elif is_col:
+                        slot_col = 0
+
+                        def vertex_key(lidx):
+                            return (
+                                mesh_loops_col[lidx].color[:3],
+                            )
+                    else:
+                        # ack, not especially efficient in this case
+                        def vertex_key(lidx):
+                            return None
+
+                    # build a mesh mapping dict
+                    vertex_hash = [{} for i in range(len(mesh.vertices))]
+                    face_tri_list = []
+                    vert_tri_list = []
+                    totvert = 0
+                    for i in polygon_group:
+                        for loop_triangle in polygons_loop_triangles[i]:
+                            f_tri = []
+                            for lidx, v_idx in zip(loop_triangle.loops, loop_triangle.vertices):
+                                key = vertex_key(lidx)
+                                vh = vertex_hash[v_idx]
+                                x3d_v = vh.get(key)
+                                if x3d_v is None:
+                                    x3d_v = key, v_idx, totvert
+                                    vh[key] = x3d_v
+                                    # key / original_vertex / new_vertex
+                                    vert_tri_list.append(x3d_v)
+                                    totvert += 1
+                                f_tri.append(x3d_v)
+                            face_tri_list.append(f_tri)
+
+                    return (
+                        ''.join('%i %i %i ' % (x3d_f[0][2], x3d_f[1][2], x3d_f[2][2]) for x3d_f in face_tri_list),
+                        ''.join(format_coord(mesh_vertices[x3d_v[1]].co) for x3d_v in vert_tri_list),
+                        ''.join(format_normal(mesh_vertices[x3d_v[1]].normal) for x3d_v in vert_tri_list)
+                            if is_normals else None,
+                        ''.join(format_uv(x3d_v[0][slot_uv]) for x3d_v in vert_tri_list) if is_uv else None,
+                        ''.join(format_color(x3d_v[0][slot_col]) for x3d_v in vert_tri_list) if is_col else None,
+                    )
+
+            for material_index, polygon_group in enumerate(polygon_groups):
+                if polygon_group:
                     material = mesh_materials[material_index]
+                    material_textures = mesh_material_textures[material_index]
 
                     fw('%s<Shape>\n' % ident)
                     ident += '\t'
@@ -666,8 +795,8 @@ def export(file,
                     is_smooth = False
 
                     # kludge but as good as it gets!
-                    for i in face_group:
-                        if mesh_faces[i].use_smooth:
+                    for i in polygon_group:
+                        if mesh_polygons[i].use_smooth:
                             is_smooth = True
                             break
 
@@ -678,165 +807,54 @@ def export(file,
                     # IndexedTriangleSet can have only all smooth/all flat shading).
                     is_force_normals = use_triangulate and (is_smooth or is_uv or is_col)
 
-                    if use_h3d:
-                        gpu_shader = gpu_shader_cache.get(material)  # material can be 'None', uses dummy cache
-                        if gpu_shader is None:
-                            gpu_shader = gpu_shader_cache[material] = gpu.export_shader(scene, material)
-
-                            if 1:  # XXX DEBUG
-                                gpu_shader_tmp = gpu.export_shader(scene, material)
-                                import pprint
-                                print('\nWRITING MATERIAL:', material.name)
-                                del gpu_shader_tmp['fragment']
-                                del gpu_shader_tmp['vertex']
-                                pprint.pprint(gpu_shader_tmp, width=120)
-                                #pprint.pprint(val['vertex'])
-                                del gpu_shader_tmp
-
                     fw('%s<Appearance>\n' % ident)
                     ident += '\t'
 
-                    if image and not use_h3d:
-                        writeImageTexture(ident, image)
-
-                        if mesh_materials_use_face_texture[material_index]:
-                            if image.use_tiles:
-                                fw('%s<TextureTransform scale="%s %s" />\n' % (ident, image.tiles_x, image.tiles_y))
-                        else:
-                            # transform by texture_slot
-                            loc = mesh_material_texture_diffuse_slot[material_index].offset[:2]
-
-                            # texture_slot.scale * tex_repeat
-                            sca_x, sca_y = mesh_material_texture_diffuse_slot[material_index].scale[:2]
-
-                            sca_x *= mesh_material_texture_diffuse[material_index].repeat_x
-                            sca_y *= mesh_material_texture_diffuse[material_index].repeat_y
-
-                            # flip x/y is a sampling feature, convert to transform
-                            if mesh_material_texture_diffuse[material_index].use_flip_axis:
-                                rot = math.pi / -2.0
-                                sca_x, sca_y = sca_y, -sca_x
-                            else:
-                                rot = 0.0
+                    texture = material_textures.get('diffuseTexture')
+                    if texture:
+                        writeImageTexture(ident, texture)
 
+                        # transform by the texture mapping node
+                        loc = texture.translation[:2]
+                        sca = texture.scale[:2]
+                        rot = texture.rotation[2]
+                        if loc != (0.0, 0.0) or sca != (1.0, 1.0) or rot != 0.0:
                             ident_step = ident + (' ' * (-len(ident) + \
                             fw('%s<TextureTransform ' % ident)))
                             fw('\n')
                             # fw('center="%.6f %.6f" ' % (0.0, 0.0))
                             fw(ident_step + 'translation="%.6f %.6f"\n' % loc)
-                            fw(ident_step + 'scale="%.6f %.6f"\n' % (sca_x, sca_y))
+                            fw(ident_step + 'scale="%.6f %.6f"\n' % sca)
                             fw(ident_step + 'rotation="%.6f"\n' % rot)
                             fw(ident_step + '/>\n')
 
-                    if use_h3d:
-                        mat_tmp = material if material else gpu_shader_dummy_mat
-                        writeMaterialH3D(ident, mat_tmp, world,
-                                         obj, gpu_shader)
-                        del mat_tmp
-                    else:
-                        if material:
-                            writeMaterial(ident, material, world,
-                                mesh_material_texture_alpha[material_index],
-                                mesh_material_texture_ambient[material_index],
-                                mesh_material_texture_diffuse[material_index],
-                                mesh_material_texture_displacement[material_index],
-                                mesh_material_texture_displacement_factor[material_index],
-                                mesh_material_texture_normal[material_index],
-                                mesh_material_texture_shininess[material_index],
-                                mesh_material_texture_specular[material_index]
-                            )
+                    if material:
+                        writeMaterial(ident, material, world, material_textures)
 
                     ident = ident[:-1]
                     fw('%s</Appearance>\n' % ident)
 
-                    mesh_faces_uv = mesh.tessface_uv_textures.active.data if is_uv else None
-
                     #-- IndexedFaceSet or IndexedLineSet
                     if use_triangulate:
                         ident_step = ident + (' ' * (-len(ident) + \
                         fw('%s<IndexedTriangleSet ' % ident)))
 
                         # --- Write IndexedTriangleSet Attributes (same as IndexedFaceSet)
-                        fw('solid="%s"\n' % bool_as_str(material and material.game_settings.use_backface_culling))
+                        fw('solid="%s"\n' % bool_as_str(material and material.use_backface_culling))
 
-                        if use_normals or is_force_normals:
+                        is_normals = use_normals or is_force_normals
+                        if is_normals:
                             fw(ident_step + 'normalPerVertex="true"\n')
                         else:
                             # Tell X3D browser to generate flat (per-face) normals
                             fw(ident_step + 'normalPerVertex="false"\n')
 
-                        slot_uv = None
-                        slot_col = None
-
-                        if is_uv and is_col:
-                            slot_uv = 0
-                            slot_col = 1
-
-                            def vertex_key(fidx, f_cnr_idx):
-                                return (
-                                    mesh_faces_uv[fidx].uv[f_cnr_idx][:],
-                                    getattr(mesh_faces_col[fidx], "color%d" % (f_cnr_idx + 1))[:],
-                                )
-                        elif is_uv:
-                            slot_uv = 0
-
-                            def vertex_key(fidx, f_cnr_idx):
-                                return (
-                                    mesh_faces_uv[fidx].uv[f_cnr_idx][:],
-                                )
-                        elif is_col:
-                            slot_col = 0
-
-                            def vertex_key(fidx, f_cnr_idx):
-                                return (
-                                    getattr(mesh_faces_col[fidx], "color%d" % (f_cnr_idx + 1))[:],
-                                )
-                        else:
-                            # ack, not especially efficient in this case
-                            def vertex_key(fidx, f_cnr_idx):
-                                return None
-
-                        # build a mesh mapping dict
-                        vertex_hash = [{} for i in range(len(mesh.vertices))]
-                        # worst case every face is a quad
-                        face_tri_list = [[None, None, None] for i in range(len(mesh.tessfaces) * 2)]
-                        vert_tri_list = []
-                        totvert = 0
-                        totface = 0
-                        temp_face = [None] * 4
-                        for i in face_group:
-                            fv = mesh_faces_vertices[i]
-                            for j, v_idx in enumerate(fv):
-                                key = vertex_key(i, j)
-                                vh = vertex_hash[v_idx]
-                                x3d_v = vh.get(key)
-                                if x3d_v is None:
-                                    x3d_v = key, v_idx, totvert
-                                    vh[key] = x3d_v
-                                    # key / original_vertex / new_vertex
-                                    vert_tri_list.append(x3d_v)
-                                    totvert += 1
-                                temp_face[j] = x3d_v
-
-                            if len(fv) == 4:
-                                f_iter = ((0, 1, 2), (0, 2, 3))
-                            else:
-                                f_iter = ((0, 1, 2), )
-
-                            for f_it in f_iter:
-                                # loop over a quad as 2 tris
-                                f_tri = face_tri_list[totface]
-                                for ji, j in enumerate(f_it):
-                                    f_tri[ji] = temp_face[j]
-                                # quads run this twice
-                                totface += 1
-
-                        # clear unused faces
-                        face_tri_list[totface:] = []
+                        tri_index, tri_coords, tri_normals, tri_uvs, tri_colors = calculate_geometry(
+                            'triangle_set_%i_%s' % (material_index, is_normals),
+                            lambda: calc_triangle_set(polygon_group, is_normals))
 
                         fw(ident_step + 'index="')
-                        for x3d_f in face_tri_list:
-                            fw('%i %i %i ' % (x3d_f[0][2], x3d_f[1][2], x3d_f[2][2]))
+                        fw(tri_index)
                         fw('"\n')
 
                         # close IndexedTriangleSet
@@ -845,52 +863,25 @@ def export(file,
 
                         fw('%s<Coordinate ' % ident)
                         fw('point="')
-                        for x3d_v in vert_tri_list:
-                            fw('%.6f %.6f %.6f ' % mesh_vertices[x3d_v[1]].co[:])
+                        fw(tri_coords)
                         fw('" />\n')
 
-                        if use_normals or is_force_normals:
+                        if is_normals:
                             fw('%s<Normal ' % ident)
                             fw('vector="')
-                            for x3d_v in vert_tri_list:
-                                fw('%.6f %.6f %.6f ' % mesh_vertices[x3d_v[1]].normal[:])
+                            fw(tri_normals)
                             fw('" />\n')
 
                         if is_uv:
                             fw('%s<TextureCoordinate point="' % ident)
-                            for x3d_v in vert_tri_list:
-                                fw('%.4f %.4f ' % x3d_v[0][slot_uv])
+                            fw(tri_uvs)
                             fw('" />\n')
 
                         if is_col:
                             fw('%s<Color color="' % ident)
-                            for x3d_v in vert_tri_list:
-                                fw('%.3f %.3f %.3f ' % x3d_v[0][slot_col])
+                            fw(tri_colors)
                             fw('" />\n')
 
-                        if use_h3d:
-                            # write attributes
-                            for gpu_attr in gpu_shader['attributes']:
-
-                                # UVs
-                                if gpu_attr['type'] == gpu.CD_MTFACE:
-                                    if gpu_attr['datatype'] == gpu.GPU_DATA_2F:
-                                        fw('%s<FloatVertexAttribute ' % ident)
-                                        fw('name="%s" ' % gpu_attr['varname'])
-                                        fw('numComponents="2" ')
-                                        fw('value="')
-                                        for x3d_v in vert_tri_list:
-                                            fw('%.4f %.4f ' % x3d_v[0][slot_uv])
-                                        fw('" />\n')
-                                    else:
-                                        assert(0)
-
-                                elif gpu_attr['type'] == gpu.CD_MCOL:
-                                    if gpu_attr['datatype'] == gpu.GPU_DATA_4UB:
-                                        pass  # XXX, H3D can't do
-                                    else:
-                                        assert(0)
-
                         ident = ident[:-1]
 
                         fw('%s</IndexedTriangleSet>\n' % ident)
@@ -900,7 +891,7 @@ def export(file,
                         fw('%s<IndexedFaceSet ' % ident)))
 
                         # --- Write IndexedFaceSet Attributes (same as IndexedTriangleSet)
-                        fw('solid="%s"\n' % bool_as_str(material and material.game_settings.use_backface_culling))
+                        fw('solid="%s"\n' % bool_as_str(material and material.use_backface_culling))
                         if is_smooth:
                             # use Auto-Smooth angle, if enabled. Otherwise make
                             # the mesh perfectly smooth by creaseAngle > pi.
@@ -916,28 +907,25 @@ def export(file,
 
                         # for IndexedTriangleSet we use a uv per vertex so this isnt needed.
                         if is_uv:
-                            fw(ident_step + 'texCoordIndex="')
+                            def calc_tex_coord_index():
+                                result = []
+                                j = 0
+                                for i in polygon_group:
+                                    num_vertices = len(mesh_polygons_vertices[i])
+                                    result.append('%s -1 ' % ' '.join(str(k) for k in range(j, j + num_vertices)))
+                                    j += num_vertices
+                                return ''.join(result)
 
-                            j = 0
-                            for i in face_group:
-                                if len(mesh_faces_vertices[i]) == 4:
-                                    fw('%d %d %d %d -1 ' % (j, j + 1, j + 2, j + 3))
-                                    j += 4
-                                else:
-                                    fw('%d %d %d -1 ' % (j, j + 1, j + 2))
-                                    j += 3
+                            fw(ident_step + 'texCoordIndex="')
+                            fw(calculate_geometry('tex_coord_index_%i' % material_index, calc_tex_coord_index))
                             fw('"\n')
                             # --- end texCoordIndex
 
                         if True:
                             fw(ident_step + 'coordIndex="')
-                            for i in face_group:
-                                fv = mesh_faces_vertices[i]
-                                if len(fv) == 3:
-                                    fw('%i %i %i -1 ' % fv)
-                                else:
-                                    fw('%i %i %i %i -1 ' % fv)
-
+                            fw(calculate_geometry('coord_index_%i' % material_index,
+                                lambda: ''.join('%s -1 ' % ' '.join(str(k) for k in mesh_polygons_vertices[i])
+                                    for i in polygon_group)))
                             fw('"\n')
                             # --- end coordIndex
 
@@ -956,29 +944,32 @@ def export(file,
                                 fw('%s<Coordinate ' % ident)))
                                 fw('DEF=%s\n' % mesh_id_coords)
                                 fw(ident_step + 'point="')
-                                for v in mesh.vertices:
-                                    fw('%.6f %.6f %.6f ' % v.co[:])
+                                fw(calculate_geometry('coords',
+                                    lambda: ''.join(format_coord(v.co) for v in mesh_vertices)))
                                 fw('"\n')
                                 fw(ident_step + '/>\n')
 
                                 is_coords_written = True
 
+                                if object_coordinate_ids is not None:
+                                    object_coordinate_ids[obj.name] = \
+                                        (mesh_id_coords, mesh_id_normals if use_normals else None)
+
                                 if use_normals:
                                     ident_step = ident + (' ' * (-len(ident) + \
                                     fw('%s<Normal ' % ident)))
                                     fw('DEF=%s\n' % mesh_id_normals)
                                     fw(ident_step + 'vector="')
-                                    for v in mesh.vertices:
-                                        fw('%.6f %.6f %.6f ' % v.normal[:])
+                                    fw(calculate_geometry('normals',
+                                        lambda: ''.join(format_normal(v.normal) for v in mesh_vertices)))
                                     fw('"\n')
                                     fw(ident_step + '/>\n')
 
                         if is_uv:
                             fw('%s<TextureCoordinate point="' % ident)
-                            for i in face_group:
-                                for uv in mesh_faces_uv[i].uv:
-                                    fw('%.4f %.4f ' % uv[:])
-                            del mesh_faces_uv
+                            fw(calculate_geometry('tex_coords_%i' % material_index,
+                                lambda: ''.join(format_uv(mesh_loops_uv[lidx].uv)
+                                    for i in polygon_group for lidx in mesh_polygons_loops[i])))
                             fw('" />\n')
 
                         if is_col:
@@ -987,13 +978,15 @@ def export(file,
                             # or per vertex. Probably with an explicit fallback mode parameter.
                             fw('%s<Color color="' % ident)
                             if is_col_per_vertex:
-                                for i in range(len(mesh.vertices)):
+                                fw(calculate_geometry('colors',
                                     # may be None,
-                                    fw('%.3f %.3f %.3f ' % (vert_color[i] or (0.0, 0.0, 0.0)))
+                                    lambda: ''.join(format_color(vert_color[i] or (0.0, 0.0, 0.0))
+                                        for i in range(len(mesh.vertices)))))
                             else: # Export as colors per face.
                                 # TODO: average them rather than using the first one!
-                                for i in face_group:
-                                    fw('%.3f %.3f %.3f ' % mesh_faces_col[i].color1[:])
+                                fw(calculate_geometry('colors_%i' % material_index,
+                                    lambda: ''.join(format_color(mesh_loops_col[mesh_polygons[i].loop_start].color[:3])
+                                        for i in polygon_group)))
                             fw('" />\n')
 
                         #--- output vertexColors
@@ -1015,26 +1008,34 @@ def export(file,
             ident = ident[:-1]
             fw('%s</Group>\n' % ident)
 
+            if inline_url is not None:
+                writeInlineMesh_end(obj, inline_state)
+                ident = ident_before_inline
+
         ident = writeTransform_end(ident)
 
         if use_collnode:
             ident = ident[:-1]
             fw('%s</Collision>\n' % ident)
 
+    # Material wrapped by PrincipledBSDFWrapper (read-only), to get its
+    # parameters and textures from the Principled BSDF node
+    # (or from the material viewport settings, if there is no such node).
+    # Cached, as the wrapper has to search the material node tree.
+    def material_wrapper(material):
+        wrapper = material_wrappers.get(material)
+        if wrapper is None:
+            wrapper = material_wrappers[material] = PrincipledBSDFWrapper(material, is_readonly=True)
+        return wrapper
+
     # Write X3D <Material> node.
     #
     # If use_common_surface_shader, write also X3D <CommonSurfaceShader> node,
     # that contains the same information as <Material>, and additionally specifies
     # also textures for some shading parameters.
-    def writeMaterial(ident, material, world,
-                      texture_alpha,
-                      texture_ambient,
-                      texture_diffuse,
-                      texture_displacement,
-                      texture_displacement_factor,
-                      texture_normal,
-                      texture_shininess,
-                      texture_specular):
+    # material_textures maps CommonSurfaceShader texture fields
+    # to ShaderImageTextureWrapper.
+    def writeMaterial(ident, material, world, material_textures):
         material_id_unquoted = unique_name(material, MA_ + material.name, uuid_cache_material, clean_func=clean_def, sep="_")
         material_id = quoteattr(material_id_unquoted)
         # Sharing of CommonSurfaceShader occurs at exactly the same point
@@ -1043,34 +1044,26 @@ def export(file,
         common_surface_shader_id = quoteattr(CSS_ + material_id_unquoted)
 
         # look up material name, use it if available
-        if material.tag:
+        if material in written_materials:
             fw('%s<Material USE=%s />\n' % (ident, material_id))
             if use_common_surface_shader:
                 fw('%s<CommonSurfaceShader USE=%s />\n' % (ident, common_surface_shader_id))
         else:
-            material.tag = True
-
-            emit = material.emit
-            ambient = material.ambient / 3.0
-            diffuseColor = material.diffuse_color[:]
-            if world:
-                ambiColor = ((material.ambient * 2.0) * world.ambient_color)[:]
-            else:
-                ambiColor = 0.0, 0.0, 0.0
-
-            emitColor = tuple(((c * emit) + ambiColor[i]) / 2.0 for i, c in enumerate(diffuseColor))
-            shininess = material.specular_hardness / 512.0
-            specColor = tuple((c + 0.001) / (1.25 / (material.specular_intensity + 0.001)) for c in material.specular_color)
-            transp = 1.0 - material.alpha
-
-            if material.use_shadeless:
-            	# Make the material purely emissive.
-                # This is optimized in Castle Game Engine and view3dscene.
-                ambient = 0.0
-                shininess = 0.0
-                emitColor = diffuseColor
-                diffuseColor = 0.0, 0.0, 0.0
-                specColor = 0.0, 0.0, 0.0
+            written_materials.add(material)
+
+            wrapper = material_wrapper(material)
+
+            # Blender 2.80 materials have no ambient, use the Blender 2.7x
+            # default (material.ambient = 1), the lights' ambientIntensity
+            # follows the world color.
+            # Emission is only available in newer PrincipledBSDFWrapper.
+            ambient = 1.0 / 3.0
+            diffuseColor = wrapper.base_color[:3]
+            emitColor = getattr(wrapper, 'emission_color', (0.0, 0.0, 0.0))[:3]
+            shininess = 1.0 - wrapper.roughness
+            specColor = (wrapper.specular, ) * 3
+            alpha = wrapper.alpha
+            transp = 1.0 - alpha
 
             ident_step = ident + (' ' * (-len(ident) + \
             fw('%s<Material ' % ident)))
@@ -1095,330 +1088,34 @@ def export(file,
                 fw(ident_step + 'emissiveFactor="%.3f %.3f %.3f"\n' % clamp_color(emitColor))
                 fw(ident_step + 'ambientFactor="%.3f %.3f %.3f"\n' % (ambient, ambient, ambient))
                 fw(ident_step + 'shininessFactor="%.3f"\n' % shininess)
-                fw(ident_step + 'alphaFactor="%.3f"\n' % material.alpha)
-                if texture_displacement_factor:
-                    fw(ident_step + 'displacementFactor="%.3f"\n' % texture_displacement_factor)
-                    # Set the same value for Castle Game Engine normalTextureParallaxHeight.
-                    #
-                    # The effect of Castle Game Engine (parallax bump mapping)
-                    # and X3DOM displacement are different effects, and often require different
-                    # settings... but it makes sense to export both as equal from Blender,
-                    # to allow users of both programs to be able to control these effects.
-                    fw(ident_step + 'normalTextureParallaxHeight="%.3f"\n' % texture_displacement_factor)
+                fw(ident_step + 'alphaFactor="%.3f"\n' % alpha)
                 fw(ident_step + '>\n')
 
                 ident += '\t'
 
                 # textures inside CommonSurfaceShader
-                if texture_alpha:
-                    writeImageTexture(ident, texture_alpha.image, "alphaTexture")
-                if texture_ambient:
-                    writeImageTexture(ident, texture_ambient.image, "ambientTexture")
-                if texture_diffuse:
-                    writeImageTexture(ident, texture_diffuse.image, "diffuseTexture")
-                if texture_displacement:
-                    writeImageTexture(ident, texture_displacement.image, "displacementTexture")
-                if texture_normal:
-                    writeImageTexture(ident, texture_normal.image, "normalTexture")
-                if texture_shininess:
-                    writeImageTexture(ident, texture_shininess.image, "shininessTexture")
-                if texture_specular:
-                    writeImageTexture(ident, texture_specular.image, "specularTexture")
+                for field, wrapper_texture in COMMON_SURFACE_SHADER_TEXTURES:
+                    if field in material_textures:
+                        writeImageTexture(ident, material_textures[field], field)
 
                 ident = ident[:-1]
 
                 fw('%s</CommonSurfaceShader>\n' % ident)
 
-    def writeMaterialH3D(ident, material, world,
-                         obj, gpu_shader):
-        material_id = quoteattr(unique_name(material, 'MA_' + material.name, uuid_cache_material, clean_func=clean_def, sep="_"))
-
-        fw('%s<Material />\n' % ident)
-        if material.tag:
-            fw('%s<ComposedShader USE=%s />\n' % (ident, material_id))
-        else:
-            material.tag = True
-
-            # GPU_material_bind_uniforms
-            # GPU_begin_object_materials
-
-            #~ CD_MCOL 6
-            #~ CD_MTFACE 5
-            #~ CD_ORCO 14
-            #~ CD_TANGENT 18
-            #~ GPU_DATA_16F 7
-            #~ GPU_DATA_1F 2
-            #~ GPU_DATA_1I 1
-            #~ GPU_DATA_2F 3
-            #~ GPU_DATA_3F 4
-            #~ GPU_DATA_4F 5
-            #~ GPU_DATA_4UB 8
-            #~ GPU_DATA_9F 6
-            #~ GPU_DYNAMIC_LAMP_DYNCO 7
-            #~ GPU_DYNAMIC_LAMP_DYNCOL 11
-            #~ GPU_DYNAMIC_LAMP_DYNENERGY 10
-            #~ GPU_DYNAMIC_LAMP_DYNIMAT 8
-            #~ GPU_DYNAMIC_LAMP_DYNPERSMAT 9
-            #~ GPU_DYNAMIC_LAMP_DYNVEC 6
-            #~ GPU_DYNAMIC_OBJECT_COLOR 5
-            #~ GPU_DYNAMIC_OBJECT_IMAT 4
-            #~ GPU_DYNAMIC_OBJECT_MAT 2
-            #~ GPU_DYNAMIC_OBJECT_VIEWIMAT 3
-            #~ GPU_DYNAMIC_OBJECT_VIEWMAT 1
-            #~ GPU_DYNAMIC_SAMPLER_2DBUFFER 12
-            #~ GPU_DYNAMIC_SAMPLER_2DIMAGE 13
-            #~ GPU_DYNAMIC_SAMPLER_2DSHADOW 14
-
-            '''
-            inline const char* typeToString( X3DType t ) {
-              switch( t ) {
-              case     SFFLOAT: return "SFFloat";
-              case     MFFLOAT: return "MFFloat";
-              case    SFDOUBLE: return "SFDouble";
-              case    MFDOUBLE: return "MFDouble";
-              case      SFTIME: return "SFTime";
-              case      MFTIME: return "MFTime";
-              case     SFINT32: return "SFInt32";
-              case     MFINT32: return "MFInt32";
-              case     SFVEC2F: return "SFVec2f";
-              case     MFVEC2F: return "MFVec2f";
-              case     SFVEC2D: return "SFVec2d";
-              case     MFVEC2D: return "MFVec2d";
-              case     SFVEC3F: return "SFVec3f";
-              case     MFVEC3F: return "MFVec3f";
-              case     SFVEC3D: return "SFVec3d";
-              case     MFVEC3D: return "MFVec3d";
-              case     SFVEC4F: return "SFVec4f";
-              case     MFVEC4F: return "MFVec4f";
-              case     SFVEC4D: return "SFVec4d";
-              case     MFVEC4D: return "MFVec4d";
-              case      SFBOOL: return "SFBool";
-              case      MFBOOL: return "MFBool";
-              case    SFSTRING: return "SFString";
-              case    MFSTRING: return "MFString";
-              case      SFNODE: return "SFNode";
-              case      MFNODE: return "MFNode";
-              case     SFCOLOR: return "SFColor";
-              case     MFCOLOR: return "MFColor";
-              case SFCOLORRGBA: return "SFColorRGBA";
-              case MFCOLORRGBA: return "MFColorRGBA";
-              case  SFROTATION: return "SFRotation";
-              case  MFROTATION: return "MFRotation";
-              case  SFQUATERNION: return "SFQuaternion";
-              case  MFQUATERNION: return "MFQuaternion";
-              case  SFMATRIX3F: return "SFMatrix3f";
-              case  MFMATRIX3F: return "MFMatrix3f";
-              case  SFMATRIX4F: return "SFMatrix4f";
-              case  MFMATRIX4F: return "MFMatrix4f";
-              case  SFMATRIX3D: return "SFMatrix3d";
-              case  MFMATRIX3D: return "MFMatrix3d";
-              case  SFMATRIX4D: return "SFMatrix4d";
-              case  MFMATRIX4D: return "MFMatrix4d";
-              case UNKNOWN_X3D_TYPE:
-              default:return "UNKNOWN_X3D_TYPE";
-            '''
-            import gpu
-
-            fw('%s<ComposedShader DEF=%s language="GLSL" >\n' % (ident, material_id))
-            ident += '\t'
-
-            shader_url_frag = 'shaders/%s_%s.frag' % (filename_strip, material_id[1:-1])
-            shader_url_vert = 'shaders/%s_%s.vert' % (filename_strip, material_id[1:-1])
-
-            # write files
-            shader_dir = os.path.join(base_dst, 'shaders')
-            if not os.path.isdir(shader_dir):
-                os.mkdir(shader_dir)
-
-            # ------------------------------------------------------
-            # shader-patch
-            field_descr = " <!--- H3D View Matrix Patch -->"
-            fw('%s<field name="%s" type="SFMatrix4f" accessType="inputOutput" />%s\n' % (ident, H3D_VIEW_MATRIX, field_descr))
-            frag_vars = ["uniform mat4 %s;" % H3D_VIEW_MATRIX]
-
-            # annoying!, we need to track if some of the directional lamp
-            # vars are children of the camera or not, since this adjusts how
-            # they are patched.
-            frag_uniform_var_map = {}
-
-            h3d_material_route.append(
-                    '<ROUTE fromNode="%s" fromField="glModelViewMatrix" toNode=%s toField="%s" />%s' %
-                    (H3D_TOP_LEVEL, material_id, H3D_VIEW_MATRIX, field_descr))
-            # ------------------------------------------------------
-
-            for uniform in gpu_shader['uniforms']:
-                if uniform['type'] == gpu.GPU_DYNAMIC_SAMPLER_2DIMAGE:
-                    field_descr = " <!--- Dynamic Sampler 2d Image -->"
-                    fw('%s<field name="%s" type="SFNode" accessType="inputOutput">%s\n' % (ident, uniform['varname'], field_descr))
-                    writeImageTexture(ident + '\t', uniform['image'])
-                    fw('%s</field>\n' % ident)
-
-                elif uniform['type'] == gpu.GPU_DYNAMIC_LAMP_DYNCO:
-                    lamp_obj = uniform['lamp']
-                    frag_uniform_var_map[uniform['varname']] = lamp_obj
-
-                    if uniform['datatype'] == gpu.GPU_DATA_3F:  # should always be true!
-                        lamp_obj_id = quoteattr(unique_name(lamp_obj, LA_ + lamp_obj.name, uuid_cache_lamp, clean_func=clean_def, sep="_"))
-                        lamp_obj_transform_id = quoteattr(unique_name(lamp_obj, lamp_obj.name, uuid_cache_object, clean_func=clean_def, sep="_"))
-
-                        value = '%.6f %.6f %.6f' % (global_matrix * lamp_obj.matrix_world).to_translation()[:]
-                        field_descr = " <!--- Lamp DynCo '%s' -->" % lamp_obj.name
-                        fw('%s<field name="%s" type="SFVec3f" accessType="inputOutput" value="%s" />%s\n' % (ident, uniform['varname'], value, field_descr))
-
-                        # ------------------------------------------------------
-                        # shader-patch
-                        field_descr = " <!--- Lamp DynCo '%s' (shader patch) -->" % lamp_obj.name
-                        fw('%s<field name="%s_transform" type="SFMatrix4f" accessType="inputOutput" />%s\n' % (ident, uniform['varname'], field_descr))
-
-                        # transform
-                        frag_vars.append("uniform mat4 %s_transform;" % uniform['varname'])
-                        h3d_material_route.append(
-                                '<ROUTE fromNode=%s fromField="accumulatedForward" toNode=%s toField="%s_transform" />%s' %
-                                (suffix_quoted_str(lamp_obj_transform_id, _TRANSFORM), material_id, uniform['varname'], field_descr))
-
-                        h3d_material_route.append(
-                                '<ROUTE fromNode=%s fromField="location" toNode=%s toField="%s" /> %s' %
-                                (lamp_obj_id, material_id, uniform['varname'], field_descr))
-                        # ------------------------------------------------------
-
-                    else:
-                        assert(0)
-
-                elif uniform['type'] == gpu.GPU_DYNAMIC_LAMP_DYNCOL:
-                    # odd  we have both 3, 4 types.
-                    lamp_obj = uniform['lamp']
-                    frag_uniform_var_map[uniform['varname']] = lamp_obj
-
-                    lamp = lamp_obj.data
-                    value = '%.6f %.6f %.6f' % (lamp.color * lamp.energy)[:]
-                    field_descr = " <!--- Lamp DynColor '%s' -->" % lamp_obj.name
-                    if uniform['datatype'] == gpu.GPU_DATA_3F:
-                        fw('%s<field name="%s" type="SFVec3f" accessType="inputOutput" value="%s" />%s\n' % (ident, uniform['varname'], value, field_descr))
-                    elif uniform['datatype'] == gpu.GPU_DATA_4F:
-                        fw('%s<field name="%s" type="SFVec4f" accessType="inputOutput" value="%s 1.0" />%s\n' % (ident, uniform['varname'], value, field_descr))
-                    else:
-                        assert(0)
-
-                elif uniform['type'] == gpu.GPU_DYNAMIC_LAMP_DYNENERGY:
-                    # not used ?
-                    assert(0)
-
-                elif uniform['type'] == gpu.GPU_DYNAMIC_LAMP_DYNVEC:
-                    lamp_obj = uniform['lamp']
-                    frag_uniform_var_map[uniform['varname']] = lamp_obj
-
-                    if uniform['datatype'] == gpu.GPU_DATA_3F:
-                        lamp_obj = uniform['lamp']
-                        value = '%.6f %.6f %.6f' % ((global_matrix * lamp_obj.matrix_world).to_quaternion() * mathutils.Vector((0.0, 0.0, 1.0))).normalized()[:]
-                        field_descr = " <!--- Lamp DynDirection '%s' -->" % lamp_obj.name
-                        fw('%s<field name="%s" type="SFVec3f" accessType="inputOutput" value="%s" />%s\n' % (ident, uniform['varname'], value, field_descr))
-
-                        # route so we can have the lamp update the view
-                        if h3d_is_object_view(scene, lamp_obj):
-                            lamp_id = quoteattr(unique_name(lamp_obj, LA_ + lamp_obj.name, uuid_cache_lamp, clean_func=clean_def, sep="_"))
-                            h3d_material_route.append(
-                                '<ROUTE fromNode=%s fromField="direction" toNode=%s toField="%s" />%s' %
-                                        (lamp_id, material_id, uniform['varname'], field_descr))
-
-                    else:
-                        assert(0)
-
-                elif uniform['type'] == gpu.GPU_DYNAMIC_OBJECT_VIEWIMAT:
-                    frag_uniform_var_map[uniform['varname']] = None
-                    if uniform['datatype'] == gpu.GPU_DATA_16F:
-                        field_descr = " <!--- Object View Matrix Inverse '%s' -->" % obj.name
-                        fw('%s<field name="%s" type="SFMatrix4f" accessType="inputOutput" />%s\n' % (ident, uniform['varname'], field_descr))
-
-                        h3d_material_route.append(
-                            '<ROUTE fromNode="%s" fromField="glModelViewMatrixInverse" toNode=%s toField="%s" />%s' %
-                                    (H3D_TOP_LEVEL, material_id, uniform['varname'], field_descr))
-                    else:
-                        assert(0)
-
-                elif uniform['type'] == gpu.GPU_DYNAMIC_OBJECT_IMAT:
-                    frag_uniform_var_map[uniform['varname']] = None
-                    if uniform['datatype'] == gpu.GPU_DATA_16F:
-                        value = ' '.join(['%.6f' % f for v in (global_matrix * obj.matrix_world).inverted().transposed() for f in v])
-                        field_descr = " <!--- Object Invertex Matrix '%s' -->" % obj.name
-                        fw('%s<field name="%s" type="SFMatrix4f" accessType="inputOutput" value="%s" />%s\n' % (ident, uniform['varname'], value, field_descr))
-                    else:
-                        assert(0)
-
-                elif uniform['type'] == gpu.GPU_DYNAMIC_SAMPLER_2DSHADOW:
-                    pass  # XXX, shadow buffers not supported.
-
-                elif uniform['type'] == gpu.GPU_DYNAMIC_SAMPLER_2DBUFFER:
-                    frag_uniform_var_map[uniform['varname']] = None
-
-                    if uniform['datatype'] == gpu.GPU_DATA_1I:
-                        if 1:
-                            tex = uniform['texpixels']
-                            value = []
-                            for i in range(0, len(tex) - 1, 4):
-                                col = tex[i:i + 4]
-                                value.append('0x%.2x%.2x%.2x%.2x' % (col[0], col[1], col[2], col[3]))
-
-                            field_descr = " <!--- Material Buffer -->"
-                            fw('%s<field name="%s" type="SFNode" accessType="inputOutput">%s\n' % (ident, uniform['varname'], field_descr))
-
-                            ident += '\t'
-
-                            ident_step = ident + (' ' * (-len(ident) + \
-                            fw('%s<PixelTexture \n' % ident)))
-                            fw(ident_step + 'repeatS="false"\n')
-                            fw(ident_step + 'repeatT="false"\n')
-
-                            fw(ident_step + 'image="%s 1 4 %s"\n' % (len(value), " ".join(value)))
-
-                            fw(ident_step + '/>\n')
-
-                            ident = ident[:-1]
-
-                            fw('%s</field>\n' % ident)
-
-                            #for i in range(0, 10, 4)
-                            #value = ' '.join(['%d' % f for f in uniform['texpixels']])
-                            # value = ' '.join(['%.6f' % (f / 256) for f in uniform['texpixels']])
-
-                            #fw('%s<field name="%s" type="SFInt32" accessType="inputOutput" value="%s" />%s\n' % (ident, uniform['varname'], value, field_descr))
-                            #print('test', len(uniform['texpixels']))
-                    else:
-                        assert(0)
-                else:
-                    print("SKIPPING", uniform['type'])
-
-            file_frag = open(os.path.join(base_dst, shader_url_frag), 'w', encoding='utf-8')
-            file_frag.write(gpu_shader['fragment'])
-            file_frag.close()
-            # patch it
-            h3d_shader_glsl_frag_patch(os.path.join(base_dst, shader_url_frag),
-                                       scene,
-                                       frag_vars,
-                                       frag_uniform_var_map,
-                                       )
-
-            file_vert = open(os.path.join(base_dst, shader_url_vert), 'w', encoding='utf-8')
-            file_vert.write(gpu_shader['vertex'])
-            file_vert.close()
-
-            fw('%s<ShaderPart type="FRAGMENT" url=%s />\n' % (ident, quoteattr(shader_url_frag)))
-            fw('%s<ShaderPart type="VERTEX" url=%s />\n' % (ident, quoteattr(shader_url_vert)))
-            ident = ident[:-1]
-
-            fw('%s</ComposedShader>\n' % ident)
-
-    # Write <ImageTexture>, based on Blender Image instance
-    def writeImageTexture(ident, image, container_field = None):
+    # Write <ImageTexture>, based on ShaderImageTextureWrapper instance
+    # (image texture node of a material)
+    def writeImageTexture(ident, texture, container_field = None):
+        image = texture.image
         image_id = quoteattr(unique_name(image, IM_ + image.name, uuid_cache_image, clean_func=clean_def, sep="_"))
         if container_field:
             container_field_complete = 'containerField="' + container_field + '" '
         else:
             container_field_complete = ''
 
-        if image.tag:
+        if image in written_images:
             fw('%s<ImageTexture USE=%s %s/>\n' % (ident, image_id, container_field_complete))
         else:
-            image.tag = True
+            written_images.add(image)
 
             ident_step = ident + (' ' * (-len(ident) + \
             fw('%s<ImageTexture ' % ident)))
@@ -1442,9 +1139,8 @@ def export(file,
             images = [f for i, f in enumerate(images) if f not in images[:i]]
 
             fw(ident_step + "url='%s'\n" % ' '.join(['"%s"' % escape(f) for f in images]))
-            if image.use_clamp_x:
+            if texture.extension != 'REPEAT':
                 fw(ident_step + "repeatS='false'\n")
-            if image.use_clamp_y:
                 fw(ident_step + "repeatT='false'\n")
             fw(ident_step + '%s/>\n' % container_field_complete)
 
@@ -1456,45 +1152,14 @@ def export(file,
         # note, not re-used
         world_id = quoteattr(unique_name(world, WO_ + world.name, uuid_cache_world, clean_func=clean_def, sep="_"))
 
-        blending = world.use_sky_blend, world.use_sky_paper, world.use_sky_real
-
-        grd_triple = clamp_color(world.horizon_color)
-        sky_triple = clamp_color(world.zenith_color)
-        mix_triple = clamp_color((grd_triple[i] + sky_triple[i]) / 2.0 for i in range(3))
+        # Blender 2.80 world has only one color (no horizon/zenith blending)
+        color_triple = clamp_color(world.color)
 
         ident_step = ident + (' ' * (-len(ident) + \
         fw('%s<Background ' % ident)))
         fw('DEF=%s\n' % world_id)
-        # No Skytype - just Hor color
-        if blending == (False, False, False):
-            fw(ident_step + 'groundColor="%.3f %.3f %.3f"\n' % grd_triple)
-            fw(ident_step + 'skyColor="%.3f %.3f %.3f"\n' % grd_triple)
-        # Blend Gradient
-        elif blending == (True, False, False):
-            fw(ident_step + 'groundColor="%.3f %.3f %.3f, %.3f %.3f %.3f"\n' % (grd_triple + mix_triple))
-            fw(ident_step + 'groundAngle="1.57"\n')
-            fw(ident_step + 'skyColor="%.3f %.3f %.3f, %.3f %.3f %.3f"\n' % (sky_triple + mix_triple))
-            fw(ident_step + 'skyAngle="1.57"\n')
-        # Blend+Real Gradient Inverse
-        elif blending == (True, False, True):
-            fw(ident_step + 'groundColor="%.3f %.3f %.3f, %.3f %.3f %.3f"\n' % (sky_triple + grd_triple))
-            fw(ident_step + 'groundAngle="1.57"\n')
-            fw(ident_step + 'skyColor="%.3f %.3f %.3f, %.3f %.3f %.3f, %.3f %.3f %.3f"\n' % (sky_triple + grd_triple + sky_triple))
-            fw(ident_step + 'skyAngle="1.57, 3.14159"\n')
-        # Paper - just Zen Color
-        elif blending == (False, False, True):
-            fw(ident_step + 'groundColor="%.3f %.3f %.3f"\n' % sky_triple)
-            fw(ident_step + 'skyColor="%.3f %.3f %.3f"\n' % sky_triple)
-        # Blend+Real+Paper - komplex gradient
-        elif blending == (True, True, True):
-            fw(ident_step + 'groundColor="%.3f %.3f %.3f, %.3f %.3f %.3f"\n' % (sky_triple + grd_triple))
-            fw(ident_step + 'groundAngle="1.57"\n')
-            fw(ident_step + 'skyColor="%.3f %.3f %.3f, %.3f %.3f %.3f"\n' % (sky_triple + grd_triple))
-            fw(ident_step + 'skyAngle="1.57"\n')
-        # Any Other two colors
-        else:
-            fw(ident_step + 'groundColor="%.3f %.3f %.3f"\n' % grd_triple)
-            fw(ident_step + 'skyColor="%.3f %.3f %.3f"\n' % sky_triple)
+        fw(ident_step + 'groundColor="%.3f %.3f %.3f"\n' % color_triple)
+        fw(ident_step + 'skyColor="%.3f %.3f %.3f"\n' % color_triple)
 
         for tex in bpy.data.textures:
             if tex.type == 'IMAGE' and tex.image:
@@ -1520,84 +1185,103 @@ def export(file,
     # -------------------------------------------------------------------------
     # Export Object Hierarchy (recursively called)
     # -------------------------------------------------------------------------
+
+    # instances (particles, instanced collections) generated by each object,
+    # as lists of pairs (original instanced object, world matrix),
+    # calculated in export_main
+    object_instances = {}
+
+    def create_derived_objects(obj_main):
+        """Return (is_instance, list of pairs (object, world matrix))
+        for objects to export in place of obj_main.
+        Like create_derived_objects from bpy_extras.io_utils in Blender 2.7x,
+        but using instances from the depsgraph."""
+        if obj_main.parent and obj_main.parent.instance_type in {'VERTS', 'FACES'}:
+            # shown by the parent instances
+            return False, None
+        if obj_main.instance_type != 'NONE' or obj_main.particle_systems:
+            return True, object_instances.get(obj_main, [])
+        return False, [(obj_main, obj_main.matrix_world)]
+
     def export_object(ident, obj_main_parent, obj_main, obj_children):
         matrix_fallback = mathutils.Matrix()
         world = scene.world
-        free, derived = create_derived_objects(scene, obj_main)
+        # derived objects are instances (particles, instanced collections)
+        is_instance, derived = create_derived_objects(obj_main)
 
         if use_hierarchy:
             obj_main_matrix_world = obj_main.matrix_world
-            if obj_main_parent:
-                obj_main_matrix = obj_main_parent.matrix_world.inverted(matrix_fallback) * obj_main_matrix_world
-            else:
-                obj_main_matrix = obj_main_matrix_world
             obj_main_matrix_world_invert = obj_main_matrix_world.inverted(matrix_fallback)
 
             obj_main_id = quoteattr(unique_name(obj_main, obj_main.name, uuid_cache_object, clean_func=clean_def, sep="_"))
+            obj_main_transform_id = suffix_quoted_str(obj_main_id, _TRANSFORM)
+            if object_transform_ids is not None:
+                object_transform_ids[obj_main.name] = obj_main_transform_id
 
-            ident = writeTransform_begin(ident, obj_main_matrix if obj_main_parent else global_matrix * obj_main_matrix, suffix_quoted_str(obj_main_id, _TRANSFORM))
-
-        # Set here just incase we dont enter the loop below.
-        is_dummy_tx = False
+            ident = writeTransform_begin(ident, object_transform_matrix(obj_main, obj_main_parent, global_matrix), obj_main_transform_id)
 
         for obj, obj_matrix in (() if derived is None else derived):
             obj_type = obj.type
 
             if use_hierarchy:
                 # make transform node relative
-                obj_matrix = obj_main_matrix_world_invert * obj_matrix
+                obj_matrix = obj_main_matrix_world_invert @ obj_matrix
             else:
-                obj_matrix = global_matrix * obj_matrix
-
-            # H3D - use for writing a dummy transform parent
-            is_dummy_tx = False
+                obj_matrix = global_matrix @ obj_matrix
 
             if obj_type == 'CAMERA':
                 writeViewpoint(ident, obj, obj_matrix, scene)
 
-                if use_h3d and scene.camera == obj:
-                    view_id = uuid_cache_view[obj]
-                    fw('%s<Transform DEF="%s">\n' % (ident, H3D_CAMERA_FOLLOW))
-                    h3d_material_route.extend([
-                        '<ROUTE fromNode="%s" fromField="totalPosition" toNode="%s" toField="translation" />' % (view_id, H3D_CAMERA_FOLLOW),
-                        '<ROUTE fromNode="%s" fromField="totalOrientation" toNode="%s" toField="rotation" />' % (view_id, H3D_CAMERA_FOLLOW),
-                        ])
-                    is_dummy_tx = True
-                    ident += '\t'
-
             elif obj_type in {'MESH', 'CURVE', 'SURFACE', 'FONT'}:
-                if (obj_type != 'MESH') or (use_mesh_modifiers and obj.is_modified(scene, 'PREVIEW')):
+                obj_for_mesh = obj.evaluated_get(depsgraph) if use_mesh_modifiers else obj
+                if is_instance and obj in instance_meshes:
+                    # reuse the mesh, it is already written, so it will be USEd
+                    me = instance_meshes[obj]
+                    me_temporary = False
+                elif (obj_type != 'MESH') or (use_mesh_modifiers and obj.is_modified(scene, 'PREVIEW')):
                     try:
-                        me = obj.to_mesh(scene, use_mesh_modifiers, 'PREVIEW')
+                        if is_instance:
+                            # keep the mesh until the end of export,
+                            # to share it among all instances
+                            me = instance_meshes[obj] = bpy.data.meshes.new_from_object(obj_for_mesh)
+                            me_temporary = False
+                        else:
+                            me = obj_for_mesh.to_mesh()
+                            me_temporary = True
                     except:
                         me = None
-                    do_remove = True
+                    if me is not None:
+                        me.tag = False
                 else:
                     me = obj.data
-                    do_remove = False
+                    me_temporary = False
 
                 if me is not None:
-                    # ensure unique name, we could also do this by
-                    # postponing mesh removal, but clearing data - TODO
-                    if do_remove:
-                        me.name = obj.name.rstrip("1234567890").rstrip(".")
-                        me_name_new = me_name_org = me.name
+                    if me_temporary:
+                        # ensure unique name, the temporary mesh memory
+                        # may be reused by the next to_mesh call,
+                        # so the object (with unique name) identifies it
+                        me_name_new = me_name_org = obj.name.rstrip("1234567890").rstrip(".")
                         count = 0
                         while me_name_new in mesh_name_set:
-                            me.name = "%.17s.%03d" % (me_name_org, count)
-                            me_name_new = me.name
+                            me_name_new = "%.17s.%03d" % (me_name_org, count)
                             count += 1
                         mesh_name_set.add(me_name_new)
-                        del me_name_new, me_name_org, count
+                        me_key = ('to_mesh', obj.name)
+                        del me_name_org, count
+                    else:
+                        me_name_new = me.name
+                        me_key = me
                     # done
 
-                    writeIndexedFaceSet(ident, obj, me, obj_matrix, world)
+                    writeIndexedFaceSet(ident, obj, me, me_key, me_name_new, obj_matrix, world, is_instance)
 
-                    # free mesh created with create_mesh()
-                    if do_remove:
-                        bpy.data.meshes.remove(me)
+                    # free mesh created with to_mesh()
+                    # (for instances, new_from_object meshes are removed at the end of export)
+                    if me_temporary:
+                        obj_for_mesh.to_mesh_clear()
 
-            elif obj_type == 'LAMP':
+            elif obj_type == 'LIGHT':
                 data = obj.data
                 datatype = data.type
                 if datatype == 'POINT':
@@ -1612,20 +1296,12 @@ def export(file,
                 #print "Info: Ignoring [%s], object type [%s] not handle yet" % (object.name,object.getType)
                 pass
 
-        if free:
-            free_derived_objects(obj_main)
-
         # ---------------------------------------------------------------------
         # write out children recursively
         # ---------------------------------------------------------------------
         for obj_child, obj_child_children in obj_children:
             export_object(ident, obj_main, obj_child, obj_child_children)
 
-        if is_dummy_tx:
-            ident = ident[:-1]
-            fw('%s</Transform>\n' % ident)
-            is_dummy_tx = False
-
         if use_hierarchy:
             ident = writeTransform_end(ident)
 
@@ -1637,21 +1313,25 @@ def export(file,
 
         # tag un-exported IDs
         bpy.data.meshes.tag(False)
-        bpy.data.materials.tag(False)
-        bpy.data.images.tag(False)
 
         if use_selection:
-            objects = [obj for obj in scene.objects if obj.is_visible(scene) and obj.select]
+            objects = [obj for obj in scene.objects if obj.visible_get(view_layer=view_layer) and obj.select_get(view_layer=view_layer)]
         else:
-            objects = [obj for obj in scene.objects if obj.is_visible(scene)]
+            objects = [obj for obj in scene.objects if obj.visible_get(view_layer=view_layer)]
+
+        # Instance data is only valid during iteration,
+        # so remember the original objects and copy the matrices.
+        for instance in depsgraph.object_instances:
+            if instance.is_instance:
+                object_instances.setdefault(instance.parent.original, []).append(
+                    (instance.object.original, instance.matrix_world.copy()))
 
         print('Info: starting X3D export to %r...' % file.name)
         ident = ''
         ident = writeHeader(ident)
 
-        writeNavigationInfo(ident, scene, any(obj.type == 'LAMP' for obj in objects))
+        writeNavigationInfo(ident, scene, any(obj.type == 'LIGHT' for obj in objects))
         writeBackground(ident, world)
-        writeFog(ident, world)
 
         ident = '\t\t'
 
@@ -1663,6 +1343,12 @@ def export(file,
         for obj_main, obj_main_children in objects_hierarchy:
             export_object(ident, None, obj_main, obj_main_children)
 
+        if write_scene_extra:
+            write_scene_extra(fw, ident)
+
+        for me in instance_meshes.values():
+            bpy.data.meshes.remove(me)
+
         ident = writeFooter(ident)
 
     export_main()
@@ -1670,10 +1356,6 @@ def export(file,
     # -------------------------------------------------------------------------
     # global cleanup
     # -------------------------------------------------------------------------
-    file.close()
-
-    if use_h3d:
-        bpy.data.materials.remove(gpu_shader_dummy_mat)
 
     # copy all collected files.
     # print(copy_set)
@@ -1687,21 +1369,13 @@ def export(file,
 ##########################################################
 
 
-def gzip_open_utf8(filepath, mode):
-    """Workaround for py3k only allowing binary gzip writing"""
+def gzip_open_utf8(filepath, mode, compresslevel=9):
+    """Open gzip-compressed file in text mode, with UTF-8 encoding.
+    Written text is buffered and compressed as a stream."""
 
     import gzip
 
-    # need to investigate encoding
-    file = gzip.open(filepath, mode)
-    write_real = file.write
-
-    def write_wrap(data):
-        return write_real(data.encode("utf-8"))
-
-    file.write = write_wrap
-
-    return file
+    return gzip.open(filepath, mode + 't', compresslevel=compresslevel, encoding='utf-8')
 
 
 def save(context,
@@ -1713,11 +1387,15 @@ def save(context,
          use_normals=False,
          use_compress=False,
          use_hierarchy=True,
-         use_h3d=False,
          use_common_surface_shader=False,
          global_matrix=None,
          path_mode='AUTO',
-         name_decorations=True
+         name_decorations=True,
+         coord_decimals=6,
+         normal_decimals=6,
+         uv_decimals=4,
+         color_decimals=3,
+         strip_zeros=False,
          ):
 
     bpy.path.ensure_ext(filepath, '.x3dz' if use_compress else '.x3d')
@@ -1735,16 +1413,24 @@ def save(context,
 
     export(file,
            global_matrix,
+           context.evaluated_depsgraph_get(),
            context.scene,
+           context.view_layer,
            use_mesh_modifiers=use_mesh_modifiers,
            use_selection=use_selection,
            use_triangulate=use_triangulate,
            use_normals=use_normals,
            use_hierarchy=use_hierarchy,
-           use_h3d=use_h3d,
            use_common_surface_shader=use_common_surface_shader,
            path_mode=path_mode,
            name_decorations=name_decorations,
+           coord_decimals=coord_decimals,
+           normal_decimals=normal_decimals,
+           uv_decimals=uv_decimals,
+           color_decimals=color_decimals,
+           strip_zeros=strip_zeros,
            )
 
+    file.close()
+
     return {'FINISHED'}